@@ -70,6 +70,14 @@ class BiopharmaceuticsModel:
         # Total amount of drug that is available at time t
         return 0.0
 
+    def getAgArray(self,t):
+        # Vectorized version of getAg for an array of times. Models may override it with a faster version
+        return np.array([self.getAg(ti) for ti in t],np.double)
+
+    def getParameterKey(self):
+        # Values that identify the current profile, used to cache the drug input
+        return tuple(self.parameters)
+
     def getEquation(self):
         return ""
 
@@ -121,6 +129,10 @@ class BiopharmaceuticsModelOrder0(BiopharmaceuticsModel):
         Rin = self.parameters[0]
         return max(self.Amax-Rin*t,0.0)
 
+    def getAgArray(self,t):
+        Rin = self.parameters[0]
+        return np.where(t<0,0.0,np.maximum(self.Amax-Rin*t,0.0))
+
     def getEquation(self):
         Rin = self.parameters[0]
         return "D(t)=(%f)*t"%(Rin)
@@ -160,6 +172,14 @@ class BiopharmaceuticsModelOrder01(BiopharmaceuticsModel):
             A0=max(self.Amax-Rin*t0,0.0)
             return A0*math.exp(-Ka*(t-t0))
 
+    def getAgArray(self,t):
+        Rin = self.parameters[0]
+        t0 = self.parameters[1]
+        Ka = self.parameters[2]
+        A0=max(self.Amax-Rin*t0,0.0)
+        Ag = np.where(t<t0,np.maximum(self.Amax-Rin*t,0.0),A0*np.exp(-Ka*(np.maximum(t,t0)-t0)))
+        return np.where(t<0,0.0,Ag)
+
     def getEquation(self):
         Rin = self.parameters[0]
         t0 = self.parameters[1]
@@ -230,6 +250,10 @@ class BiopharmaceuticsModelOrder1(BiopharmaceuticsModel):
         Ka = self.parameters[0]
         return self.Amax*math.exp(-Ka*t)
 
+    def getAgArray(self,t):
+        Ka = self.parameters[0]
+        return np.where(t<0,0.0,self.Amax*np.exp(-Ka*np.maximum(t,0.0)))
+
     def getEquation(self):
         Ka = self.parameters[0]
         return "D(t)=(%f)*(1-exp(-(%f)*t)"%(self.Amax,Ka)
@@ -297,6 +321,11 @@ class BiopharmaceuticsModelImmediateAndOrder1(BiopharmaceuticsModel):
         F = self.parameters[1]
         return self.Amax*(1-F)*math.exp(-Ka*t)
 
+    def getAgArray(self,t):
+        Ka = self.parameters[0]
+        F = self.parameters[1]
+        return np.where(t<0,0.0,self.Amax*(1-F)*np.exp(-Ka*np.maximum(t,0.0)))
+
     def getEquation(self):
         Ka = self.parameters[0]
         F = self.parameters[1]
@@ -334,6 +363,15 @@ class BiopharmaceuticsModelOrder1AndOrder1(BiopharmaceuticsModel):
             A2=(1-F1)*math.exp(-Ka2*(t-tlag12))
         return self.Amax*(A1+A2)
 
+    def getAgArray(self,t):
+        Ka1 = self.parameters[0]
+        Ka2 = self.parameters[1]
+        tlag12 = self.parameters[2]
+        F1 = self.parameters[3]
+        A1=F1*np.exp(-Ka1*np.maximum(t,0.0))
+        A2=np.where(t>tlag12,(1-F1)*np.exp(-Ka2*(np.maximum(t,tlag12)-tlag12)),1-F1)
+        return np.where(t<0,0.0,self.Amax*(A1+A2))
+
     def getEquation(self):
         Ka1 = self.parameters[0]
         Ka2 = self.parameters[1]
@@ -603,6 +641,20 @@ class BiopharmaceuticsModelOrder1Multiple4(BiopharmaceuticsModel):
         viaslow = (1-F1)*Fslow*math.exp(-Kaslow*t)
         return self.Amax*(via1 + viafast + viamed + viaslow)
 
+    def getAgArray(self,t):
+        F1 = self.parameters[0]
+        Ka1 = self.parameters[1]
+        Fmed = self.parameters[2]
+        Kamed = self.parameters[3]
+        Fslow = self.parameters[4]
+        Kaslow = self.parameters[5]
+        tp = np.maximum(t,0.0)
+        via1 = F1*np.exp(-Ka1*tp)
+        viafast = (1-F1)*(1-Fmed-Fslow)
+        viamed = (1-F1)*Fmed*np.exp(-Kamed*tp)
+        viaslow = (1-F1)*Fslow*np.exp(-Kaslow*tp)
+        return np.where(t<0,0.0,self.Amax*(via1 + viafast + viamed + viaslow))
+
     def getEquation(self):
         F1 = self.parameters[0]
         Ka1 = self.parameters[1]
@@ -907,6 +959,10 @@ class BiopharmaceuticsModelNumerical(BiopharmaceuticsModel):
         self.B = PchipInterpolator(tUnique, Aunique)
         self.tmin=np.min(t)
         self.tmax=np.max(t)
+        self.xyKey=(np.asarray(t,dtype=np.float64).tobytes(),np.asarray(A,dtype=np.float64).tobytes())
+
+    def getParameterKey(self):
+        return self.xyKey
 
     def getDescription(self):
         return ['Numerical source with t and A']
@@ -1199,6 +1255,11 @@ class PKPDDose:
     TYPE_REPEATED_BOLUS = 2
     TYPE_INFUSION = 3
 
+    # Drug inputs with a closed form response in linear systems
+    INPUT_IMPULSE = 1
+    INPUT_CONSTANT_RATE = 2
+    INPUT_FIRST_ORDER = 3
+
     def __init__(self):
         self.doseName = None
         self.via = None
@@ -1360,7 +1421,7 @@ class PKPDDose:
     def getDoseAt(self,t0,dt=0.5):
         """Dose between t0<=t<t0+dt, t0 is in the units of the dose"""
         t0-=self.via.tlag
-        t1=t0+dt-self.via.tlag
+        t1=t0+dt
         if self.doseType == PKPDDose.TYPE_BOLUS:
             if t0<=self.t0 and self.t0<t1:
                 return self.doseAmount
@@ -1396,6 +1457,32 @@ class PKPDDose:
         # print("t0=%f self.t0=%f self.tlag=%f self.dt=%f -> released=%f"%(t0,self.t0,self.via.tlag,dt,doseAmount))
         return doseAmount
 
+    def getDoseAtArray(self,t,dt=0.5):
+        """Vectorized version of getDoseAt for an array of times t"""
+        t0=t-self.via.tlag
+        t1=t0+dt
+        if self.doseType == PKPDDose.TYPE_BOLUS:
+            return np.where(np.logical_and(t0<=self.t0,self.t0<t1),self.doseAmount,0.0)
+        elif self.doseType == PKPDDose.TYPE_REPEATED_BOLUS:
+            doseAmount=np.zeros(t.shape)
+            for tDose in np.arange(self.t0,self.tF,self.every):
+                doseAmount[np.logical_and(t0<=tDose,tDose<t1)]+=self.doseAmount
+            return doseAmount
+        elif self.doseType == PKPDDose.TYPE_INFUSION:
+            tLeft=np.maximum(t0,self.t0)
+            tRight=np.minimum(t1,self.tF)
+            return np.where(np.logical_or(t0>self.tF,t1<self.t0),0.0,self.doseAmount*(tRight-tLeft))
+
+    def getAmountReleasedArray(self,t,dt=0.5):
+        """Vectorized version of getAmountReleasedAt for an array of times t"""
+        if self.via.viaProfile == None or self.doseType==PKPDDose.TYPE_INFUSION:
+            doseAmount = self.getDoseAtArray(t,dt)
+        else:
+            self.via.viaProfile.Amax = self.via.bioavailability*self.doseAmount
+            tDose = t-self.t0-self.via.tlag
+            doseAmount = self.via.viaProfile.getAgArray(tDose)-self.via.viaProfile.getAgArray(tDose+dt)
+        return np.maximum(doseAmount,0.0)
+
     def getAmountReleasedUpTo(self, t0):
         doseAmount = 0.0
         if self.via.viaProfile == None:
@@ -1411,6 +1498,42 @@ class PKPDDose:
             doseAmount=0
         return doseAmount
 
+    def getReleaseRateAt(self,t,h=1e-4):
+        """Release rate at t of the doses that are not impulsive (see isImpulsive)"""
+        tDose = t-self.t0-self.via.tlag
+        if self.doseType == PKPDDose.TYPE_INFUSION:
+            if tDose>=0 and t-self.via.tlag<self.tF:
+                return self.doseAmount
+            else:
+                return 0.0
+        elif self.via.viaProfile == None:
+            return 0.0
+        else:
+            self.via.viaProfile.Amax = self.via.bioavailability*self.doseAmount
+            return max(self.via.viaProfile.getAg(tDose)-self.via.viaProfile.getAg(tDose+h),0.0)/h
+
+    def getLinearInput(self):
+        """
+        Drug input as (inputType, tStart, amount, extra): an impulse of amount at tStart, a constant rate=amount
+        from tStart to extra, or a first order absorption of amount starting at tStart with rate constant extra.
+        Returns None if the release profile does not have a closed form.
+        """
+        tStart = self.t0+self.via.tlag
+        if self.doseType == PKPDDose.TYPE_INFUSION:
+            return (PKPDDose.INPUT_CONSTANT_RATE, tStart, self.doseAmount, self.tF+self.via.tlag)
+        elif self.doseType != PKPDDose.TYPE_BOLUS:
+            return None
+        elif self.via.viaProfile == None:
+            return (PKPDDose.INPUT_IMPULSE, tStart, self.doseAmount, None)
+        elif self.via.via == "ev1":
+            return (PKPDDose.INPUT_FIRST_ORDER, tStart, self.via.bioavailability*self.doseAmount,
+                    self.via.viaProfile.parameters[0])
+        return None
+
+    def isImpulsive(self):
+        # Intravenous boluses enter the system instantaneously
+        return self.via.viaProfile == None and self.doseType == PKPDDose.TYPE_BOLUS
+
     def isDoseABolus(self):
         if self.doseType != PKPDDose.TYPE_BOLUS:
             return False
@@ -1446,8 +1569,11 @@ class DrugSource:
         self.parameterNames = []
         self.parameterUnits = []
         self.vias = []
+        self.inputTable = None
+        self.inputTableKey = None
 
     def setDoses(self, parsedDoseList, t0, tF):
+        self.inputTableKey = None
         self.originalDoseList = parsedDoseList
         self.parsedDoseList = []
         collectedVias = []
@@ -1493,6 +1619,61 @@ class DrugSource:
             doseAmount+=dose.getAmountReleasedUpTo(t0)
         return doseAmount
 
+    def getAmountReleasedArray(self,t,dt=0.5):
+        doseAmount = np.zeros(t.shape)
+        for dose in self.parsedDoseList:
+            doseAmount+=dose.getAmountReleasedArray(t,dt)
+        return doseAmount
+
+    def getReleaseRateAt(self,t0):
+        rate = 0.0
+        for dose in self.parsedDoseList:
+            rate+=dose.getReleaseRateAt(t0)
+        return rate
+
+    def getImpulsiveDoses(self):
+        """List of (time, amount) of the doses that enter the system instantaneously"""
+        return [(dose.t0+dose.via.tlag, dose.doseAmount) for dose in self.parsedDoseList if dose.isImpulsive()]
+
+    def getLinearInputs(self):
+        """List with the linear input of each dose (see PKPDDose.getLinearInput), None if any of them has no closed form"""
+        retval = []
+        for dose in self.parsedDoseList:
+            linearInput = dose.getLinearInput()
+            if linearInput is None:
+                return None
+            retval.append(linearInput)
+        return retval
+
+    def getInputBreakpoints(self):
+        """Times at which the drug input may change abruptly"""
+        retval = []
+        for dose in self.parsedDoseList:
+            retval.append(dose.t0+dose.via.tlag)
+            if dose.doseType == PKPDDose.TYPE_INFUSION:
+                retval.append(dose.tF+dose.via.tlag)
+        return retval
+
+    def getParameterKey(self):
+        key = []
+        for via,_ in self.vias:
+            key+=[via.tlag, via.bioavailability]
+            if via.viaProfile is not None:
+                key+=list(via.viaProfile.getParameterKey())
+        return tuple(key)
+
+    def getAmountReleasedTable(self,t0,dt,Nsamples):
+        """
+        Amount released in [t,t+dt/2) and [t,t+dt) for t=t0+i*dt, i=0,1,...,Nsamples-1.
+        The table is cached and only recomputed when the time grid or the via parameters change.
+        """
+        key = (t0,dt,Nsamples,self.getParameterKey())
+        if self.inputTableKey!=key:
+            t = t0+np.arange(0,Nsamples)*dt
+            self.inputTable = (self.getAmountReleasedArray(t,0.5*dt), self.getAmountReleasedArray(t,dt))
+            self.inputTableKey = key
+        return self.inputTable
+
     def getEquation(self):
         retval = ""
         for via,_ in self.vias:
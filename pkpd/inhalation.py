@@ -29,13 +29,14 @@ Classes for inhalation PK simulations.
 See Hartung and Borghardt. A mechanistic framework for a priori pharmacokinetic
 predictions of orally inhaled drugs. PLOS Computational Biology, 16: e1008466 (2020)
 """
+import copy
 import math
 import numpy as np
 import scipy.linalg
-from scipy.interpolate import interp1d, interp2d
+from scipy.interpolate import interp1d
 from pwem.objects import EMObject
 from pyworkflow.object import String, Integer
-from .utils import int_dx, int_dx1dx2
+from .utils import int_dx, int_dx1dx2, PhaseTimer
 
 def diam2vol(diameters):
     # Hartung2020_MATLAB/functions/diam2vol.m
@@ -288,6 +289,7 @@ class PKDepositionParameters(EMObject):
         fh.close()
 
         diameters = np.asarray(diameters) # [um] for D
+        self.depositionDiameters = diameters # as given in the file
         if self.diameterMode=="aerodynamic":
             # Hartung2020_MATLAB/functions/aero2geom.m
             lambdaVar = 1; # spherical shape
@@ -317,6 +319,29 @@ class PKDepositionParameters(EMObject):
         alveolarGeneration = len(self.lung.getBronchial()['type'])+1
         self.readDepositionFile(alveolarGeneration)
 
+    def getScaledCopy(self, doseMultiplier):
+        """ Copy of the deposition parameters, once read, with the dose multiplied by doseMultiplier """
+        deposition = copy.copy(self)
+        deposition.doseMultiplier = self.doseMultiplier * doseMultiplier
+        deposition.dose = self.dose * doseMultiplier
+        deposition.dose_nmol = self.dose_nmol * doseMultiplier
+        deposition.bronchiDose_nmol = self.bronchiDose_nmol * doseMultiplier
+        deposition.alveolarDose_nmol = self.alveolarDose_nmol * doseMultiplier
+        deposition.throatDose = self.throatDose * doseMultiplier
+        return deposition
+
+    def getSizeClassCopy(self, i):
+        """ Copy of the deposition parameters, once read, with only the particles of the i-th diameter. They are all
+            deposited in the lung, there is no throat dose. """
+        deposition = copy.copy(self)
+        inClass = np.arange(self.particleSize.size)==i
+        deposition.bronchiDose_nmol = self.bronchiDose_nmol * inClass
+        deposition.alveolarDose_nmol = self.alveolarDose_nmol * inClass
+        deposition.throatDose = 0.0
+        deposition.dose_nmol = np.sum(deposition.bronchiDose_nmol) + np.sum(deposition.alveolarDose_nmol)
+        deposition.dose = deposition.dose_nmol * self.substance.MW * 1e-3 # [nmol] * [g/mol] * 1e-3 = [ug]
+        return deposition
+
     def getData(self):
         data = {}
         data['bronchial'] = self.bronchiDose_nmol
@@ -378,9 +403,9 @@ class PKInhalationDissolution(EMObject):
     #    (based on the assumption that only a part of the particle surface
     #    is in contact with the dissolution medium)
 
-    UNSAT       = 0
+    UNSAT       = 0 # Implemented
     TRUNC_UNSAT = 1
-    SAT         = 2 # Only this one is implemented
+    SAT         = 2 # Implemented
     TRUNC_SAT   = 3
     TRUNC2_SAT  = 4
     CAP         = 5
@@ -392,6 +417,8 @@ class PKInhalationDissolution(EMObject):
         self.type = Integer()
         self.type.set(self.SAT)
         self.substanceParams = None
+        self.sizeGrid = None
+        self.sizeFactor = None
 
     def prepare(self, substanceParams, part):
         self.substanceParams = substanceParams
@@ -411,15 +438,31 @@ class PKInhalationDissolution(EMObject):
         print("Density in [nmol/cm3]",self.rho)
 
         D = self.kdiss / self.Cs
-        K = 4 * math.pi * D / (self.rho * np.power(4.0/3.0 * math.pi, 1.0/3.0))
-
+        self.K = 4 * math.pi * D / (self.rho * np.power(4.0/3.0 * math.pi, 1.0/3.0))
+
+        if not self.type.get() in [self.UNSAT, self.SAT]:
+            raise Exception("Dissolution type %d is not implemented"%self.type.get())
+        self.sizeGrid = None
+        self.sizeFactor = None
+
+    # The dissolution speed is the outer product of a factor depending on the concentration in the fluid and
+    # another one depending on the particle size (see getDissolution)
+    def getSizeFactor(self, s):
+        # The size grid does not change during a simulation, the factor is computed only when it changes
+        if self.sizeFactor is None or self.sizeGrid is not s:
+            self.sizeGrid = s
+            self.sizeFactor = np.reshape(np.where(s>0, np.power(s,1.0/3.0), 0.0),(1,s.size))
+        return self.sizeFactor
+
+    def getConcentrationFactor(self, Cf):
         if self.type.get()==self.SAT:
-            self.dissol = lambda s, Cf: np.multiply(np.reshape(K*(self.Cs-Cf),(Cf.size,1)),
-                                                    np.reshape(np.where(s>0, np.power(s,1.0/3.0), 0.0),(1,s.size)))
-                          # [cm^3/min]
+            return self.K*(self.Cs-Cf)
+        else: # UNSAT, sink conditions
+            return np.full(Cf.size, self.K*self.Cs)
 
-    def getDissolution(self, s, Cf, h):
-        return self.dissol(s,Cf)
+    def getDissolution(self, s, Cf, h, out=None):
+        # [cm^3/min], a Cf.size x s.size array. If given, out is the array where it is written.
+        return np.multiply(np.reshape(self.getConcentrationFactor(Cf),(Cf.size,1)), self.getSizeFactor(s), out=out)
 
 class PKLung(EMObject):
     # Hartung2020_MATLAB/functions/get_bronchial_kinetics.m
@@ -532,6 +575,33 @@ def P_Qbr(lungData, systemicData, Xbnd):
     Q_Xctr = conserving_projection(np.concatenate(([0],lungData['end_cm'])), Qgen, Xbnd)
     return np.divide(Q_Xctr,np.diff(Xbnd));
 
+def bilinear_interpolation(x, y, z, xi, yi, fill_value=0):
+    #   Bilinear interpolation of z, defined on the rectilinear grid (x, y) with shape (y.size, x.size),
+    #   at all the points of the rectilinear grid (xi, yi). The result has shape (yi.size, xi.size),
+    #   points outside the grid take fill_value. As in interp2d, x and y may be in any order, they are sorted
+    #   (together with z) before interpolating.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    xOrder = np.argsort(x)
+    yOrder = np.argsort(y)
+    x = x[xOrder]
+    y = y[yOrder]
+    z = np.asarray(z)[np.ix_(yOrder, xOrder)]
+    def weights(x, xi):
+        i = np.clip(np.searchsorted(x, xi, side='right') - 1, 0, x.size - 2)
+        h = x[i + 1] - x[i]
+        w = np.divide(xi - x[i], h, out=np.zeros(xi.shape), where=h>0)
+        return i, w, np.logical_or(xi < x[0], xi > x[-1])
+    ix, wx, outx = weights(x, xi)
+    iy, wy, outy = weights(y, yi)
+    zy = z[iy, :] + np.diff(z, axis=0)[iy, :] * np.reshape(wy, (yi.size, 1))
+    zi = np.diff(zy, axis=1)[:, ix]
+    zi *= wx
+    zi += zy[:, ix]
+    zi[:, outx] = fill_value
+    zi[outy, :] = fill_value
+    return zi
+
 def project_deposition_2D(depositionData,X,S,lungData):
     #   Project deposition data on 2D computational grid
     #   Strategy for projection on 2D grid:
@@ -560,8 +630,7 @@ def project_deposition_2D(depositionData,X,S,lungData):
     camtdat_br_xs = np.cumsum(np.pad(camtdat_br_x,((0,0),(1,0)),'constant',constant_values=0),axis=1)
 
     # step 3: linear interpolation projects onto solver location-size grid
-    interpolator = interp2d(sbnddat, xbnddat, camtdat_br_xs, bounds_error=False, fill_value=0)
-    camtbnd_br_xs = interpolator(S, X)
+    camtbnd_br_xs = bilinear_interpolation(sbnddat, xbnddat, camtdat_br_xs, S, X, fill_value=0)
 
     amtgrd_br_x = np.diff(camtbnd_br_xs, axis=0)
     amtgrd_br_xs = np.diff(amtgrd_br_x, axis=1)
@@ -586,7 +655,36 @@ def project_deposition_2D(depositionData,X,S,lungData):
     rho0alv = np.divide(amtgrd_alv, np.multiply(s,ds))
     return (rho0br, rho0alv)
 
-def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
+def project_deposition(depositionParams, lungParams, Sbnd):
+    # Initial particle densities (bronchial, alveolar) on the grid of saturable_2D_upwind_IE.
+    # They do not depend on the physiology multipliers and are proportional to the dose.
+    lungData = lungParams.getBronchial()
+    Xbnd = np.sort([0] + lungData['end_cm'].tolist() + lungData['pos'].tolist())
+    return project_deposition_2D(depositionParams.getData(), Xbnd, Sbnd, lungData)
+
+def lung_geometry(lungParams, pkLung):
+    # Location grid of saturable_2D_upwind_IE and the location-resolved quantities projected on it.
+    # They depend on the lung physiology and the substance (with their multipliers), but not on the size grid.
+    lungData = lungParams.getBronchial()
+    Xbnd = np.sort([0] + lungData['end_cm'].tolist() + lungData['pos'].tolist())
+    Xctr = Xbnd[:-1] + np.diff(Xbnd)/2
+    return {'Xbnd': Xbnd,
+            'lambdaX': pkLung.cilspeed(Xbnd),             # transport velocity
+            'kaX': pkLung.bronchialAbsorb(Xctr),          # absorption into tissue
+            'aFluX': P_aELF(lungData, Xbnd),              # cross-sectional areas
+            'aTisX': P_aTis(lungData, Xbnd),
+            'hFluX': P_hELF(lungData, Xctr),              # ELF heights in bronchi
+            'qX': P_Qbr(lungData, lungParams.getSystemic(), Xbnd)} # blood flow
+
+def quality_control_failures(qcValues):
+    #   Failed checks of the quality control of a time step of saturable_2D_upwind_IE: the values that are
+    #   negative or not finite (NaN or inf, as when the step is unstable)
+    qc = np.asarray(qcValues, dtype=float)
+    return np.logical_or(qc < 0, np.logical_not(np.isfinite(qc)))
+
+def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd, reportStep=1, rho0=None,
+                           geometry=None, adaptive=False, maxCFL=0.9, tolerance=1e-4, dtMax=None, profile=False,
+                           abortOnViolation=False):
     # Hartung2020_MATLAB/models/saturable_2D_upwind_IE.m
     #   Algorithm features:
     #   - Conducting airways, peripheral airways and systemic circulation fully coupled
@@ -602,6 +700,19 @@ def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
     #   The idea of this approach is that the size resolution in the data may
     #   be much coarser than that the location grid
     #   (extreme case: monodisperse particle distribution)
+    #
+    #   Only the particle densities of the current and next time steps are kept in memory (rolling window).
+    #   The outputs are reported every reportStep time steps and at the last time point.
+    #   rho0 are the initial particle densities (see project_deposition), they are projected from the
+    #   deposition if not given. Similarly, geometry is the result of lung_geometry.
+    #   If adaptive, tt are only the report times (subsampled by reportStep) and the time steps are chosen by the
+    #   solver, see the time loop below.
+    #   If profile, the wall time of each phase of the solver, the time steps, the CFL factors and the memory of the
+    #   arrays are returned in sol['profile'] (see print_solver_profile).
+    #   The quality control checks (CFL condition and negative quantities) are summarized at the end and returned in
+    #   sol['qc']. If abortOnViolation, an exception is raised as soon as one of them fails.
+    if profile:
+        timer = PhaseTimer()
     # print(Sbnd.shape)
     # print(np.mean(Sbnd)); aaaa
 
@@ -613,7 +724,9 @@ def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
     systemicData = lungParams.getSystemic()
     depositionData = depositionParams.getData()
 
-    Xbnd = np.sort([0] + lungData['end_cm'].tolist() + lungData['pos'].tolist())
+    if geometry is None:
+        geometry = lung_geometry(lungParams, pkLung)
+    Xbnd = geometry['Xbnd']
     Nx = Xbnd.size - 1
     Ns = Sbnd.size - 1
 
@@ -622,7 +735,7 @@ def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
     Sctr = Sbnd[:-1] + np.diff(Sbnd)/2
 
     # transport velocity
-    lambdaX = pkLung.cilspeed(Xbnd)
+    lambdaX = geometry['lambdaX']
     # print("Xbnd",np.mean(Xbnd))
     # print("lambdaX",np.mean(lambdaX)); aaaaa
 
@@ -631,24 +744,24 @@ def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
     ds = np.diff(Sbnd)
 
     # absorption into tissue
-    kaX = pkLung.bronchialAbsorb(Xctr)
+    kaX = geometry['kaX']
     # print("kaX",np.mean(kaX)); aaaaa
 
     # cross-sectional areas
-    aFluX = P_aELF(lungData, Xbnd)
-    aTisX = P_aTis(lungData, Xbnd)
+    aFluX = geometry['aFluX']
+    aTisX = geometry['aTisX']
     # print("aFluX",np.mean(aFluX));
     # print("aTisX",np.mean(aTisX)); aaaaa
 
     # ELF heights in bronchi / alveolar space
-    hFluX = P_hELF(lungData, Xctr)
+    hFluX = geometry['hFluX']
     hFlualv = alveolarData['ELF_cm3']/alveolarData['Surf_cm2']
     # print("hFluX",np.mean(hFluX));
     # print("hFlualv",np.mean(hFlualv)); aaaaa
 
     # blood flow
     Qalv = alveolarData['fQco'] * systemicData['Qco'] # Alveolar
-    qX = P_Qbr(lungData, systemicData, Xbnd)
+    qX = geometry['qX']
     QbrX = np.multiply(qX, dx) # bronchial (location-resolved)
     # print("Qalv",np.mean(Qalv));
     # print("QbrX",np.mean(QbrX)); aaaaa
@@ -679,35 +792,61 @@ def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
     # print("brELF",np.mean(brELF));
     # print("brTis",np.mean(brTis)); aaaaa
 
+    # Time points that are reported: every reportStep time points of tt and the last one
+    Nt = tt.size-1
+    reported = np.zeros(Nt+1, dtype=bool)
+    reported[::max(int(reportStep),1)] = True
+    reported[-1] = True
+    tReport = tt[reported]
+    Nr = tReport.size
+
     # Allocate lung amounts: A_flu(alv/br), A_tis(alv/br)
-    Nt=tt.size-1
-    Aalvflu = np.zeros((Nt+1,1));
-    Aalvtis = np.zeros((Nt+1,1));
+    Aalvflu = np.zeros((Nr,1));
+    Aalvtis = np.zeros((Nr,1));
 
-    Abrflu  = np.zeros((Nt+1,Nx));
-    Abrtis  = np.zeros((Nt+1,Nx));
+    Abrflu  = np.zeros((Nr,Nx));
+    Abrtis  = np.zeros((Nr,Nx));
 
     # Allocate systemic amounts: Asysgut, Asysctr, Asysper
-    Asysgut   = np.zeros((Nt+1,1));
-    Asysctr   = np.zeros((Nt+1,1));
-    Asysper   = np.zeros((Nt+1,1));
+    Asysgut   = np.zeros((Nr,1));
+    Asysctr   = np.zeros((Nr,1));
+    Asysper   = np.zeros((Nr,1));
 
     # Allocate amount cleared:
-    Aclear = np.zeros((Nt+1,1));     # for mass balance
-    Amcc   = np.zeros((Nt+1,1));     # to track cumulative amount cleared by MCC (not in mass balance)
+    Aclear = np.zeros((Nr,1));     # for mass balance
+    Amcc   = np.zeros((Nr,1));     # to track cumulative amount cleared by MCC (not in mass balance)
 
-    # Initialize PSPM densities (br/alv) and gut compartment with dosing
-    rhobr  = np.zeros((Nt+1,Nx,Ns));
-    rhoalv = np.zeros((Nt+1, 1,Ns));
+    # Amount of undissolved drug in alveolar space and conducting airways
+    Aalvsol = np.zeros(Nr)
+    Abrsol = np.zeros(Nr)
 
-    rho0br, rho0alv = project_deposition_2D(depositionData, Xbnd, Sbnd, lungData)
+    # Initialize PSPM densities (br/alv) and gut compartment with dosing
+    # Rolling window: time step n is stored at n%2
+    rhobr  = np.zeros((2,Nx,Ns));
+    rhoalv = np.zeros((2, 1,Ns));
+
+    if rho0 is None:
+        rho0br, rho0alv = project_deposition_2D(depositionData, Xbnd, Sbnd, lungData)
+    else:
+        rho0br, rho0alv = rho0
     # print("rho0br",np.mean(rho0br));
     # print("rho0alv",np.mean(rho0alv)); aaaaa
 
     rhobr[0,:,:]=rho0br
     rhoalv[0,:,:]=rho0alv
-    Asysgut[0] = depositionData['throat']
-    CFL_factor = np.zeros((Nt,1))
+
+    # State at the current time step: fluid and tissue amounts (bronchial cells first, then alveolar space),
+    # systemic amounts (gut, per, clear, ctr), cumulative MCC and undissolved amounts
+    Aflun = np.zeros(Nx+1)
+    Atisn = np.zeros(Nx+1)
+    Asysn = np.asarray([depositionData['throat'], 0.0, 0.0, 0.0])
+    Amccn = 0.0
+    Aalvsoln = int_dx(Sbnd,np.multiply(Sctr,rhoalv[0,0,:]))
+    Abrsoln = int_dx1dx2(Xbnd,Sbnd,np.multiply(Sctr,rhobr[0,:,:]))
+
+    Asysgut[0] = Asysn[0]
+    Aalvsol[0] = Aalvsoln
+    Abrsol[0] = Abrsoln
     # print("depositionData['throat']",depositionData['throat']); aaaa
 
     # Time iteration
@@ -736,137 +875,239 @@ def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
     # print("k01",k01);
     # print("F",F); aaaaa
 
+    # Dissolution speeds at the size boundaries, overwritten at every time step
+    dissolAlv = np.zeros((1,Sbnd.size))
+    dissolBr = np.zeros((Nx,Sbnd.size))
+
     Qbrtot = np.sum(QbrX) # total bronchial blood flow
     R =  pkLung.substanceData['R']
     # print("Qbrtot",Qbrtot);
     # print("R",R); aaaaa
 
     # Time loop
-    for n in range(Nt): # (semi - explicit Euler; implicit absorption into tissue)
-        dtn = dt[n]
-        Calvflun = Aalvflu[n] / alvELF;
-        Cbrflun = np.divide(Abrflu[n,:], brELF)
-
-        d_Sbnd_Cflualv = np.reshape(pkLung.inhalationDissolutionAlveoli.getDissolution(Sbnd, Calvflun, hFlualv),
-                                    (Sbnd.size))
+    # With adaptive time steps, each step satisfies the CFL condition (with maxCFL) in the cells with particles,
+    # is not larger than dtMax, and its estimated local error relative to each amount is below tolerance (otherwise
+    # it is rejected and repeated with a smaller step). Without them, the steps are those of tt. The reported
+    # quantities are linearly interpolated at the report times that fall inside a step.
+    t = tt[0]
+    n = 0
+    r = 1
+    dtPrev = None
+    nRejected = 0
+    qcChecks = ['CFL condition not satisfied', 'Asysgut not positive', 'Asysctr not positive', 'Asysper not positive',
+                'rho (br) not positive', 'A_flu (br) not positive', 'A_tis (br) not positive',
+                'rho (alv) not positive', 'A_flu (alv) not positive', 'A_tis (alv) not positive']
+    qcFirst = np.full(len(qcChecks), np.nan) # first time at which each check fails
+    qcCount = np.zeros(len(qcChecks), dtype=int) # number of time steps at which it fails
+    qcMask = np.zeros((Nr, len(qcChecks)), dtype=bool) # failures since the previous reported time point
+    qcPending = np.zeros(len(qcChecks), dtype=bool)
+    if profile:
+        timer.lap('setup')
+        dtStats = [np.inf, 0.0, 0.0] # min, sum, max
+        cflStats = [np.inf, 0.0, 0.0]
+    if adaptive:
+        Atot = Aalvsoln + Abrsoln + Asysn[0]
+        dtMin = 1e-6*(T-t)
+        if dtMax is None:
+            dtMax = np.inf
+        dtn = min(dt[0], dtMax) if Nt>0 else 0
+        Yn = np.concatenate(([Aalvsoln, Abrsoln], Aflun, Atisn, Asysn))
+        rateOld = None # rate of the previous step, the error of the first step cannot be estimated
+    while r < Nr: # (semi - explicit Euler; implicit absorption into tissue)
+        cur = n%2
+        nxt = (n+1)%2
+        Calvflun = Aflun[Nx:] / alvELF;
+        Cbrflun = np.divide(Aflun[0:Nx], brELF)
+
+        d_Sbnd_Cflualv = np.reshape(pkLung.inhalationDissolutionAlveoli.getDissolution(Sbnd, Calvflun, hFlualv,
+                                                                                       dissolAlv), (Sbnd.size))
         # print("d_Sbnd_Cflualv",np.mean(d_Sbnd_Cflualv)); aaaaa
-
-        rhoalv[n + 1,:,:] = \
-                 np.multiply(1-dtn*np.divide(d_Sbnd_Cflualv[0:-1],ds3D), rhoalv[n,:,:])+\
-                 dtn  * np.multiply(np.divide(d_Sbnd_Cflualv[1:], ds3D),\
-                                    np.pad(rhoalv[n,:,1:],((0,0),(0,1)),'constant',constant_values=0))
-        # aaa=rhoalv[n + 1,:,:]; print("rhoalv[n + 1,:,:]",np.mean(aaa)); aaaaa
-        dissolved_alv = np.dot(dSctr,np.reshape(np.multiply(d_Sbnd_Cflualv[1:-1], rhoalv[n,:,1:]),(dSctr.size)))
+        dissolved_alv = np.dot(dSctr,np.reshape(np.multiply(d_Sbnd_Cflualv[1:-1], rhoalv[cur,:,1:]),(dSctr.size)))
         # print("dissolved_alv",np.mean(dissolved_alv)); aaaaa
 
-        d_Sbnd_Cflubr = pkLung.inhalationDissolutionBronchi.getDissolution(Sbnd, Cbrflun, hFluX)
+        d_Sbnd_Cflubr = pkLung.inhalationDissolutionBronchi.getDissolution(Sbnd, Cbrflun, hFluX, dissolBr)
         # print("d_Sbnd_Cflubr",np.mean(d_Sbnd_Cflubr)); aaaaa
-
-        aux = rhobr[n, :, :]
-        rhobr[n + 1,:,:] = \
-            np.multiply(1 - dtn * (np.reshape(l_dx_pre,(l_dx_pre.size,1))+
-                                              np.reshape(np.divide(d_Sbnd_Cflubr[:,0:-1], ds3D),aux.shape)),
-                        rhobr[n, :, :]) + \
-            dtn * np.multiply(np.reshape(l_dx_post,(l_dx_post.size,1)),
-                              np.pad(rhobr[n,1:,:],((0,1),(0,0)),'constant',constant_values=0)) +\
-            dtn * np.multiply(np.divide(d_Sbnd_Cflubr[:,1:], ds3D), \
-                              np.pad(rhobr[n, :, 1:], ((0, 0), (0, 1)), 'constant', constant_values=0))
-        # aaa=rhobr[n + 1,:,:]; print("rhobr[n + 1,:,:]",np.mean(aaa)); aaaaa
-
         dissolved_br = np.multiply(dx,
                                    np.sum(np.multiply(dSctr,
-                                                      np.multiply(d_Sbnd_Cflubr[:, 1:-1],rhobr[n,:, 1:])),
+                                                      np.multiply(d_Sbnd_Cflubr[:, 1:-1],rhobr[cur,:, 1:])),
                                           axis=1))
         # print("dissolved_br",np.mean(dissolved_br)); aaaaa
-        A1 = np.diag(1+dtn*np.divide(PS_br,brELF))
-        A2 = np.diag(-(dtn/Kpl_u_br)*np.divide(PS_br,brTis))
-        A3 = np.diag(-dtn*np.divide(PS_br,brELF))
-        A4 = np.diag(1+np.multiply(np.divide(dtn,brTis),PS_br/Kpl_u_br + QbrX*(R/Kpl_br)))
-        Mbr = np.kron(A1,[[1,0],[0,0]])+np.kron(A2,[[0,1],[0,0]])+np.kron(A3,[[0,0],[1,0]])+np.kron(A4,[[0,0],[0,1]])
-        # print("Mbr",np.mean(Mbr))
-
-
-        Malv = np.asarray([[1 + dtn/alvELF*PS_alv,  -dtn/alvTis * PS_alv/Kpl_u_alv],
-                           [-dtn/alvELF*PS_alv   ,  1 + dtn/alvTis*(PS_alv/Kpl_u_alv + Qalv*R/Kpl_alv)]])
-        # print("Malv",np.mean(Malv))
-
-        Msys = np.asarray([ # gut        per       clear      ctr  <- X_i' %f(X_j)
-                           [1+dtn*k01     ,      0  ,      0   ,           0],           # gut
-                           [0             ,1+dtn*k21,      0   ,    -dtn*k12],           # per
-                           [-dtn*(1-F)*k01,      0  ,      1   ,    -dtn*k10],           # clear
-                           [-dtn*F*k01,     -dtn*k21,      0   , 1+dtn*(k10+k12+(Qalv+Qbrtot)/Vc)]]) # ctr
-        # print("Msys",np.mean(Msys)); aaaa
-
-        Mbrctr = -np.kron((dtn / Vc) * QbrX, [0, 1])
-        Malvctr = -np.asarray([0, (dtn / Vc) * Qalv])
-        Mbralvctr = np.concatenate((Mbrctr, Malvctr))
-        Mctrbr = -np.kron(dtn* np.divide(QbrX, brTis) * (R / Kpl_br), [0, 1])
-        Mctralv = -np.asarray([0, dtn * (Qalv / alvTis) * (R / Kpl_alv)])
-        Mctrbralv = np.concatenate((Mctrbr,Mctralv))
-
-        M = np.block([[scipy.linalg.block_diag(Mbr,Malv), np.zeros((2*Nx+2,3)), np.reshape(Mbralvctr,(2*Nx+2,1))],
-                     [np.block([[np.zeros((3,2*Nx+2))],[np.reshape(Mctrbralv,(1,2*Nx+2))]]),
-                      Msys]])
-        # print("M",np.mean(M)); aaaa
-        rhsbr = np.block([[Abrflu[n,:] + dtn * dissolved_br],[Abrtis[n,:]]])
-        # print("rhsbr",np.mean(rhsbr)); aaaa
-
-        mcc = dtn * lambdaX[0] * int_dx(Sbnd, np.multiply(Sctr,rhobr[n,0,:]))
-        rhs = np.concatenate((np.reshape(rhsbr,(rhsbr.size,1),order='F'),
-                              [Aalvflu[n] + dtn * dissolved_alv],
-                              [Aalvtis[n]],
-                              [Asysgut[n] + mcc],
-                              [Asysper[n]],
-                              [Aclear[n]],
-                              [Asysctr[n]]))
-        # print("rhs",np.mean(rhs)); aaaa
-        Ynext = np.linalg.solve(M,rhs)
-        # print("Ynext",np.mean(Ynext)); aaaa
-
-        Abrflu[n + 1,:]  = np.reshape(Ynext[0:(2*Nx):2],(Nx,))
-        Abrtis[n + 1,:]  = np.reshape(Ynext[1:(2*Nx):2],(Nx,))
-        Aalvflu[n + 1] = Ynext[2 * Nx]
-        Aalvtis[n + 1] = Ynext[2 * Nx + 1]
-        Asysgut[n + 1] = Ynext[2 * Nx + 2]
-        Asysper[n + 1] = Ynext[2 * Nx + 3]
-        Aclear[n + 1] = Ynext[2 * Nx + 4]
-        Asysctr[n + 1] = Ynext[2 * Nx + 5]
-
-        Amcc[n + 1] = Amcc[n] + mcc
-
-        # Quality control: detect a violation of CFL condition
-        aux = np.reshape(np.divide(d_Sbnd_Cflubr[:,0:-1],ds3D),(d_Sbnd_Cflubr.shape[0],d_Sbnd_Cflubr.shape[1]-1)) +\
-              np.dot(np.reshape(l_dx_pre,(l_dx_pre.shape[0],1)),np.ones((1,d_Sbnd_Cflubr.shape[1]-1)))
-        CFL_factor[n] = dtn * aux.max()
-        if CFL_factor[n] > 1:
-            print('CFL condition not satisfied at t=%f'%tt[n + 1])
-
-        # Quality control: detect a negative quantity
-        if Asysgut[n+1] < 0:
-            print('Asysgut not positive at t=%f'%tt[n + 1])
-        if Asysctr[n+1] < 0:
-            print('Asysctr not positive at t=%f'%tt[n + 1])
-        if Asysper[n+1] < 0:
-            print('Asysper not positive at t=%f'%tt[n + 1])
-
-        if (rhobr[n+1,:,:]).min() < 0:
-            print('rho (br) not positive at t=%f'%tt[n + 1])
-        if (Abrflu[n+1,:]).min() < 0:
-            print('A_flu (br) not positive at t=%f'%tt[n + 1])
-        if (Abrtis[n+1,:]).min() < 0:
-            print('A_tis (br) not positive at t=%f'%tt[n + 1])
-
-        if (rhoalv[n+1,:,:]).min() < 0:
-            print('rho (alv) not positive at t=%f'%tt[n + 1])
-        if (Aalvflu[n+1,:]).min() < 0:
-            print('A_flu (alv) not positive at t=%f'%tt[n + 1])
-        if (Aalvtis[n+1,:]).min() < 0:
-            print('A_tis (alv) not positive at t=%f'%tt[n + 1])
-
-    # Amount of undissolved drug in alveolar space
-    Aalvsol = np.zeros(rhoalv.shape[0])
-    for n in range(rhoalv.shape[0]):
-        Aalvsol[n]=int_dx(Sbnd,np.multiply(Sctr,np.reshape(rhoalv[n,0,:],(rhoalv.shape[2]))))
+        solidMcc = int_dx(Sbnd, np.multiply(Sctr,rhobr[cur,0,:]))
+        if profile:
+            timer.lap('dissolution')
+
+        # Rate of the CFL condition (the CFL factor is dtn times this rate)
+        d_ds_br = np.divide(d_Sbnd_Cflubr[:,0:-1], ds)
+        cflBr = d_ds_br + np.reshape(l_dx_pre,(l_dx_pre.size,1))
+        if adaptive:
+            # Only the cells with particles can become unstable
+            cflAlv = np.divide(d_Sbnd_Cflualv[0:-1],ds)
+            maskBr = rhobr[cur,:,:]!=0
+            maskAlv = rhoalv[cur,0,:]!=0
+            cflRate = max(cflBr[maskBr].max() if maskBr.any() else 0,
+                          cflAlv[maskAlv].max() if maskAlv.any() else 0)
+            if cflRate>0:
+                dtn = min(dtn, maxCFL/cflRate)
+            if dtPrev is not None and 0.8*dtn<=dtPrev<=dtn:
+                # Keep the previous step (and its factorization) if it is not much smaller than the allowed one
+                dtn = dtPrev
+            lastStep = t + dtn >= T
+            if lastStep:
+                dtn = T - t
+        else:
+            cflRate = cflBr.max()
+            dtn = dt[n]
+        if profile:
+            timer.lap('step control')
+
+        accepted = False
+        while not accepted:
+            rhoalv[nxt,:,:] = \
+                     np.multiply(1-dtn*np.divide(d_Sbnd_Cflualv[0:-1],ds3D), rhoalv[cur,:,:])+\
+                     dtn  * np.multiply(np.divide(d_Sbnd_Cflualv[1:], ds3D),\
+                                        np.pad(rhoalv[cur,:,1:],((0,0),(0,1)),'constant',constant_values=0))
+            # aaa=rhoalv[nxt,:,:]; print("rhoalv[nxt,:,:]",np.mean(aaa)); aaaaa
+
+            rhobr[nxt,:,:] = \
+                np.multiply(1 - dtn * (np.reshape(l_dx_pre,(l_dx_pre.size,1))+d_ds_br), rhobr[cur, :, :]) + \
+                dtn * np.multiply(np.reshape(l_dx_post,(l_dx_post.size,1)),
+                                  np.pad(rhobr[cur,1:,:],((0,1),(0,0)),'constant',constant_values=0)) +\
+                dtn * np.multiply(np.divide(d_Sbnd_Cflubr[:,1:], ds3D), \
+                                  np.pad(rhobr[cur, :, 1:], ((0, 0), (0, 1)), 'constant', constant_values=0))
+            # aaa=rhobr[nxt,:,:]; print("rhobr[nxt,:,:]",np.mean(aaa)); aaaaa
+            if profile:
+                timer.lap('transport')
+
+            if dtn!=dtPrev:
+                # The system matrix is block diagonal, with a 2x2 (fluid, tissue) block per bronchial cell and one
+                # more for the alveolar space, bordered by the coupling of the tissues with the central compartment.
+                # The blocks are eliminated analytically and only the 4x4 systemic system is solved.
+                # blockFF, blockFT, blockTF, blockTT: block coefficients (bronchial cells first, then alveolar space)
+                blockFF = np.append(1+dtn*np.divide(PS_br,brELF), 1 + dtn/alvELF*PS_alv)
+                blockFT = np.append(-(dtn/Kpl_u_br)*np.divide(PS_br,brTis), -dtn/alvTis * PS_alv/Kpl_u_alv)
+                blockTF = np.append(-dtn*np.divide(PS_br,brELF), -dtn/alvELF*PS_alv)
+                blockTT = np.append(1+np.multiply(np.divide(dtn,brTis),PS_br/Kpl_u_br + QbrX*(R/Kpl_br)),
+                                    1 + dtn/alvTis*(PS_alv/Kpl_u_alv + Qalv*R/Kpl_alv))
+                blockDet = blockFF*blockTT-blockFT*blockTF
+                # coupling of the tissue equations with ctr (tisCtr) and of the ctr equation with the tissues (ctrTis)
+                tisCtr = -(dtn / Vc) * np.append(QbrX, Qalv)
+                ctrTis = -dtn * np.append(np.divide(QbrX, brTis) * (R / Kpl_br), (Qalv / alvTis) * (R / Kpl_alv))
+                # response of the blocks to ctr
+                wFlu = -blockFT*tisCtr/blockDet
+                wTis = blockFF*tisCtr/blockDet
+
+                Msys = np.asarray([ # gut        per       clear      ctr  <- X_i' %f(X_j)
+                                   [1+dtn*k01     ,      0  ,      0   ,           0],           # gut
+                                   [0             ,1+dtn*k21,      0   ,    -dtn*k12],           # per
+                                   [-dtn*(1-F)*k01,      0  ,      1   ,    -dtn*k10],           # clear
+                                   [-dtn*F*k01,     -dtn*k21,      0   , 1+dtn*(k10+k12+(Qalv+Qbrtot)/Vc)]]) # ctr
+                Msys[3,3] -= np.dot(ctrTis, wTis)
+                MsysLU = scipy.linalg.lu_factor(Msys, check_finite=False)
+                dtPrev = dtn
+                if profile:
+                    timer.lap('assembly')
+
+            rhsFlu = Aflun + dtn * np.append(dissolved_br, dissolved_alv)
+            uFlu = (blockTT*rhsFlu-blockFT*Atisn)/blockDet
+            uTis = (blockFF*Atisn-blockTF*rhsFlu)/blockDet
+
+            mcc = dtn * lambdaX[0] * solidMcc
+            rhsSys = np.asarray([Asysn[0] + mcc, Asysn[1], Asysn[2], Asysn[3] - np.dot(ctrTis, uTis)])
+            Ysys = scipy.linalg.lu_solve(MsysLU, rhsSys, check_finite=False)
+            Yflu = uFlu - wFlu*Ysys[3]
+            Ytis = uTis - wTis*Ysys[3]
+            if profile:
+                timer.lap('solve')
+
+            accepted = True
+            if adaptive:
+                Aalvsol1 = int_dx(Sbnd,np.multiply(Sctr,rhoalv[nxt,0,:]))
+                Abrsol1 = int_dx1dx2(Xbnd,Sbnd,np.multiply(Sctr,rhobr[nxt,:,:]))
+                Y = np.concatenate(([Aalvsol1, Abrsol1], Yflu, Ytis, Ysys))
+                rate = (Y-Yn)/dtn
+                # Local error of the Euler step, estimated from the change of the rates, relative to each amount.
+                # The first step, without a previous rate, is accepted as given.
+                error = None
+                if rateOld is not None:
+                    error = np.max(0.5*dtn*np.abs(rate-rateOld)/(np.abs(Y)+1e-3*Atot))
+                if error is not None and error>tolerance and dtn>dtMin:
+                    # Reject the step and try a smaller one
+                    dtn = max(dtn*max(0.2, 0.9*np.sqrt(tolerance/error)), dtMin)
+                    lastStep = False
+                    accepted = False
+                    nRejected += 1
+                if profile:
+                    timer.lap('step control')
+
+        if adaptive:
+            tNew = T if lastStep else t + dtn
+        else:
+            tNew = tt[n + 1]
+
+        # Quality control: the CFL condition and the sign of the quantities are checked all together (the CFL
+        # factor as 1-CFL), the failures are recorded and reported after the time loop
+        CFL_factor = dtn * cflRate
+        qcValues = [1-CFL_factor, Ysys[0], Ysys[3], Ysys[1], rhobr[nxt,:,:].min(), Yflu[0:Nx].min(), Ytis[0:Nx].min(),
+                    rhoalv[nxt,:,:].min(), Yflu[Nx], Ytis[Nx]]
+        qcFailed = quality_control_failures(qcValues)
+        if np.any(qcFailed):
+            if abortOnViolation:
+                raise Exception("Quality control failed at t=%f: %s"%
+                                (tNew, ", ".join([check for check, failed in zip(qcChecks, qcFailed) if failed])))
+            qcFirst = np.where(np.logical_and(qcFailed, np.isnan(qcFirst)), tNew, qcFirst)
+            qcCount += qcFailed
+            qcPending |= qcFailed
+        if profile:
+            dtStats = [min(dtStats[0], dtn), dtStats[1]+dtn, max(dtStats[2], dtn)]
+            cflStats = [min(cflStats[0], CFL_factor), cflStats[1]+CFL_factor, max(cflStats[2], CFL_factor)]
+            timer.lap('quality control')
+
+        # Report the time points in (t, tNew]
+        while r < Nr and tReport[r] <= tNew:
+            if tReport[r] == tNew:
+                if not adaptive:
+                    Aalvsol1 = int_dx(Sbnd,np.multiply(Sctr,rhoalv[nxt,0,:]))
+                    Abrsol1 = int_dx1dx2(Xbnd,Sbnd,np.multiply(Sctr,rhobr[nxt,:,:]))
+                interpolate = lambda x0, x1: x1
+            else:
+                w = (tReport[r] - t) / dtn
+                interpolate = lambda x0, x1: x0 + w * (x1 - x0)
+            Aalvsol[r] = interpolate(Aalvsoln, Aalvsol1)
+            Abrsol[r] = interpolate(Abrsoln, Abrsol1)
+            Abrflu[r,:] = interpolate(Aflun[0:Nx], Yflu[0:Nx])
+            Abrtis[r,:] = interpolate(Atisn[0:Nx], Ytis[0:Nx])
+            Aalvflu[r] = interpolate(Aflun[Nx], Yflu[Nx])
+            Aalvtis[r] = interpolate(Atisn[Nx], Ytis[Nx])
+            Asysgut[r] = interpolate(Asysn[0], Ysys[0])
+            Asysper[r] = interpolate(Asysn[1], Ysys[1])
+            Aclear[r] = interpolate(Asysn[2], Ysys[2])
+            Asysctr[r] = interpolate(Asysn[3], Ysys[3])
+            Amcc[r] = interpolate(Amccn, Amccn + mcc)
+            qcMask[r] = qcPending
+            qcPending[:] = False
+            r += 1
+        if profile:
+            timer.lap('report')
+
+        # Move to the next time step
+        Aflun = Yflu
+        Atisn = Ytis
+        Asysn = Ysys
+        Amccn = Amccn + mcc
+        if adaptive:
+            Aalvsoln = Aalvsol1
+            Abrsoln = Abrsol1
+            Yn = Y
+            rateOld = rate
+            if error is not None:
+                dtn = min(dtn*min(2.0, 0.9*np.sqrt(tolerance/max(error, 1e-12))), dtMax)
+        t = tNew
+        n += 1
+    Nt = n
+    tt = tReport
+    for check, count, first in zip(qcChecks, qcCount, qcFirst):
+        if count>0:
+            print('%s at %d time steps, the first one at t=%f'%(check, count, first))
     # print("Aalvsol",np.mean(Aalvsol)); aaaa
 
     # Concentration of drug dissolved in alveolar epithelial lining fluid
@@ -877,10 +1118,6 @@ def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
     # print("Calvflu",np.mean(Calvflu));
     # print("Calvtis",np.mean(Calvtis)); aaaa
 
-    # Amount of undissolved drug in conducting airways (bronchial)
-    Abrsol = np.zeros(rhobr.shape[0])
-    for n in range(rhobr.shape[0]):
-        Abrsol[n]=int_dx1dx2(Xbnd,Sbnd,np.multiply(Sctr,np.reshape(rhobr[n,:,:],(rhobr.shape[1],rhobr.shape[2]))))
     # print("Abrsol",np.mean(Abrsol));
 
     # Concentration of drug dissolved in bronchial epithelial lining fluid
@@ -926,7 +1163,7 @@ def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
 
     # Discretisation
     grd   = {'t':tt,'X':Xctr,'S':Sctr,'dX':dx,'dS':ds}
-    param = {'Nt':Nt,'Nx':Nx,'Ns':Ns,'T':T}
+    param = {'Nt':Nt,'Nx':Nx,'Ns':Ns,'T':T,'reportStep':reportStep}
     discr = {'grid':grd,'param':param}
 
     # Input
@@ -948,6 +1185,32 @@ def saturable_2D_upwind_IE(lungParams, pkLung, depositionParams, tt, Sbnd):
         'geom': geom,
         'discr':discr,
         'input':inpt,
-        'units':units
+        'units':units,
+        'qc':   {'checks': qcChecks, 'first': qcFirst, 'count': qcCount, 'mask': qcMask}
     }
-    return sol
\ No newline at end of file
+
+    if profile:
+        timer.lap('postprocessing')
+        arrays = [rhobr, rhoalv, dissolAlv, dissolBr, Aalvflu, Aalvtis, Abrflu, Abrtis, Asysgut, Asysctr, Asysper,
+                  Aclear, Amcc, Aalvsol, Abrsol, Cbrflu, Cbrtis]
+        sol['profile'] = {
+            'times': timer.times,
+            'steps': Nt,
+            'rejected': nRejected,
+            'dt': {'min': dtStats[0], 'mean': dtStats[1]/max(Nt,1), 'max': dtStats[2]},
+            'CFL': {'min': cflStats[0], 'mean': cflStats[1]/max(Nt,1), 'max': cflStats[2]},
+            'memory': sum([x.nbytes for x in arrays])
+        }
+    return sol
+
+def print_solver_profile(profile):
+    # Print the profile returned by saturable_2D_upwind_IE
+    totalTime = sum(profile['times'].values())
+    print("Solver profile ===================")
+    for phase, phaseTime in sorted(profile['times'].items(), key=lambda x: -x[1]):
+        print("   %-16s %9.3f s %5.1f%%"%(phase, phaseTime, 100*phaseTime/totalTime))
+    print("   %-16s %9.3f s"%("total", totalTime))
+    print("Time steps: %d (%d rejected)"%(profile['steps'], profile['rejected']))
+    print("Time step [min]: min=%g mean=%g max=%g"%(profile['dt']['min'], profile['dt']['mean'], profile['dt']['max']))
+    print("CFL factor: min=%g mean=%g max=%g"%(profile['CFL']['min'], profile['CFL']['mean'], profile['CFL']['max']))
+    print("Memory of the solver arrays [MB]: %.2f"%(profile['memory']/1024**2))
\ No newline at end of file
@@ -54,6 +54,15 @@ class PDPolynomial(PDGenericModel):
         self.yPredicted = [self.yPredicted] # From array(...) to [array(...)]
         return self.yPredicted
 
+    def hasJacobian(self, parameters):
+        return True
+
+    def getJacobian(self, parameters, x=None):
+        if x is None:
+            x=self.x
+        xToUse = x[0] if type(x)==list else x # From [array(...)] to array(...)
+        return [np.vander(np.asarray(xToUse,np.double),len(parameters))]
+
     def getDescription(self):
         return "Polynomial of degree %d (%s)"%(self.N, self.__class__.__name__)
 
@@ -242,6 +251,18 @@ class PDSaturated(PDGenericModel):
         self.yPredicted = [self.yPredicted] # From array(...) to [array(...)]
         return self.yPredicted
 
+    def hasJacobian(self, parameters):
+        return True
+
+    def getJacobian(self, parameters, x=None):
+        if x is None:
+            x = self.x
+        xToUse = np.asarray(x[0] if type(x)==list else x,np.double) # From [array(...)] to array(...)
+        emax = parameters[1]
+        eC50 = parameters[2]
+        saturation = xToUse / (eC50 + xToUse)
+        return [np.column_stack((np.ones(xToUse.shape[0]), saturation, -emax*saturation/(eC50 + xToUse)))]
+
     def getDescription(self):
         return "Saturated (%s)"%self.__class__.__name__
 
@@ -87,6 +87,23 @@ class PKPDExponentialModel(PKGenericModel):
         self.yPredicted = [self.yPredicted] # From array(...) to [array(...)]
         return self.yPredicted
 
+    def hasJacobian(self, parameters):
+        return True
+
+    def getJacobian(self, parameters, x=None):
+        if x is None:
+            x=self.x
+        xToUse = np.asarray(x[0],np.double) # From [array(...)] to array(...)
+        J = np.zeros((xToUse.shape[0],2*self.Nexp))
+        for k in range(1,self.Nexp):
+            if parameters[2*(k-1)]<parameters[2*k]:
+                return [J] # Constant prediction, see forwardModel
+        for k in range(0,self.Nexp):
+            expk = np.exp(-parameters[2*k+1]*xToUse)
+            J[:,2*k] = expk
+            J[:,2*k+1] = -parameters[2*k]*xToUse*expk
+        return [J]
+
     def getDescription(self):
         return "Sum of exponentials (%s)"%self.__class__.__name__
 
@@ -304,6 +321,22 @@ class PK_Monocompartment(PKPDODEModel):
         # print("G t=",t," dD=",dD," incC=",dD/V)
         return dD/V
 
+    def Fbatch(self, t, Y):
+        Cl=self.batchParameters[:,0]
+        V=self.batchParameters[:,1]
+        return np.column_stack([-Cl/V*Y[:,0]])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,1]
+        return np.column_stack([dD/V])
+
+    def getLinearSystem(self, parameters):
+        Cl=parameters[:,0]
+        V=parameters[:,1]
+        A=np.zeros((parameters.shape[0],1,1))
+        A[:,0,0]=-Cl/V
+        return A, np.column_stack([1/V])
+
     def getResponseDimension(self):
         return 1
 
@@ -403,6 +436,18 @@ class PK_MonocompartmentClint(PKPDODEModel):
         V=self.parameters[2]
         return dD/V
 
+    def Fbatch(self, t, Y):
+        Vmax=self.batchParameters[:,0]
+        Km=self.batchParameters[:,1]
+        V=self.batchParameters[:,2]
+        C=Y[:,0]
+        Clint=Vmax/(Km+C)
+        return np.column_stack([-Clint/V*C])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,2]
+        return np.column_stack([dD/V])
+
     def getResponseDimension(self):
         return 1
 
@@ -489,6 +534,33 @@ class PK_Twocompartments(PKPDODEModel):
         V=self.parameters[1]
         return np.array([dD/V,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        Cl=self.batchParameters[:,0]
+        V=self.batchParameters[:,1]
+        Clp=self.batchParameters[:,2]
+        Vp=self.batchParameters[:,3]
+        C=Y[:,0]
+        Cp=Y[:,1]
+
+        Q12 = Clp * (C-Cp)
+        return np.column_stack([-(Cl*C + Q12)/V, Q12/Vp])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,1]
+        return np.column_stack([dD/V,np.zeros_like(V)])
+
+    def getLinearSystem(self, parameters):
+        Cl=parameters[:,0]
+        V=parameters[:,1]
+        Clp=parameters[:,2]
+        Vp=parameters[:,3]
+        A=np.zeros((parameters.shape[0],2,2))
+        A[:,0,0]=-(Cl+Clp)/V
+        A[:,0,1]=Clp/V
+        A[:,1,0]=Clp/Vp
+        A[:,1,1]=-Clp/Vp
+        return A, np.column_stack([1/V,np.zeros_like(V)])
+
     def getResponseDimension(self):
         return 1
 
@@ -645,6 +717,23 @@ class PK_TwocompartmentsClint(PKPDODEModel):
         V=self.parameters[2]
         return np.array([dD/V,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        Vmax=self.batchParameters[:,0]
+        Km=self.batchParameters[:,1]
+        V=self.batchParameters[:,2]
+        Clp=self.batchParameters[:,3]
+        Vp=self.batchParameters[:,4]
+        C=Y[:,0]
+        Cp=Y[:,1]
+
+        Clint=Vmax/(Km+C)
+        Q12 = Clp * (C-Cp)
+        return np.column_stack([-(Clint*C + Q12)/V, Q12/Vp])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,2]
+        return np.column_stack([dD/V,np.zeros_like(V)])
+
     def getResponseDimension(self):
         return 1
 
@@ -760,6 +849,24 @@ class PK_TwocompartmentsClintCl(PKPDODEModel):
         V=self.parameters[3]
         return np.array([dD/V,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        Vmax=self.batchParameters[:,0]
+        Km=self.batchParameters[:,1]
+        Cl=self.batchParameters[:,2]
+        V=self.batchParameters[:,3]
+        Clp=self.batchParameters[:,4]
+        Vp=self.batchParameters[:,5]
+        C=Y[:,0]
+        Cp=Y[:,1]
+
+        Clint=Vmax/(Km+C)
+        Q12 = Clp * (C-Cp)
+        return np.column_stack([-((Clint+Cl)*C + Q12)/V, Q12/Vp])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,3]
+        return np.column_stack([dD/V,np.zeros_like(V)])
+
     def getResponseDimension(self):
         return 1
 
@@ -890,6 +997,26 @@ class PK_TwocompartmentsClintMetabolite(PKPDODEModel):
         V=self.parameters[2]
         return np.array([dD/V,0.0,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        Vmax=self.batchParameters[:,0]
+        Km=self.batchParameters[:,1]
+        V=self.batchParameters[:,2]
+        Clp=self.batchParameters[:,3]
+        Vp=self.batchParameters[:,4]
+        Clm=self.batchParameters[:,5]
+        Vm=self.batchParameters[:,6]
+        C=Y[:,0]
+        Cm=Y[:,1]
+        Cp=Y[:,2]
+
+        Clint=Vmax/(Km+C)
+        Q12 = Clp * (C-Cp)
+        return np.column_stack([-(Clint*C + Q12)/V, (Clint*C-Clm*Cm)/Vm, Q12/Vp])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,2]
+        return np.column_stack([dD/V,np.zeros_like(V),np.zeros_like(V)])
+
     def getResponseDimension(self):
         return 2
 
@@ -1030,6 +1157,25 @@ class PK_TwocompartmentsAutoinduction(PKPDODEModel):
         V=self.parameters[3]
         return np.array([dD/V,0.0,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        E0=self.batchParameters[:,0]
+        a=self.batchParameters[:,1]
+        kout=self.batchParameters[:,2]
+        V=self.batchParameters[:,3]
+        Clp=self.batchParameters[:,4]
+        Vp=self.batchParameters[:,5]
+        C=Y[:,0]
+        Cp=Y[:,1]
+        E=Y[:,2]
+
+        Cl=a*(1+E)
+        Q12 = Clp * (C-Cp)
+        return np.column_stack([-(Cl*C + Q12)/V, Q12/Vp, kout*(E0+C-E)])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,3]
+        return np.column_stack([dD/V,np.zeros_like(V),np.zeros_like(V)])
+
     def getResponseDimension(self):
         return 1
 
@@ -1146,6 +1292,17 @@ class PK_MonocompartmentUrine(PKPDODEModel):
         V=self.parameters[1]
         return np.array([dD/V,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        C = Y[:,0]
+        Cl=self.batchParameters[:,0]
+        V=self.batchParameters[:,1]
+        fe=self.batchParameters[:,2]
+        return np.column_stack([-Cl/V*C, fe*Cl*C])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,1]
+        return np.column_stack([dD/V,np.zeros_like(V)])
+
     def getResponseDimension(self):
         return 2
 
@@ -1231,6 +1388,22 @@ class PK_MonocompartmentLinkPD(PKPDODEModel):
         V=self.parameters[1]
         return np.array([dD/V,0.0,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        C = Y[:,0]
+        Cb = Y[:,2]
+
+        Cl=self.batchParameters[:,0]
+        V=self.batchParameters[:,1]
+        Clb=self.batchParameters[:,2]
+        Vb=self.batchParameters[:,3]
+        Q12 = Clb * (C-Cb)
+
+        return np.column_stack([-(Cl*C + Q12)/V, np.zeros_like(V), Q12/Vb])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,1]
+        return np.column_stack([dD/V,np.zeros_like(V),np.zeros_like(V)])
+
     def H(self, y):
         Cb = y[2]
 
@@ -1242,6 +1415,17 @@ class PK_MonocompartmentLinkPD(PKPDODEModel):
 
         y[1]=E0*(1+a*Cbb/(math.pow(Cbm,b)+Cbb))
 
+    def Hbatch(self, Y):
+        Cb = Y[:,2]
+
+        E0=self.batchParameters[:,4]
+        a=self.batchParameters[:,5]
+        b=self.batchParameters[:,6]
+        Cbm=self.batchParameters[:,7]
+        Cbb=np.power(Cb,b)
+
+        Y[:,1]=E0*(1+a*Cbb/(np.power(Cbm,b)+Cbb))
+
     def getResponseDimension(self):
         return 2
 
@@ -1311,6 +1495,18 @@ class PK_MonocompartmentPD(PKPDODEModel):
         V=self.parameters[1]
         return np.array([dD/V,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        C = Y[:,0]
+
+        Cl=self.batchParameters[:,0]
+        V=self.batchParameters[:,1]
+
+        return np.column_stack([-Cl*C/V, np.zeros_like(V)])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,1]
+        return np.column_stack([dD/V,np.zeros_like(V)])
+
     def H(self, y):
         C = y[0]
 
@@ -1325,6 +1521,19 @@ class PK_MonocompartmentPD(PKPDODEModel):
         except:
             y[1] = E0
 
+    def Hbatch(self, Y):
+        C = Y[:,0]
+
+        E0=self.batchParameters[:,2]
+        a=self.batchParameters[:,3]
+        b=self.batchParameters[:,4]
+        Cm=self.batchParameters[:,5]
+        with np.errstate(all='ignore'):
+            Cb=np.power(C,b)
+            Cmb=np.power(Cm,b)
+            E = E0*(1+a*Cb/(Cmb+Cb))
+        Y[:,1] = np.where(np.isfinite(E),E,E0)
+
     def getResponseDimension(self):
         return 2
 
@@ -1395,6 +1604,23 @@ class PK_TwocompartmentsUrine(PKPDODEModel):
         V=self.parameters[1]
         return np.array([dD/V,0.0,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        C = Y[:,0]
+        Cp = Y[:,2]
+
+        Cl=self.batchParameters[:,0]
+        V=self.batchParameters[:,1]
+        Clp=self.batchParameters[:,2]
+        Vp=self.batchParameters[:,3]
+        fe=self.batchParameters[:,4]
+        Q12 = Clp * (C-Cp)
+
+        return np.column_stack([-(Cl*C + Q12)/V, fe*Cl*C, Q12/Vp])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,1]
+        return np.column_stack([dD/V,np.zeros_like(V),np.zeros_like(V)])
+
     def getResponseDimension(self):
         return 2
 
@@ -1520,6 +1746,21 @@ class PK_TwocompartmentsBothPD(PKPDODEModel):
         V=self.parameters[1]
         return np.array([dD/V,0.0,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        Cl=self.batchParameters[:,0]
+        V=self.batchParameters[:,1]
+        Clp=self.batchParameters[:,2]
+        Vp=self.batchParameters[:,3]
+        C=Y[:,0]
+        Cp=Y[:,1]
+
+        Q12 = Clp * (C-Cp)
+        return np.column_stack([-(Cl*C + Q12)/V, Q12/Vp, np.zeros_like(V)])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,1]
+        return np.column_stack([dD/V,np.zeros_like(V),np.zeros_like(V)])
+
     def H(self, y):
         Cp = y[1]
 
@@ -1534,6 +1775,18 @@ class PK_TwocompartmentsBothPD(PKPDODEModel):
         except:
             y[2] = E0
 
+    def Hbatch(self, Y):
+        Cp = Y[:,1]
+
+        E0=self.batchParameters[:,4]
+        a=self.batchParameters[:,5]
+        b=self.batchParameters[:,6]
+        Cpm=self.batchParameters[:,7]
+        with np.errstate(all='ignore'):
+            Cpb=np.power(Cp,b)
+            E = E0*(1+a*Cpb/(np.power(Cpm,b)+Cpb))
+        Y[:,2] = np.where(np.isfinite(E),E,E0)
+
     def getResponseDimension(self):
         return 3
 
@@ -1605,6 +1858,42 @@ class PK_Threecompartments(PKPDODEModel):
         V=self.parameters[1]
         return np.array([dD/V,0.0,0.0],np.double)
 
+    def Fbatch(self, t, Y):
+        Cl=self.batchParameters[:,0]
+        V=self.batchParameters[:,1]
+        Clpa=self.batchParameters[:,2]
+        Vpa=self.batchParameters[:,3]
+        Clpb=self.batchParameters[:,4]
+        Vpb=self.batchParameters[:,5]
+        C=Y[:,0]
+        Cpa=Y[:,1]
+        Cpb=Y[:,2]
+
+        Q12a = Clpa * (C-Cpa)
+        Q12b = Clpb * (C-Cpb)
+        return np.column_stack([-(Cl*C + Q12a + Q12b)/V, Q12a/Vpa, Q12b/Vpb])
+
+    def Gbatch(self, t, dD):
+        V=self.batchParameters[:,1]
+        return np.column_stack([dD/V,np.zeros_like(V),np.zeros_like(V)])
+
+    def getLinearSystem(self, parameters):
+        Cl=parameters[:,0]
+        V=parameters[:,1]
+        Clpa=parameters[:,2]
+        Vpa=parameters[:,3]
+        Clpb=parameters[:,4]
+        Vpb=parameters[:,5]
+        A=np.zeros((parameters.shape[0],3,3))
+        A[:,0,0]=-(Cl+Clpa+Clpb)/V
+        A[:,0,1]=Clpa/V
+        A[:,0,2]=Clpb/V
+        A[:,1,0]=Clpa/Vpa
+        A[:,1,1]=-Clpa/Vpa
+        A[:,2,0]=Clpb/Vpb
+        A[:,2,2]=-Clpb/Vpb
+        return A, np.column_stack([1/V,np.zeros_like(V),np.zeros_like(V)])
+
     def getResponseDimension(self):
         return 1
 
@@ -25,7 +25,9 @@
 # **************************************************************************
 
 import copy
+import io
 import sys
+from collections import OrderedDict
 
 from scipion.install.plugin_funcs import PluginInfo
 
@@ -46,7 +48,9 @@ import pyworkflow as pw
 import pyworkflow.utils as pwutils
 from pwem.objects import *
 from .utils import (writeMD5, verifyMD5, excelWriteRow, excelFillCells,
-                    excelAdjustColumnWidths, computeXYmean)
+                    excelAdjustColumnWidths, computeXYmean, expDifference,
+                    writeSidecar, readSidecar, packLists, unpackLists, ForkedPool,
+                    callCapturingOutput, ProgressReporter, parallelMap, latinHypercube)
 from .biopharmaceutics import (PKPDDose, PKPDVia, DrugSource, createDeltaDose,
                                createVia)
 
@@ -174,6 +178,176 @@ class PKPDVariable:
         return "%s [%s]" % (self.varName, self.getUnitsString())
 
 
+class PKPDMeasurementColumn:
+    """ Measurements of a variable in a sample.
+
+    The values are kept in a float64 array and each value has a flag saying whether it is a valid number or a
+    missing (NA, None, MS, ...) or censored (LLOQ, ULOQ) measurement. Only the text of the non numeric tokens is kept,
+    and whether the numbers were written as integers.
+    The column behaves as the list of strings in which the measurements used to be stored: it can be indexed,
+    iterated and appended with strings or numbers."""
+    VALUE_OK = 0
+    VALUE_MISSING = 1
+    VALUE_LLOQ = 2
+    VALUE_ULOQ = 3
+
+    def __init__(self, values=None):
+        self.N = 0
+        self.values = np.zeros(0, np.double)
+        self.flags = np.zeros(0, np.int8)
+        self.integers = np.zeros(0, bool)
+        self.tokens = {}
+        if values is not None:
+            self.extend(values)
+
+    def _reserve(self, N):
+        if N>self.values.size:
+            capacity = max(N, 2*self.values.size, 8)
+            self.values = np.resize(self.values, capacity)
+            self.flags = np.resize(self.flags, capacity)
+            self.integers = np.resize(self.integers, capacity)
+
+    def _set(self, i, value):
+        self.tokens.pop(i, None)
+        flag = PKPDMeasurementColumn.VALUE_OK
+        integer = False
+        if isinstance(value, str):
+            token = value.strip()
+            try:
+                x = float(token)
+                integer = token.lstrip("+-").isdigit()
+            except ValueError:
+                x = np.nan
+                if token.startswith("[") and token.endswith("]"):
+                    try:
+                        x = float(token[1:-1])
+                    except ValueError:
+                        pass
+                if np.isnan(x):
+                    if "LLOQ" in token:
+                        flag = PKPDMeasurementColumn.VALUE_LLOQ
+                    elif token=="ULOQ":
+                        flag = PKPDMeasurementColumn.VALUE_ULOQ
+                    else:
+                        flag = PKPDMeasurementColumn.VALUE_MISSING
+                self.tokens[i] = token
+        elif value is None:
+            x = np.nan
+            flag = PKPDMeasurementColumn.VALUE_MISSING
+            self.tokens[i] = "None"
+        else:
+            x = float(value)
+        self.values[i] = x
+        self.flags[i] = flag
+        self.integers[i] = integer
+
+    def _index(self, i):
+        return range(self.N)[i]
+
+    def append(self, value):
+        self._reserve(self.N+1)
+        self._set(self.N, value)
+        self.N += 1
+
+    def extend(self, values):
+        if isinstance(values, PKPDMeasurementColumn):
+            self._reserve(self.N+values.N)
+            self.values[self.N:self.N+values.N] = values.getValues()
+            self.flags[self.N:self.N+values.N] = values.getFlags()
+            self.integers[self.N:self.N+values.N] = values.integers[0:values.N]
+            for i, token in values.tokens.items():
+                self.tokens[self.N+i] = token
+            self.N += values.N
+        elif isinstance(values, np.ndarray) and values.dtype.kind in "biuf":
+            values = values.ravel()
+            self._reserve(self.N+values.size)
+            self.values[self.N:self.N+values.size] = values
+            self.flags[self.N:self.N+values.size] = PKPDMeasurementColumn.VALUE_OK
+            self.integers[self.N:self.N+values.size] = False
+            self.N += values.size
+        else:
+            for value in values:
+                self.append(value)
+
+    def extendTokens(self, tokens):
+        """ Append a list of strings, all of them are converted to numbers at once if possible """
+        try:
+            values = np.asarray(tokens, dtype=np.double)
+        except ValueError:
+            for token in tokens:
+                self.append(token)
+            return
+        self._reserve(self.N+values.size)
+        self.values[self.N:self.N+values.size] = values
+        self.flags[self.N:self.N+values.size] = PKPDMeasurementColumn.VALUE_OK
+        self.integers[self.N:self.N+values.size] = [token.lstrip("+-").isdigit() for token in tokens]
+        self.N += values.size
+
+    def setArrays(self, values, flags, integers, tokens):
+        """ The column takes the given arrays as they are, tokens is a dictionary with the text of the non numeric
+        measurements """
+        self.N = values.size
+        self.values = values
+        self.flags = flags
+        self.integers = integers
+        self.tokens = tokens
+
+    def getValues(self):
+        """ Float values of the column (NaN for the non numeric measurements) """
+        return self.values[0:self.N]
+
+    def getFlags(self):
+        return self.flags[0:self.N]
+
+    def getMask(self):
+        """ True for the measurements that are valid numbers """
+        return self.flags[0:self.N]==PKPDMeasurementColumn.VALUE_OK
+
+    def getToken(self, i):
+        if i in self.tokens:
+            return self.tokens[i]
+        if self.integers[i]:
+            return "%d"%self.values[i]
+        return str(float(self.values[i]))
+
+    def __len__(self):
+        return self.N
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.getToken(j) for j in self._index(i)]
+        return self.getToken(self._index(i))
+
+    def __setitem__(self, i, value):
+        self._set(self._index(i), value)
+
+    def __iter__(self):
+        for i in range(self.N):
+            yield self.getToken(i)
+
+    def __eq__(self, other):
+        if isinstance(other, (PKPDMeasurementColumn, list)):
+            return list(self)==list(other)
+        return NotImplemented
+
+    def __add__(self, other):
+        return list(self)+list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __copy__(self):
+        return PKPDMeasurementColumn(self)
+
+    def __deepcopy__(self, memo):
+        return PKPDMeasurementColumn(self)
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is not None and np.dtype(dtype).kind not in "fc":
+            return np.array(list(self), dtype=dtype)
+        return np.array(self.getValues(), dtype=dtype)
+
+
 class PKPDSample:
     def __init__(self):
         self.sampleName = ""
@@ -184,6 +358,42 @@ class PKPDSample:
         self.descriptors = None
         self.measurementPattern = None
 
+    def __setattr__(self, name, value):
+        # Measurements are always stored as columns, even if they are assigned as lists
+        if name.startswith("measurement_") and not isinstance(value, PKPDMeasurementColumn):
+            value = PKPDMeasurementColumn(value)
+        self.__dict__[name] = value
+
+    def __getattr__(self, name):
+        # The measurements of a lazily loaded sample are read from the experiment file when first accessed
+        if name.startswith("measurement_") and self.__dict__.get("lazyMeasurements") is not None:
+            self.readMeasurements()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def setLazyMeasurements(self, fnExperiment, offset):
+        """ The measurements are at the given byte offset of the experiment file and will be read on demand """
+        for varName in self.measurementPattern:
+            self.__dict__.pop("measurement_%s"%varName, None)
+        self.lazyMeasurements = (fnExperiment, offset)
+
+    def readMeasurements(self):
+        if self.__dict__.get("lazyMeasurements") is None:
+            return
+        fnExperiment, offset = self.lazyMeasurements
+        self.lazyMeasurements = None
+        for varName in self.measurementPattern:
+            setattr(self,"measurement_%s"%varName,[])
+        lines = []
+        with open(fnExperiment,'rb') as fh:
+            fh.seek(offset)
+            for line in fh:
+                line = line.strip()
+                if line==b"" or line[0:1]==b"[":
+                    break
+                lines.append(line.decode())
+        self.addMeasurements(lines)
+
     def parseTokens(self,tokens,variableDict,doseDict,groupDict):
         # FemaleRat1; dose=Dose1[,Dose2]; weight=207; [group=Group1,Group2]
 
@@ -304,22 +514,36 @@ class PKPDSample:
             if tokens[n]=="NA" or tokens[n]=="ULOQ" or tokens[n]=="LLOQ" or "LLOQ" in tokens[n]:
                 ok = (self.variableDictPtr[varName].role != PKPDVariable.ROLE_TIME)
             if ok:
-                exec("self.measurement_%s.append('%s')"%(varName,tokens[n]))
+                getattr(self,"measurement_%s"%varName).append(tokens[n])
             else:
                 raise Exception("Time measurements cannot be NA")
 
+    def addMeasurements(self,lines):
+        # Much faster than addMeasurement line by line, each column is converted to numbers at once
+        rows = [line.split() for line in lines]
+        rows = [tokens for tokens in rows if tokens]
+        if any(len(tokens)!=len(self.measurementPattern) for tokens in rows):
+            for line in lines:
+                self.addMeasurement(line)
+            return
+        for varName, tokens in zip(self.measurementPattern, zip(*rows)):
+            column = getattr(self,"measurement_%s"%varName)
+            column.extendTokens(tokens)
+            if self.variableDictPtr[varName].role == PKPDVariable.ROLE_TIME:
+                for token in column.tokens.values():
+                    if token=="NA" or token=="ULOQ" or "LLOQ" in token:
+                        raise Exception("Time measurements cannot be NA")
+
     def addMeasurementColumn(self,varName,values):
         if self.measurementPattern is None:
             self.measurementPattern = []
         if not varName in self.measurementPattern:
             self.measurementPattern.append(varName)
-        setattr(self, "measurement_%s"%varName, [])
-        if type(values)==list:
-            for value in values:
-                exec("self.measurement_%s.append('%s')"%(varName,str(float(value))))
-        elif type(values)==np.ndarray:
-            for i in range(values.size):
-                exec("self.measurement_%s.append('%s')"%(varName,str(float(values[i]))))
+        if type(values)==list or type(values)==np.ndarray:
+            values = np.asarray(values, dtype=np.double)
+        else:
+            values = None
+        setattr(self, "measurement_%s"%varName, PKPDMeasurementColumn(values))
 
     def getNumberOfVariables(self):
         return len(self.measurementPattern)
@@ -358,14 +582,9 @@ class PKPDSample:
             patternString += "; %s"%self.measurementPattern[n]
         fh.write("%s %s\n"%(self.sampleName,patternString))
         if len(self.measurementPattern)>0:
-            aux=getattr(self,"measurement_%s"%self.measurementPattern[0])
-            N = len(aux)
+            columns = [getattr(self,"measurement_%s"%varName) for varName in self.measurementPattern]
             for i in range(0,self.getNumberOfMeasurements()):
-                lineString = ""
-                for n in range(0,len(self.measurementPattern)):
-                    aux=getattr(self,"measurement_%s"%self.measurementPattern[n])
-                    lineString += aux[i]+" "
-                fh.write("%s\n"%lineString)
+                fh.write("%s \n"%" ".join([column.getToken(i) for column in columns]))
         fh.write("\n")
 
     def _printMeasurementsToExcel(self,wb,row):
@@ -394,9 +613,8 @@ class PKPDSample:
         if varName not in self.measurementPattern:
             return [None, None]
         else:
-            aux = getattr(self,"measurement_%s"%varName)
-            aux = [x for x in aux if x != "NA" and (not x in "LLOQ") and x!="ULOQ" and x!="None" and x!="MS"]
-            x = np.asarray(aux, dtype=np.double)
+            column = getattr(self,"measurement_%s"%varName)
+            x = column.getValues()[column.getMask()]
             return [x.min(),x.max()]
 
     def getValues(self, varName):
@@ -418,34 +636,19 @@ class PKPDSample:
         setattr(self,"measurement_%s"%varName,varValues)
 
     def getXYValues(self,varNameX,varNameY):
+        # Only the pairs in which both values are valid numbers are returned
         xl = []
         yl = []
         xs = self.getValues(varNameX)
         if type(varNameY)==list:
             ys = self.getValues(varNameY)
-            for ysi in ys:
-                xPartial =[]
-                yPartial = []
-                for x, y in izip(xs, ysi):
-                    if x != "NA" and (not "LLOQ" in x) and y!="ULOQ" and y != "NA" and ("LLOQ" not in y) and y!="ULOQ":
-                        xPartial.append(float(x))
-                        yPartial.append(float(y))
-                xl.append(np.array(xPartial))
-                yl.append(np.array(yPartial))
         else:
-            ys = self.getValues(varNameY)
-            xPartial =[]
-            yPartial = []
-            for x, y in izip(xs, ys):
-                if x != "NA" and x!="LLOQ" and y!="ULOQ" and y != "NA" and y!= "LLOQ" and y!="ULOQ" and \
-                   x!= "None" and x!="MS" and y!="None" and x!="NS" and y!="NS" and \
-                   (not "LLOQ" in x) and (not "LLOQ" in y) and y!="MS" and y!="NRE" and y!="NR":
-                    xPartial.append(float(x))
-                    if "[" in y:
-                        y=y.replace("[","").replace("]","")
-                    yPartial.append(float(y))
-            xl.append(np.array(xPartial))
-            yl.append(np.array(yPartial))
+            ys = [self.getValues(varNameY)]
+        for ysi in ys:
+            N = min(len(xs),len(ysi))
+            valid = xs.getMask()[0:N] & ysi.getMask()[0:N]
+            xl.append(xs.getValues()[0:N][valid])
+            yl.append(ysi.getValues()[0:N][valid])
         return xl, yl
 
     def getSampleMeasurements(self):
@@ -570,20 +773,40 @@ class PKPDExperiment(EMObject):
                              % (len(self.variables), len(self.samples)))
         return self.infoStr.get()
 
-    def load(self, fnExperiment="", verifyIntegrity=True, fullRead=True):
+    def load(self, fnExperiment="", verifyIntegrity=True, fullRead=True, lazy=False, useSidecar=True):
+        """ The file is read as a stream. If lazy, the measurements of each sample are not read until they are
+        accessed for the first time. If useSidecar and the binary sidecar written with the file is still valid,
+        the measurements are taken from it and only the header of the text file is read """
         if fnExperiment!="":
             self.fnPKPD.set(fnExperiment)
         if verifyIntegrity and not verifyMD5(self.fnPKPD.get()):
             raise Exception("The file %s has been modified since its creation"%self.fnPKPD.get())
         if self.fnPKPD.get() is None:
             return
-        fh=open(self.fnPKPD.get(),'r')
+        fh=open(self.fnPKPD.get(),'rb')
         if not fh:
             raise Exception("Cannot open the file "+self.fnPKPD)
 
+        arrays=None
+        if fullRead and useSidecar:
+            arrays=readSidecar(self.fnPKPD.get())
+
         state=None
-        for line in fh.readlines():
+        offset=0
+        measurementLines=[]
+        for line in fh:
+            offset+=len(line)
             line=line.strip()
+            if state==PKPDExperiment.READING_A_MEASUREMENT:
+                # The measurements of a sample are collected and converted together
+                if line!=b"" and line[0:1]!=b"[":
+                    if not lazy:
+                        measurementLines.append(line.decode())
+                    continue
+                if not lazy:
+                    self.samples[samplename].addMeasurements(measurementLines)
+                    measurementLines=[]
+            line=line.decode()
             if line=="":
                 if state==PKPDExperiment.READING_A_MEASUREMENT:
                     state=PKPDExperiment.READING_MEASUREMENTS
@@ -603,7 +826,7 @@ class PKPDExperiment(EMObject):
                 elif section=="[samples]":
                     state=PKPDExperiment.READING_SAMPLES
                 elif section=="[measurements]":
-                    if fullRead:
+                    if fullRead and arrays is None:
                         state=PKPDExperiment.READING_MEASUREMENTS
                     else:
                         break
@@ -672,20 +895,80 @@ class PKPDExperiment(EMObject):
                 samplename = tokens[0].strip()
                 if samplename in self.samples:
                     self.samples[samplename].addMeasurementPattern(tokens)
+                    if lazy:
+                        self.samples[samplename].setLazyMeasurements(self.fnPKPD.get(), offset)
                     state=PKPDExperiment.READING_A_MEASUREMENT
                 else:
                     print("Skipping measurement: %s"%line)
-            elif state==PKPDExperiment.READING_A_MEASUREMENT:
-                self.samples[samplename].addMeasurement(line)
+        if state==PKPDExperiment.READING_A_MEASUREMENT and not lazy:
+            self.samples[samplename].addMeasurements(measurementLines)
 
         fh.close()
-
-    def write(self, fnExperiment, writeToExcel=True):
+        if arrays is not None:
+            self._setMeasurementArrays(arrays)
+
+    def _getMeasurementArrays(self):
+        # All measurement columns concatenated, only those that can be read back from the text file
+        columnSamples = []
+        columnVariables = []
+        columns = []
+        for sampleName in sorted(self.samples.keys()):
+            sample = self.samples[sampleName]
+            if sample.measurementPattern is None or len(sample.measurementPattern)<2:
+                continue
+            N = sample.getNumberOfMeasurements()
+            for varName in sample.measurementPattern:
+                columnSamples.append(sampleName)
+                columnVariables.append(varName)
+                columns.append((getattr(sample,"measurement_%s"%varName), N))
+        columnOffsets = np.cumsum([0]+[N for _, N in columns])
+        tokenIndex = []
+        tokenText = []
+        for (column, N), offset in zip(columns, columnOffsets):
+            for i in sorted(column.tokens.keys()):
+                if i<N:
+                    tokenIndex.append(offset+i)
+                    tokenText.append(column.tokens[i])
+        return {"columnSamples": np.array(columnSamples, dtype=str),
+                "columnVariables": np.array(columnVariables, dtype=str),
+                "columnOffsets": columnOffsets,
+                "values": np.concatenate([np.zeros(0,np.double)]+[column.values[0:N] for column, N in columns]),
+                "flags": np.concatenate([np.zeros(0,np.int8)]+[column.flags[0:N] for column, N in columns]),
+                "integers": np.concatenate([np.zeros(0,bool)]+[column.integers[0:N] for column, N in columns]),
+                "tokenIndex": np.array(tokenIndex, dtype=np.int64),
+                "tokenText": np.array(tokenText, dtype=str)}
+
+    def _setMeasurementArrays(self, arrays):
+        columnOffsets = arrays["columnOffsets"]
+        tokens = [{} for _ in range(len(columnOffsets)-1)]
+        tokenColumns = np.searchsorted(columnOffsets, arrays["tokenIndex"], side="right")-1
+        for n, i, token in zip(tokenColumns.tolist(), arrays["tokenIndex"].tolist(), arrays["tokenText"].tolist()):
+            tokens[n][i-columnOffsets[n]] = token
+        samplesRead = set()
+        for n, (sampleName, varName) in enumerate(zip(arrays["columnSamples"].tolist(),
+                                                      arrays["columnVariables"].tolist())):
+            if not sampleName in self.samples:
+                continue
+            sample = self.samples[sampleName]
+            if not sampleName in samplesRead:
+                sample.measurementPattern = []
+                samplesRead.add(sampleName)
+            sample.measurementPattern.append(varName)
+            i0, iF = columnOffsets[n], columnOffsets[n+1]
+            column = PKPDMeasurementColumn()
+            column.setArrays(arrays["values"][i0:iF], arrays["flags"][i0:iF], arrays["integers"][i0:iF], tokens[n])
+            setattr(sample, "measurement_%s"%varName, column)
+
+    def write(self, fnExperiment, writeToExcel=True, sidecar=True):
+        for sample in self.samples.values():
+            sample.readMeasurements() # The file may be overwritten
         fh=open(fnExperiment,'w')
         self._printToStream(fh)
         fh.close()
         self.fnPKPD.set(fnExperiment)
         writeMD5(fnExperiment)
+        if sidecar:
+            writeSidecar(fnExperiment, self._getMeasurementArrays())
         self.infoStr.set("variables: %d, samples: %d" % (len(self.variables), len(self.samples)))
         if writeToExcel:
             self.writeToExcel(os.path.splitext(fnExperiment)[0]+".xlsx")
@@ -1081,6 +1364,8 @@ class PKPDModelBase(object):
 
 
 class PKPDModelBase2(PKPDModelBase):
+    JACOBIAN_STEP = math.sqrt(np.finfo(np.double).eps) # Relative step of the finite differences, as in leastsq
+
     def __init__(self):
         PKPDModelBase.__init__(self)
         self.bounds = None
@@ -1088,6 +1373,31 @@ class PKPDModelBase2(PKPDModelBase):
     def forwardModel(self, parameters, x=None):
         pass
 
+    def setYPredicted(self, yPredicted):
+        """Set the prediction as if forwardModel had computed it"""
+        self.yPredicted = yPredicted
+
+    def getJacobian(self, parameters, x=None):
+        """
+        Derivative of the prediction with respect to the parameters. Returns a list with one matrix of size
+        len(x[j]) x Nparameters per response dimension, or None if the model cannot provide it (the local
+        optimizer then estimates it by finite differences of the forward model).
+        """
+        return None
+
+    def hasJacobian(self, parameters):
+        """True if getJacobian provides the derivative for these parameters, without computing it"""
+        return False
+
+    def getJacobianByBatch(self, parameters, x=None):
+        # Forward differences (with the steps of MINPACK) of a single batched simulation of the parameters and
+        # their perturbations, it requires a forwardModelBatch(parameters, x) consistent with forwardModel
+        parameters = np.asarray(parameters,np.double)
+        h = self.JACOBIAN_STEP*np.abs(parameters)
+        h[h==0] = self.JACOBIAN_STEP
+        yBatch = self.forwardModelBatch(np.vstack((parameters,parameters+np.diag(h))), x)
+        return [np.transpose(yj[1:]-yj[0])/h for yj in yBatch]
+
     def printSetup(self):
         print("Model: %s"%self.getModelEquation())
         print("Variables: "+str(self.getParameterNames()))
@@ -1177,11 +1487,23 @@ class PKPDModel(PKPDModelBase2):
 
 
 class PKPDODEModel(PKPDModelBase2):
+    INTEGRATOR_RK4 = 0
+    INTEGRATOR_RK45 = 1
+    INTEGRATOR_LSODA = 2
+    INTEGRATOR_NAMES = {INTEGRATOR_RK4: 'Runge-Kutta 4 (fixed step)',
+                        INTEGRATOR_RK45: 'Runge-Kutta 4(5) (adaptive step)',
+                        INTEGRATOR_LSODA: 'LSODA (adaptive step, stiff systems)'}
+
     def __init__(self):
         PKPDModelBase2.__init__(self)
         self.t0 = None # (min)
         self.tF = None # (min)
         self.deltaT = 0.25 # (min)
+        self.integrator = PKPDODEModel.INTEGRATOR_RK4
+        self.rtol = 1e-6 # Relative and absolute tolerances of the adaptive integrators
+        self.atol = 1e-12
+        self.analytic = False # Use the closed form solution of linear models if the drug input allows it
+        self.Nfev = 0 # Number of evaluations of F
         self.drugSource = None
         self.drugSourceImpulse = None
         self.tFImpulse = None
@@ -1213,6 +1535,10 @@ class PKPDODEModel(PKPDModelBase2):
         return 0
 
     def imposeConstraints(self, yt):
+        """
+        Make the state physically meaningful (non negative amounts) in place. yt is an array of any shape whose last
+        axis is the state: a single state vector, a batch of them or a whole trajectory.
+        """
         if type(yt)==np.ndarray:
             yt[yt<0]=0
         elif type(yt)==np.float64:
@@ -1222,13 +1548,254 @@ class PKPDODEModel(PKPDModelBase2):
     def H(self, y):
         pass
 
+    # Batched versions of F, G and H. The state Y is a matrix of size Nbatch x stateDim and the parameters of each
+    # row are the rows of self.batchParameters. The default implementations evaluate F, G and H row by row,
+    # models should override them with vectorized versions
+    def Fbatch(self, t, Y):
+        return self._evaluateByRows(lambda b, y: self.F(t, y), Y)
+
+    def Gbatch(self, t, dD):
+        if np.isscalar(dD):
+            return self._evaluateByRows(lambda b, y: self.G(t, dD), None)
+        else:
+            return self._evaluateByRows(lambda b, y: self.G(t, dD[b]), None)
+
+    def Hbatch(self, Y):
+        if type(self).H is PKPDODEModel.H or self.getStateDimension()==1:
+            return
+        parameters = self.parameters
+        for b in range(Y.shape[0]):
+            self.parameters = self.batchParameters[b]
+            self.H(Y[b]) # Y[b] is a view, H modifies it in place
+        self.parameters = parameters
+
+    def _evaluateByRows(self, function, Y):
+        parameters = self.parameters
+        Nbatch = self.batchParameters.shape[0]
+        stateDim = self.getStateDimension()
+        retval = np.zeros((Nbatch,stateDim),np.double)
+        for b in range(Nbatch):
+            self.parameters = self.batchParameters[b]
+            if Y is None:
+                y = None
+            elif stateDim>1:
+                y = Y[b]
+            else:
+                y = Y[b,0]
+            retval[b] = function(b, y)
+        self.parameters = parameters
+        return retval
+
     def getResponseDimension(self):
         return None
 
     def getStateDimension(self):
         return None
 
+    def getLinearSystem(self, parameters):
+        """
+        Linear models, dy/dt = A*y + b*dD/dt, return A (Nbatch x stateDim x stateDim) and b (Nbatch x stateDim)
+        for the parameter vectors in the rows of parameters. Nonlinear models return None.
+        """
+        return None
+
+    def linearResponse(self, parameters, t, drugSource):
+        """
+        Closed form response at the times t (sorted) of a linear model for the parameter vectors in the rows of
+        parameters. The response to each dose is computed on the eigenvectors of A and superimposed.
+        Returns an array Nbatch x len(t) x stateDim, or None if the model or the drug input have no closed form.
+        """
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            system = self.getLinearSystem(parameters)
+        if system is None:
+            return None
+        inputs = drugSource.getLinearInputs()
+        if inputs is None:
+            return None
+        A, b = system
+        if not np.all(np.isfinite(A)) or not np.all(np.isfinite(b)):
+            return None
+        try:
+            lambdas, V = np.linalg.eig(A)
+            if np.iscomplexobj(lambdas):
+                if np.max(np.abs(lambdas.imag))>0:
+                    return None
+                lambdas = lambdas.real
+                V = V.real
+            if np.max(np.linalg.cond(V))>1e10:
+                return None # A is (almost) not diagonalizable
+            c = np.linalg.solve(V,b[:,:,np.newaxis])[:,:,0]
+        except np.linalg.LinAlgError:
+            return None
+
+        # Response of each mode, Nbatch x len(t) x stateDim
+        L = lambdas[:,np.newaxis,:]
+        tau = np.asarray(t,np.double)[np.newaxis,:,np.newaxis]
+        Z = np.zeros((A.shape[0],tau.shape[1],A.shape[1]),np.double)
+        with np.errstate(over='ignore', invalid='ignore'):
+            for inputType, tStart, amount, extra in inputs:
+                if tStart<self.t0:
+                    return None
+                tauDose = np.maximum(tau-tStart,0.0)
+                if inputType == PKPDDose.INPUT_IMPULSE:
+                    Z += np.where(tau>=tStart,amount*np.exp(L*tauDose),0.0)
+                elif inputType == PKPDDose.INPUT_CONSTANT_RATE:
+                    tauOn = np.minimum(tauDose,max(extra-tStart,0.0))
+                    Z += amount*np.exp(L*(tauDose-tauOn))*expDifference(L,0.0,tauOn)
+                elif inputType == PKPDDose.INPUT_FIRST_ORDER:
+                    Z += amount*extra*expDifference(L,-extra,tauDose)
+        return np.einsum('bij,btj->bti',V,Z*c[:,np.newaxis,:])
+
+    def _analyticTimes(self, x):
+        # Times at which the closed form solution is evaluated and position of each x in them
+        Xt = np.unique(np.clip(np.concatenate([np.atleast_1d(np.asarray(xj,np.double)) for xj in x]+[[self.tF]]),
+                               self.t0,self.tF))
+        idxList = [np.searchsorted(Xt,np.clip(np.asarray(xj,np.double),self.t0,self.tF)) for xj in x]
+        return Xt, idxList
+
+    def forwardModelAnalytic(self, parameters, x=None, drugSource=None):
+        """
+        Evaluate the response at x with the closed form solution of the model (see linearResponse).
+        Returns None if the model or the drug input have no closed form.
+        """
+        if drugSource is None:
+            drugSource=self.drugSource
+        if x is None:
+            x = self.x
+        Xt, idxList = self._analyticTimes(x)
+        Yt = self.linearResponse(np.atleast_2d(np.asarray(parameters,np.double)),Xt,drugSource)
+        if Yt is None:
+            return None
+        self.parameters = parameters
+        self.imposeConstraints(Yt)
+        self.yPredicted = [Yt[0,idxList[j],j] for j in range(0,self.getResponseDimension())]
+        return self.yPredicted
+
+    def forwardModelBatch(self, parameters, x=None, drugSource=None, sourceParameters=None):
+        """
+        Simulate the system response for many parameter vectors at once.
+
+        parameters is a matrix of size Nbatch x Nparameters, one parameter vector per row. If sourceParameters
+        (Nbatch x NparametersSource) is given, the drug source is evaluated with the parameters of each row (the
+        drug source keeps the parameters of the last row). Otherwise, all rows share the drug input.
+        Returns a list with one matrix of size Nbatch x len(x[j]) per response dimension.
+        """
+        self.batchParameters = np.atleast_2d(np.asarray(parameters,np.double))
+        Nbatch = self.batchParameters.shape[0]
+        stateDim = self.getStateDimension()
+        if drugSource is None:
+            drugSource=self.drugSource
+        if x is None:
+            x = self.x
+
+        if self.analytic:
+            Xt, idxList = self._analyticTimes(x)
+            if sourceParameters is None:
+                Yt = self.linearResponse(self.batchParameters,Xt,drugSource)
+            else:
+                sourceParameters = np.atleast_2d(np.asarray(sourceParameters,np.double))
+                Yt = []
+                for b in range(Nbatch):
+                    drugSource.setParameters(sourceParameters[b])
+                    Ytb = self.linearResponse(self.batchParameters[b:b+1],Xt,drugSource)
+                    if Ytb is None:
+                        Yt = None
+                        break
+                    Yt.append(Ytb)
+                if Yt is not None:
+                    Yt = np.concatenate(Yt)
+            if Yt is not None:
+                self.imposeConstraints(Yt)
+                self.yPredictedBatch = [Yt[:,idxList[j],j] for j in range(0,self.getResponseDimension())]
+                return self.yPredictedBatch
+
+        Nsamples = int(math.ceil((self.tF-self.t0)/self.deltaT))+1
+        Xt = self.t0 + np.arange(0,Nsamples)*self.deltaT
+        delta_2 = 0.5*self.deltaT
+        K = self.deltaT/3
+
+        # Drug input at each time step
+        if sourceParameters is None:
+            dD1t, dDt = drugSource.getAmountReleasedTable(self.t0,self.deltaT,Nsamples)
+        else:
+            sourceParameters = np.atleast_2d(np.asarray(sourceParameters,np.double))
+            dD1t = np.zeros((Nsamples,Nbatch),np.double)
+            dDt = np.zeros((Nsamples,Nbatch),np.double)
+            for b in range(Nbatch):
+                drugSource.setParameters(sourceParameters[b])
+                dD1t[:,b], dDt[:,b] = drugSource.getAmountReleasedTable(self.t0,self.deltaT,Nsamples)
+
+        # Linear interpolation weights of the output points, only the samples involved are kept
+        idxList = []
+        for j in range(0,self.getResponseDimension()):
+            u = np.clip((np.asarray(x[j],np.double)-self.t0)/self.deltaT,0,Nsamples-1)
+            i0 = np.minimum(np.floor(u).astype(int),max(Nsamples-2,0))
+            i1 = np.minimum(i0+1,Nsamples-1)
+            idxList.append((i0,i1,u-i0))
+        keep = np.unique(np.concatenate([np.concatenate((i0,i1)) for i0, i1, _ in idxList]))
+        position = np.full(Nsamples,-1,int)
+        position[keep] = np.arange(keep.size)
+
+        # Simulate the system response
+        yt = np.zeros((Nbatch,stateDim),np.double)
+        Yt = np.zeros((keep.size,Nbatch,stateDim),np.double)
+        for i in range(0,Nsamples):
+            t = Xt[i]
+
+            # Same Runge Kutta scheme as in forwardModel
+            k1 = self.Fbatch(t,yt)
+            dyD1 = self.Gbatch(t,dD1t[i])
+            t_delta_2=t+delta_2
+            k2 = self.Fbatch(t_delta_2,yt+k1*delta_2+dyD1)
+            k3 = self.Fbatch(t_delta_2,yt+k2*delta_2+dyD1)
+            dyD = self.Gbatch(t,dDt[i])
+            k4 = self.Fbatch(t+self.deltaT,yt+k3*self.deltaT+dyD)
+            yt += (0.5*(k1+k4)+k2+k3)*K+dyD
+
+            self.imposeConstraints(yt)
+            self.Hbatch(yt)
+
+            if position[i]>=0:
+                Yt[position[i]]=yt
+        self.Nfev += 4*Nsamples*Nbatch
+
+        # Get the values at x
+        self.yPredictedBatch = []
+        for j in range(0,self.getResponseDimension()):
+            i0, i1, w = idxList[j]
+            self.yPredictedBatch.append(Yt[position[i0],:,j].T*(1-w)+Yt[position[i1],:,j].T*w)
+        return self.yPredictedBatch
+
+    def hasClosedFormSolution(self, parameters, drugSource=None):
+        """True if forwardModel and forwardModelBatch use the closed form solution for these parameters"""
+        if drugSource is None:
+            drugSource=self.drugSource
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            return self.analytic and drugSource.getLinearInputs() is not None and \
+                   self.getLinearSystem(np.atleast_2d(np.asarray(parameters,np.double))) is not None
+
+    def hasJacobian(self, parameters):
+        return self.hasClosedFormSolution(parameters)
+
+    def getJacobian(self, parameters, x=None):
+        """
+        With the closed form solution, the perturbed parameter vectors are evaluated together with the current one
+        in a single batch (see forwardModelBatch). The numerical integrators are left to the finite differences of
+        the optimizer, for the usual number of parameters a batched Runge-Kutta is slower than one simulation per
+        parameter.
+        """
+        if not self.hasClosedFormSolution(parameters):
+            return None
+        return self.getJacobianByBatch(parameters, x)
+
     def forwardModel(self, parameters, x=None, drugSource=None):
+        if self.analytic:
+            yPredicted = self.forwardModelAnalytic(parameters, x, drugSource)
+            if yPredicted is not None:
+                return yPredicted
+        if self.integrator!=PKPDODEModel.INTEGRATOR_RK4:
+            return self.forwardModelAdaptive(parameters, x, drugSource)
+
         self.parameters = parameters
         if drugSource is None:
             drugSource=self.drugSource
@@ -1245,6 +1812,7 @@ class PKPDODEModel(PKPDModelBase2):
         Xt = np.zeros(Yt.shape[0])
         delta_2 = 0.5*self.deltaT
         K = self.deltaT/3
+        dD1t, dDt = drugSource.getAmountReleasedTable(self.t0,self.deltaT,Nsamples)
         for i in range(0,Nsamples):
             t = self.t0 + i*self.deltaT # More accurate than t+= self.deltaT
             Xt[i]=t
@@ -1252,7 +1820,7 @@ class PKPDODEModel(PKPDModelBase2):
             # Internal evolution
             # Runge Kutta's 4th order (http://lpsa.swarthmore.edu/NumInt/NumIntFourth.html)
             k1 = self.F(t,yt)
-            dD1 = drugSource.getAmountReleasedAt(t,delta_2)
+            dD1 = dD1t[i]
             dyD1 = self.G(t, dD1)
             y1 = yt+k1*delta_2+dyD1
             # print("t=",t," y0=",yt," k1=",k1," dD1=",dD1," dyD1=",dyD1," y1=",y1)
@@ -1262,7 +1830,7 @@ class PKPDODEModel(PKPDModelBase2):
             y2 = yt+k2*delta_2+dyD1
             # print("k2=",k2," y2=",y2)
 
-            dD = drugSource.getAmountReleasedAt(t,self.deltaT)
+            dD = dDt[i]
             dyD = self.G(t, dD)
             k3 = self.F(t_delta_2,y2)
             y3 = yt+k3*self.deltaT+dyD
@@ -1277,8 +1845,13 @@ class PKPDODEModel(PKPDModelBase2):
             # print("yt=",yt)
             # print(" ")
 
-            # Make sure it makes sense
-            self.imposeConstraints(yt)
+            # Make sure it makes sense (a scalar state is constrained as a 1-element array, as in forwardModelBatch)
+            if self.getStateDimension()>1:
+                self.imposeConstraints(yt)
+            else:
+                ytArray = np.atleast_1d(np.asarray(yt,np.double))
+                self.imposeConstraints(ytArray)
+                yt = ytArray[0]
 
             # Apply measurement transformation
             self.H(yt)
@@ -1291,6 +1864,7 @@ class PKPDODEModel(PKPDModelBase2):
                 Yt[i,:]=yt
             else:
                 Yt[i]=yt
+        self.Nfev += 4*Nsamples
 
         # Get the values at x
         if x is None:
@@ -1304,6 +1878,77 @@ class PKPDODEModel(PKPDModelBase2):
                 self.yPredicted.append(np.interp(x[j],Xt,Yt[:,j]))
         return self.yPredicted
 
+    def forwardModelAdaptive(self, parameters, x=None, drugSource=None):
+        """
+        Simulate the system response with an adaptive step integrator (scipy's solve_ivp) and evaluate it at x.
+        Intravenous boluses are discontinuities of the state, the rest of the drug input enters as a release rate.
+        """
+        from scipy.integrate import solve_ivp
+        self.parameters = parameters
+        if drugSource is None:
+            drugSource=self.drugSource
+        if x is None:
+            x = self.x
+        if self.integrator==PKPDODEModel.INTEGRATOR_LSODA:
+            method = "LSODA"
+        else:
+            method = "RK45"
+        stateDim = self.getStateDimension()
+
+        def dydt(t, y):
+            if stateDim==1:
+                y = y[0]
+            return np.atleast_1d(self.F(t,y)+self.G(t,drugSource.getReleaseRateAt(t)))
+
+        # Output times
+        Xt = np.unique(np.clip(np.concatenate([np.atleast_1d(xj) for xj in x]+[[self.tF]]),self.t0,self.tF))
+        Yt = np.zeros((Xt.size,stateDim),np.double)
+
+        # Integrate between consecutive discontinuities of the input
+        impulses = drugSource.getImpulsiveDoses()
+        tBreak = [t for t in drugSource.getInputBreakpoints() if self.t0<t and t<self.tF]
+        tBreak = [self.t0]+sorted(set(tBreak))+[self.tF]
+        yt = np.zeros(stateDim,np.double)
+        for n in range(len(tBreak)-1):
+            ta = tBreak[n]
+            tb = tBreak[n+1]
+            for tImpulse, amount in impulses:
+                if tImpulse==ta:
+                    yt += np.atleast_1d(self.G(ta,amount))
+            if n==len(tBreak)-2:
+                idx = np.logical_and(Xt>=ta,Xt<=tb)
+            else:
+                idx = np.logical_and(Xt>=ta,Xt<tb)
+            Nidx = np.sum(idx)
+            if tb<=ta:
+                Yt[idx,:]=yt
+                continue
+            tEval = Xt[idx]
+            if Nidx==0 or tEval[-1]<tb:
+                tEval = np.append(tEval,tb)
+            if not np.all(np.isfinite(dydt(ta,yt))):
+                Yt[Xt>=ta,:]=np.nan # Invalid parameters, e.g., null volume
+                break
+            sol = solve_ivp(dydt,(ta,tb),yt,method=method,t_eval=tEval,rtol=self.rtol,atol=self.atol)
+            self.Nfev += sol.nfev
+            if sol.status<0:
+                print("The integration of the ODE failed: "+sol.message)
+                Yt[Xt>=ta,:]=np.nan
+                break
+            Yt[idx,:] = sol.y[:,0:Nidx].T
+            yt = sol.y[:,-1]
+
+        # Make sure it makes sense and apply measurement transformation
+        self.imposeConstraints(Yt)
+        if type(self).H is not PKPDODEModel.H:
+            for i in range(Xt.size):
+                self.H(Yt[i])
+
+        self.yPredicted = []
+        for j in range(0,self.getResponseDimension()):
+            self.yPredicted.append(np.interp(x[j],Xt,Yt[:,j]))
+        return self.yPredicted
+
     def getImpulseResponse(self, parameters, tImpulse):
         if self.tFImpulse is None:
             self.tFImpulse = self.tF
@@ -1322,14 +1967,10 @@ class PKPDODEModel(PKPDModelBase2):
 
         # Simulate the system response
         Nsamples = int(math.ceil(self.tF/self.deltaT))+1
-        Xt = np.zeros(Nsamples)
+        Xt = np.arange(0,Nsamples)*self.deltaT
 
         # Get the drug input
-        D = copy.copy(Xt)
-        for i in range(0,Nsamples):
-            t = i*self.deltaT # More accurate than t+= self.deltaT
-            Xt[i]=t
-            D[i]=self.drugSource.getAmountReleasedAt(t,self.deltaT)
+        _, D = self.drugSource.getAmountReleasedTable(0.0,self.deltaT,Nsamples)
 
         # Get the model impulse response
         if self.thImpulse is None:
@@ -1354,11 +1995,16 @@ class PKPDODEModel(PKPDModelBase2):
 
 
 class PKPDOptimizer:
+    FORWARD_CACHE_SIZE = 64 # Number of predictions kept by forwardModel
+
     def __init__(self,model,fitType,goalFunction="RMSE"):
         self.model = model
         self.fitType = fitType
         self.Nevaluations = 0
         self.bestRmse=1e38
+        self.forwardCache = OrderedDict()
+        self.cacheHits = 0
+        self.cacheMisses = 0
 
         self.yTarget = [np.array(yi, dtype=np.float32) for yi in model.y]
         self.yTargetLogs = [np.log10(yi) for yi in self.yTarget]
@@ -1381,7 +2027,9 @@ class PKPDOptimizer:
         else:
             raise Exception("Unknown goal function")
 
-        self.verbose = 1
+        # 0 (quiet), 1 (results and the best RMSE at most every few seconds), 2 (every improvement with its residuals)
+        self.verbose = ProgressReporter.PROGRESS
+        self.reporter = ProgressReporter()
 
     def inBounds(self,parameters):
         if self.bounds==None or len(self.bounds)!=len(parameters):
@@ -1401,18 +2049,39 @@ class PKPDOptimizer:
                 allDiffs = np.concatenate([allDiffs, diff])
         return allDiffs
 
-    def getResiduals(self,parameters):
-        if not self.inBounds(parameters):
-            return self.hugeError()
+    def forwardModel(self, parameters):
+        """
+        Prediction of the model for these parameters. The last FORWARD_CACHE_SIZE predictions are kept, the same
+        parameter vector is usually evaluated several times at the end of an optimization (goal, covariance,
+        quality and printing). A cached prediction is also set back in the model (see setYPredicted). The key also
+        includes the x of the model, some protocols evaluate the optimum on other data (e.g., the bootstrap).
+        """
+        x = self.model.x if type(self.model.x)==list else [self.model.x]
+        key = np.asarray(parameters,np.double).tobytes()+b"".join([np.asarray(xj,np.double).tobytes() for xj in x])
+        if key in self.forwardCache:
+            self.forwardCache.move_to_end(key)
+            self.cacheHits += 1
+            self.model.setYPredicted(copy.deepcopy(self.forwardCache[key]))
+            return copy.deepcopy(self.forwardCache[key])
+        self.cacheMisses += 1
         yPredicted = self.model.forwardModel(parameters)
+        self.forwardCache[key] = copy.deepcopy(yPredicted)
+        if len(self.forwardCache)>self.FORWARD_CACHE_SIZE:
+            self.forwardCache.popitem(last=False)
+        return yPredicted
+
+    def printCacheStatistics(self):
+        print("Cached predictions: %d hits, %d misses"%(self.cacheHits,self.cacheMisses))
 
+    def residualsFromPrediction(self, yPredicted):
+        # Residuals of the prediction, None if it is so bad that it should not be considered
         allDiffs = None
         for y, yTarget, yTargetLog in izip(yPredicted,self.yTarget,self.yTargetLogs):
             if self.takeYLogs:
                 diff = np.full(yTarget.shape,np.nan)
                 idx = np.logical_and(np.isfinite(y),y>=1e-20)
                 if np.sum(idx)<0.8*diff.size:
-                    return self.hugeError()
+                    return None
                 diff[idx] = yTargetLog[idx]-np.log10(y[idx])
             else:
                 diff = yTarget - y
@@ -1426,26 +2095,72 @@ class PKPDOptimizer:
 
         idx = np.logical_not(np.isfinite(allDiffs))
         allDiffs[idx]=np.nan
-        e = allDiffs
-        if e.size<parameters.size:
+        return allDiffs
+
+    def getResiduals(self,parameters):
+        if not self.inBounds(parameters):
+            return self.hugeError()
+        e = self.residualsFromPrediction(self.forwardModel(parameters))
+        if e is None or e.size<parameters.size:
             return self.hugeError()
 
         rmse = math.sqrt(np.nanmean(np.power(e,2)))
         if rmse<self.bestRmse:
-            print("   Best rmse so far=%f"%rmse)
-            print("      at x=%s"%str(parameters))
-            print("      e=%s"%str(e))
-            # print("      yTarget=%s"%str(yTarget))
-            # print("      yTargetLog=%s"%str(yTargetLog))
-            # print("      y=%s"%str(y))
-            sys.stdout.flush()
             self.bestRmse=rmse
+            self.reportBest(rmse, parameters)
+            self.reporter.debug(self.verbose, "      e=%s", e)
         elif self.Nevaluations%100==0:
-            print("   Neval=%d RMSE=%f"%(self.Nevaluations,rmse))
-            sys.stdout.flush()
+            self.reporter.progress(self.verbose, "   Neval=%d RMSE=%f (best %f)", self.Nevaluations, rmse,
+                                   self.bestRmse)
         self.Nevaluations+=1
         return e
 
+    def reportBest(self, rmse, parameters):
+        self.reporter.progress(self.verbose, "   Best rmse so far=%f\n      at x=%s", rmse, parameters)
+
+    def getJacobian(self,parameters):
+        """
+        Jacobian of the residuals (Nresiduals x Nparameters) from the derivative of the prediction supplied by the
+        model (see PKPDModelBase2.getJacobian). If the model cannot supply it, it is estimated by forward
+        differences of the residuals.
+        """
+        parameters = np.asarray(parameters,np.double)
+        dyList = None
+        if self.inBounds(parameters):
+            dyList = self.model.getJacobian(parameters)
+        if dyList is None:
+            return self.getJacobianByDifferences(parameters)
+        yPredicted = self.forwardModel(parameters)
+
+        allJ = []
+        for y, dy, yTarget in izip(yPredicted,dyList,self.yTarget):
+            y = np.asarray(y,np.double)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if self.takeYLogs:
+                    J = -dy/(math.log(10)*y[:,np.newaxis])
+                    J[np.logical_not(np.logical_and(np.isfinite(y),y>=1e-20))] = 0
+                else:
+                    J = -dy
+                if self.takeRelative:
+                    J = J/yTarget[:,np.newaxis]
+            allJ.append(J)
+        J = np.concatenate(allJ)
+        J[np.logical_not(np.isfinite(J))] = 0
+        return J
+
+    def getJacobianByDifferences(self,parameters):
+        # Same forward differences as leastsq when it is not given the Jacobian
+        e0 = self.getResiduals(parameters)
+        J = np.zeros((e0.size,parameters.size))
+        for k in range(parameters.size):
+            h = PKPDModelBase2.JACOBIAN_STEP*abs(parameters[k])
+            if h==0:
+                h = PKPDModelBase2.JACOBIAN_STEP
+            parametersk = np.copy(parameters)
+            parametersk[k] += h
+            J[:,k] = (self.getResiduals(parametersk)-e0)/h
+        return J
+
     def goalRMSE(self,parameters):
         e = self.getResiduals(parameters)
         rmse = math.sqrt(np.nanmean(np.power(e,2)))
@@ -1511,7 +2226,7 @@ class PKPDOptimizer:
         print("------------------------")
 
     def evaluateQuality(self):
-        yPredicted=self.model.forwardModel(self.model.parameters)
+        yPredicted=self.forwardModel(self.model.parameters)
         x = copy.copy(self.model.x)
         y = copy.copy(self.model.y)
         if self.fitType=="linear" or self.fitType=="relative":
@@ -1541,7 +2256,7 @@ class PKPDOptimizer:
         self._evaluateQuality(x,y,yp)
 
     def printFitting(self):
-        yPredicted = self.model.forwardModel(self.model.parameters)
+        yPredicted = self.forwardModel(self.model.parameters)
         print("==========================================")
         print("X     Y    Ypredicted  Error=Y-Ypredicted ")
         print("==========================================")
@@ -1572,11 +2287,26 @@ class PKPDOptimizer:
 
 
 class PKPDDEOptimizer(PKPDOptimizer):
-    def optimize(self):
+    def optimize(self, popsize=15, maxiter=30, seed=None, Nprocesses=1, updating=None):
+        """
+        popsize, maxiter, seed and updating are those of scipy's differential_evolution. With Nprocesses>1, the
+        population of each generation is evaluated in parallel and it is updated once per generation
+        (updating='deferred'), so that for a given seed the result does not depend on the number of processes.
+        """
         from scipy.optimize import differential_evolution
         if self.verbose>0:
             print("Optimizing with Differential Evolution (DE), a global optimizer")
-        self.optimum = differential_evolution(self.goalFunction, self.model.getBounds(), maxiter=30)
+        if Nprocesses>1:
+            if self.verbose>0:
+                print("The population is evaluated with %d processes"%Nprocesses)
+            with ForkedPool(self._goalInProcess, Nprocesses) as pool:
+                self.optimum = differential_evolution(self.goalFunction, self.model.getBounds(), maxiter=maxiter,
+                                                      popsize=popsize, seed=seed, updating='deferred',
+                                                      workers=lambda goal, population: self._mapGoal(pool, population))
+        else:
+            self.optimum = differential_evolution(self.goalFunction, self.model.getBounds(), maxiter=maxiter,
+                                                  popsize=popsize, seed=seed,
+                                                  updating='immediate' if updating is None else updating)
         if self.verbose>0:
             print("Best DE function value: "+str(self.optimum.fun))
             print("Best DE parameters: "+str(self.optimum.x))
@@ -1584,9 +2314,83 @@ class PKPDDEOptimizer(PKPDOptimizer):
         if self.verbose>0:
             print(self.model.getEquation())
             self.printFitting()
+            self.printCacheStatistics()
             print(" ")
         return self.optimum
 
+    def _goalInProcess(self, parameters):
+        # Executed in a forked process, the progress is reported by the main process
+        _, goal = callCapturingOutput(self.goalFunction, parameters)
+        return goal
+
+    def _mapGoal(self, pool, population):
+        goals = pool.map([(parameters,) for parameters in population])
+        self.Nevaluations += len(goals)
+        i = int(np.argmin(goals))
+        if goals[i]<self.bestRmse:
+            self.bestRmse = goals[i]
+            self.reportBest(goals[i], population[i])
+        return goals
+
+
+class PKPDMultiStartOptimizer(PKPDOptimizer):
+    def optimize(self, Nstarts=10, seed=None, Nprocesses=1):
+        """
+        Local optimizations (least squares) from Nstarts initial points sampled in the bounding box by a latin
+        hypercube, the best optimum is kept. The local optimizations are run with Nprocesses processes.
+        """
+        from scipy.optimize import OptimizeResult
+        if self.verbose>0:
+            print("Optimizing with Least Squares from %d starting points (multi-start), a global optimizer"%Nstarts)
+        starts = latinHypercube(self.model.getBounds(), Nstarts, np.random.RandomState(seed))
+        if Nprocesses>1:
+            if self.verbose>0:
+                print("The starting points are optimized with %d processes"%Nprocesses)
+            # The logs of the processes are discarded, the results are reported below
+            results = [result for _, result in parallelMap(self._localSearch, [(x0,) for x0 in starts], Nprocesses,
+                                                           captureOutput=True)]
+            self.Nevaluations += sum([nfev for _, _, nfev in results])
+        else:
+            results = [self._localSearch(x0) for x0 in starts]
+
+        best = None
+        for n, (x, goal, _) in enumerate(results):
+            if self.verbose>0:
+                if x is None:
+                    print("   Start %d: failed"%n)
+                else:
+                    print("   Start %d: rmse=%f at x=%s"%(n,goal,str(x)))
+            if x is not None and (best is None or goal<results[best][1]):
+                best = n
+        if best is None:
+            raise Exception("The local optimization failed from all the starting points")
+        self.optimum = OptimizeResult(x=results[best][0], fun=results[best][1], nfev=self.Nevaluations)
+        if self.verbose>0:
+            print("Best multi-start function value: "+str(self.optimum.fun))
+            print("Best multi-start parameters: "+str(self.optimum.x))
+        self.model.setParameters(self.optimum.x)
+        if self.verbose>0:
+            print(self.model.getEquation())
+            self.printFitting()
+            self.printCacheStatistics()
+            print(" ")
+        return self.optimum
+
+    def _localSearch(self, x0):
+        # Optimum, goal and number of evaluations of the local optimization from x0, (None, inf, n) if it fails
+        from scipy.optimize import leastsq
+        Nevaluations = self.Nevaluations
+        try:
+            Dfun = None
+            if self.model.hasJacobian(x0):
+                Dfun = self.getJacobian
+            x = leastsq(self.getResiduals, x0, Dfun=Dfun)[0]
+            return x, self.goalFunction(x), self.Nevaluations-Nevaluations
+        except Exception as e:
+            if self.verbose>0:
+                print("   The local optimization from %s failed: %s"%(str(x0),str(e)))
+            return None, np.inf, self.Nevaluations-Nevaluations
+
 
 class PKPDLSOptimizer(PKPDOptimizer):
     def optimize(self, ftol=1.49012e-8, xtol=1.49012e-8): # Same values as in minpack.py
@@ -1594,29 +2398,31 @@ class PKPDLSOptimizer(PKPDOptimizer):
         if self.verbose>0:
             print("Optimizing with Least Squares (LS), a local optimizer")
             print("Initial parameters: "+str(self.model.parameters))
-        self.optimum, J, self.info, mesg, _ = leastsq(self.getResiduals, self.model.parameters, full_output=True,
-                                                      ftol=ftol, xtol=xtol)
+        Dfun = None
+        if self.model.hasJacobian(np.asarray(self.model.parameters,np.double)):
+            Dfun = self.getJacobian # Otherwise leastsq takes its own finite differences
+        self.optimum, J, self.info, mesg, _ = leastsq(self.getResiduals, self.model.parameters, Dfun=Dfun,
+                                                      full_output=True, ftol=ftol, xtol=xtol)
             # J is the jacobian C=MSE*inv(J'*J)
+        self.cov_x = None
+        if J is not None:
+            e = self.getResiduals(self.optimum)
+            JtJ=np.matmul(np.transpose(J),J)
+            if np.linalg.det(JtJ)>1e-6:
+                self.cov_x = np.var(e)*np.linalg.inv(JtJ)
         if self.verbose>0:
             print("Best LS function value: "+str(self.goalFunction(self.optimum)))
             print("Best LS parameters: "+str(self.optimum))
             print("Covariance matrix:")
-            if J is not None:
-                e = self.getResiduals(self.optimum)
-                JtJ=np.matmul(np.transpose(J),J)
-                if np.linalg.det(JtJ)>1e-6:
-                    self.cov_x = np.var(e)*np.linalg.inv(JtJ)
-                    print(np.array_str(self.cov_x,max_line_width=120))
-                else:
-                    self.cov_x = None
-                    print("Singular Jacobian, we cannot estimate the covariance")
+            if self.cov_x is not None:
+                print(np.array_str(self.cov_x,max_line_width=120))
             else:
-                self.cov_x = None
                 print("Singular Jacobian, we cannot estimate the covariance")
         self.model.setParameters(self.optimum)
         if self.verbose>0:
             print(self.model.getEquation())
             self.printFitting()
+            self.printCacheStatistics()
             print(" ")
         return self.optimum
 
@@ -1855,6 +2661,54 @@ class PKPDSampleFit:
                     self.yl.append(tokens[0])
                     self.yu.append(tokens[1])
 
+    @classmethod
+    def packSampleFits(cls, sampleFits):
+        """ Arrays with the content of a list of sample fits, the inverse of unpackSampleFits """
+        series = {}
+        for key in ["x", "y", "yp", "yl", "yu"]:
+            seriesList = []
+            for sampleFit in sampleFits:
+                values = getattr(sampleFit, key) or []
+                seriesList += values if sampleFit.multiOutputSeries else [values]
+            series[key] = seriesList
+        arrays = {"sampleNames": np.array([sampleFit.sampleName for sampleFit in sampleFits], dtype=str),
+                  "modelEquations": np.array([sampleFit.modelEquation for sampleFit in sampleFits], dtype=str),
+                  "quality": np.array([[sampleFit.R2, sampleFit.R2adj, sampleFit.AIC, sampleFit.AICc, sampleFit.BIC]
+                                       for sampleFit in sampleFits], dtype=np.double).reshape(-1,5),
+                  "multiOutputSeries": np.array([sampleFit.multiOutputSeries for sampleFit in sampleFits], dtype=bool),
+                  "seriesOffsets": np.cumsum([0]+[len(sampleFit.x or []) if sampleFit.multiOutputSeries else 1
+                                                  for sampleFit in sampleFits])}
+        for key, dtype in [("parameters", np.double), ("lowerBound", str), ("upperBound", str),
+                           ("significance", str)]:
+            arrays[key], arrays[key+"Offsets"] = packLists([getattr(sampleFit, key) or [] for sampleFit in sampleFits],
+                                                           dtype)
+        for key, dtype in [("x", np.double), ("y", np.double), ("yp", np.double), ("yl", str), ("yu", str)]:
+            arrays[key], arrays[key+"Offsets"] = packLists(series[key], dtype)
+        return arrays
+
+    @classmethod
+    def unpackSampleFits(cls, arrays):
+        sampleFits = []
+        values = {}
+        for key in ["parameters", "lowerBound", "upperBound", "significance", "x", "y", "yp", "yl", "yu"]:
+            values[key] = unpackLists(arrays[key], arrays[key+"Offsets"])
+        seriesOffsets = arrays["seriesOffsets"]
+        for n, (sampleName, modelEquation, quality, multiOutputSeries) in \
+                enumerate(zip(arrays["sampleNames"].tolist(), arrays["modelEquations"].tolist(),
+                              arrays["quality"].tolist(), arrays["multiOutputSeries"].tolist())):
+            sampleFit = cls()
+            sampleFit.sampleName = sampleName
+            sampleFit.modelEquation = modelEquation
+            sampleFit.R2, sampleFit.R2adj, sampleFit.AIC, sampleFit.AICc, sampleFit.BIC = quality
+            for key in ["parameters", "lowerBound", "upperBound", "significance"]:
+                setattr(sampleFit, key, values[key][n])
+            sampleFit.multiOutputSeries = multiOutputSeries
+            for key in ["x", "y", "yp", "yl", "yu"]:
+                series = values[key][seriesOffsets[n]:seriesOffsets[n+1]]
+                setattr(sampleFit, key, series if multiOutputSeries else series[0])
+            sampleFits.append(sampleFit)
+        return sampleFits
+
     def copyFromOptimizer(self,optimizer):
         self.R2 = optimizer.R2
         self.R2adj = optimizer.R2adj
@@ -1978,6 +2832,43 @@ class PKPDSampleFitBootstrap:
 
             self.state = PKPDSampleFitBootstrap.READING_SAMPLEFITTINGS_XB
 
+    @classmethod
+    def packSampleFits(cls, sampleFits):
+        """ Arrays with the content of a list of sample fits, the inverse of unpackSampleFits """
+        Nparameters = max([0]+[sampleFit.parameters.shape[1] for sampleFit in sampleFits
+                               if sampleFit.parameters is not None])
+        arrays = {"sampleNames": np.array([sampleFit.sampleName for sampleFit in sampleFits], dtype=str),
+                  "parameters": np.vstack([np.empty((0,Nparameters),np.double)]+
+                                          [sampleFit.parameters for sampleFit in sampleFits
+                                           if sampleFit.parameters is not None])}
+        arrays["quality"], arrays["replicateOffsets"] = packLists(
+            [list(zip(sampleFit.R2, sampleFit.R2adj, sampleFit.AIC, sampleFit.AICc, sampleFit.BIC))
+             for sampleFit in sampleFits], np.double)
+        arrays["quality"] = arrays["quality"].reshape(-1,5)
+        arrays["xB"], _ = packLists([sampleFit.xB for sampleFit in sampleFits], str)
+        arrays["yB"], _ = packLists([sampleFit.yB for sampleFit in sampleFits], str)
+        return arrays
+
+    @classmethod
+    def unpackSampleFits(cls, arrays):
+        sampleFits = []
+        replicateOffsets = arrays["replicateOffsets"]
+        xB = unpackLists(arrays["xB"], replicateOffsets)
+        yB = unpackLists(arrays["yB"], replicateOffsets)
+        for n, sampleName in enumerate(arrays["sampleNames"].tolist()):
+            i0, iF = replicateOffsets[n], replicateOffsets[n+1]
+            sampleFit = cls()
+            sampleFit.sampleName = sampleName
+            if iF>i0:
+                sampleFit.parameters = arrays["parameters"][i0:iF,:]
+            quality = arrays["quality"][i0:iF,:].T.tolist()
+            if quality:
+                sampleFit.R2, sampleFit.R2adj, sampleFit.AIC, sampleFit.AICc, sampleFit.BIC = quality
+            sampleFit.xB = xB[n]
+            sampleFit.yB = yB[n]
+            sampleFits.append(sampleFit)
+        return sampleFits
+
     def copyFromOptimizer(self,optimizer):
         self.R2.append(optimizer.R2)
         self.R2adj.append(optimizer.R2adj)
@@ -1985,6 +2876,23 @@ class PKPDSampleFitBootstrap:
         self.AICc.append(optimizer.AICc)
         self.BIC.append(optimizer.BIC)
 
+    def allocateReplicates(self, Nbootstrap, Nparameters):
+        self.parameters = np.zeros((Nbootstrap,Nparameters),np.double)
+        self.xB = [None]*Nbootstrap
+        self.yB = [None]*Nbootstrap
+        self.R2 = [None]*Nbootstrap
+        self.R2adj = [None]*Nbootstrap
+        self.AIC = [None]*Nbootstrap
+        self.AICc = [None]*Nbootstrap
+        self.BIC = [None]*Nbootstrap
+
+    def setReplicate(self, n, parameters, xB, yB, quality):
+        # Replicates may be computed in any order, quality is (R2, R2adj, AIC, AICc, BIC)
+        self.parameters[n,:] = parameters
+        self.xB[n] = xB
+        self.yB[n] = yB
+        self.R2[n], self.R2adj[n], self.AIC[n], self.AICc[n], self.BIC[n] = quality
+
 
 class PKPDFitting(EMObject):
     READING_FITTING_EXPERIMENT = 1
@@ -2018,12 +2926,24 @@ class PKPDFitting(EMObject):
             return False
         return self.fnFitting.get().endswith("bootstrapPopulation.pkpd")
 
-    def write(self, fnFitting, writeToExcel=True):
-        fh=open(fnFitting,'w')
+    def write(self, fnFitting, writeToExcel=True, sidecar=True):
+        # The text is printed once, the sidecar is parsed from the same text
+        fh = io.StringIO()
         self._printToStream(fh)
-        fh.close()
+        fhFile=open(fnFitting,'w')
+        fhFile.write(fh.getvalue())
+        fhFile.close()
         self.fnFitting.set(fnFitting)
         writeMD5(fnFitting)
+        if sidecar:
+            # The sample fits are stored as they are read from the text file, that has rounded numbers
+            fh.seek(0)
+            for line in fh:
+                if line.startswith("[SAMPLE FITTINGS]"):
+                    break
+            arrays = eval(self.sampleFittingClass).packSampleFits(self._readSampleFits(fh))
+            arrays["sampleFittingClass"] = np.array(self.sampleFittingClass)
+            writeSidecar(fnFitting, arrays)
 
         if writeToExcel:
             self.writeToExcel(os.path.splitext(fnFitting)[0] + ".xlsx")
@@ -2140,7 +3060,9 @@ class PKPDFitting(EMObject):
         excelAdjustColumnWidths(wb)
         wb.save(fnXls)
 
-    def load(self, fnFitting=None):
+    def load(self, fnFitting=None, useSidecar=True):
+        """ If useSidecar and the binary sidecar written with the file is still valid, the sample fittings are
+        taken from it and only the header of the text file is read """
         fnFitting = str(fnFitting or self.fnFitting)
         fh = open(fnFitting)
         if not fh:
@@ -2149,12 +3071,16 @@ class PKPDFitting(EMObject):
             raise Exception("The file %s has been modified since its creation" % fnFitting)
         self.fnFitting.set(fnFitting)
 
+        arrays = None
+        if useSidecar:
+            arrays = readSidecar(fnFitting)
+            if arrays is not None and str(arrays["sampleFittingClass"])!=self.sampleFittingClass:
+                arrays = None
+
         auxUnit = PKPDUnit()
-        for line in fh.readlines():
+        for line in fh:
             line=line.strip()
             if line=="":
-                if state==PKPDFitting.READING_SAMPLEFITTINGS_CONTINUE:
-                     state=PKPDFitting.READING_SAMPLEFITTINGS_BEGIN
                 continue
             if line.startswith('[') and line.endswith('='):
                 section = line.split('=')[0].strip().lower()
@@ -2165,7 +3091,11 @@ class PKPDFitting(EMObject):
                     state=PKPDFitting.READING_POPULATION_HEADER
                     self.summaryLines.append(line)
                 elif section=="[sample fittings]":
-                    state=PKPDFitting.READING_SAMPLEFITTINGS_BEGIN
+                    if arrays is not None:
+                        self.sampleFits += eval(self.sampleFittingClass).unpackSampleFits(arrays)
+                    else:
+                        self.sampleFits += self._readSampleFits(fh)
+                    break
                 else:
                     print("Skipping: ",line)
 
@@ -2222,17 +3152,26 @@ class PKPDFitting(EMObject):
             elif state==PKPDFitting.READING_POPULATION:
                 self.summaryLines.append(line)
 
+        fh.close()
+
+    def _readSampleFits(self, fh):
+        """ Sample fittings in the lines of the [SAMPLE FITTINGS] section, one block per sample separated by
+        blank lines """
+        sampleFits = []
+        state = PKPDFitting.READING_SAMPLEFITTINGS_BEGIN
+        for line in fh:
+            line=line.strip()
+            if line=="":
+                state=PKPDFitting.READING_SAMPLEFITTINGS_BEGIN
             elif state==PKPDFitting.READING_SAMPLEFITTINGS_BEGIN:
                 newSampleFit = eval("%s()"%self.sampleFittingClass)
-                self.sampleFits.append(newSampleFit)
-                self.sampleFits[-1].restartReadingState()
-                self.sampleFits[-1].readFromLine(line)
+                sampleFits.append(newSampleFit)
+                sampleFits[-1].restartReadingState()
+                sampleFits[-1].readFromLine(line)
                 state = PKPDFitting.READING_SAMPLEFITTINGS_CONTINUE
-
-            elif state==PKPDFitting.READING_SAMPLEFITTINGS_CONTINUE:
-                self.sampleFits[-1].readFromLine(line)
-
-        fh.close()
+            else:
+                sampleFits[-1].readFromLine(line)
+        return sampleFits
 
     def getSampleFit(self, sampleName):
         for sampleFit in self.sampleFits:
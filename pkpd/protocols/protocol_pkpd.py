@@ -32,6 +32,7 @@ import os
 from pwem.protocols import *
 from pkpd.objects import PKPDExperiment, PKPDFitting
 import pyworkflow.protocol.params as params
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
 
 class ProtPKPD(EMProtocol):
     def printSection(self, msg):
@@ -39,9 +40,9 @@ class ProtPKPD(EMProtocol):
         print("Section: %s"%msg)
         print("**********************************************************************************************")
 
-    def readExperiment(self,fnIn, show=True, fullRead=True):
+    def readExperiment(self,fnIn, show=True, fullRead=True, lazy=False):
         experiment = PKPDExperiment()
-        experiment.load(fnIn,fullRead=fullRead)
+        experiment.load(fnIn,fullRead=fullRead,lazy=lazy)
         if show:
             self.printSection("Reading %s"%fnIn)
             experiment._printToStream(sys.stdout)
@@ -88,6 +89,73 @@ class ProtPKPD(EMProtocol):
         """
         self.setExperiment(self.loadInputExperiment())
 
+    def _defineParamsGlobalSearch(self, form, condition="", seedHelp="", parallel=False):
+        """ Method, options and random seed of the global search. If the global search is optional, condition is
+        the condition under which it is performed (e.g., 'globalSearch'). If parallel, the number of processes of
+        the global search is also defined (numberOfProcesses) """
+        def conditionArgs(methodCondition=""):
+            fullCondition = " and ".join([token for token in [condition, methodCondition] if token])
+            return {'condition': fullCondition} if fullCondition else {}
+
+        form.addParam('globalSearchMethod', params.EnumParam, choices=["Differential evolution","Multi-start"],
+                      label="Global search method", default=0, expertLevel=LEVEL_ADVANCED,
+                      help='Differential evolution: a population of parameter vectors evolves within the bounding '
+                           'box.\nMulti-start: local optimizations from a few starting points spread over the bounding '
+                           'box (latin hypercube), the best one is kept. It is usually much cheaper for models that '
+                           'converge from most starting points.',
+                      **conditionArgs())
+        form.addParam('populationSize', params.IntParam, label="Global search population", default=15,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='The global search (differential evolution) evolves a population of this number of '
+                           'parameter vectors per parameter. Larger populations explore the bounding box better, '
+                           'the cost of the global search is proportional to it.',
+                      **conditionArgs('globalSearchMethod==0'))
+        form.addParam('maxIterations', params.IntParam, label="Global search iterations", default=30,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Maximum number of generations of the global search',
+                      **conditionArgs('globalSearchMethod==0'))
+        form.addParam('numberOfStarts', params.IntParam, label="Multi-start points", default=10,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Number of starting points of the multi-start search',
+                      **conditionArgs('globalSearchMethod==1'))
+        form.addParam('seed', params.IntParam, label="Random seed", default=-1, expertLevel=LEVEL_ADVANCED,
+                      help='Seed of the random generator of the global search, the same seed produces the same fit. '
+                           +seedHelp+'If it is -1, a random seed is used.',
+                      **conditionArgs())
+        if parallel:
+            form.addParam('numberOfProcesses', params.IntParam, label="Parallel processes", default=1,
+                          expertLevel=LEVEL_ADVANCED,
+                          help='The population of the differential evolution (or the local optimizations of the '
+                               'multi-start search) is evaluated with these processes. With more than one process, '
+                               'the population is updated once per generation, and the fit is the same for any '
+                               'number of processes above 1.',
+                          **conditionArgs())
+
+    def _defineParamsBootstrapParallel(self, form):
+        """ Random seed and number of processes of the bootstrap protocols """
+        form.addParam('seed', params.IntParam, label="Random seed", default=-1, expertLevel=LEVEL_ADVANCED,
+                      help='Seed of the random generator of the bootstrap samples, the same seed produces the same '
+                           'bootstrap samples for any number of processes. If it is -1, a random seed is used.')
+        form.addParam('numberOfProcesses', params.IntParam, label="Parallel processes", default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Number of bootstrap samples fitted simultaneously, each one in a separate process')
+
+    def _defineParamsOptimizerLog(self, form):
+        form.addParam('optimizerLog', params.EnumParam, choices=["Quiet","Progress","Debug"], label="Optimizer log",
+                      default=1, expertLevel=LEVEL_ADVANCED,
+                      help='Quiet: the optimizers do not report anything. Progress: the results of each optimizer and '
+                           'the best cost found so far, at most every few seconds. Debug: every improvement of the '
+                           'cost with its parameters and residuals, the log may be very large.')
+
+    def getGlobalSearchSeed(self):
+        """ Seed of the global search, None for a random one """
+        if hasattr(self,"seed") and self.seed.get()>=0:
+            return self.seed.get()
+        return None
+
+    def getOptimizerVerbosity(self):
+        return self.optimizerLog.get() if hasattr(self,"optimizerLog") else 1
+
 def addDoseToForm(form):
     form.addParam('doses', params.TextParam, height=5, width=70, label="Doses", default="",
                   help="Structure: [Dose Name] ; [via=ViaName] ; [doseType] ; [time description] ; [dose description]\n"\
@@ -27,15 +27,14 @@
 import math
 import numpy as np
 import openpyxl
-import random
 from scipy.interpolate import InterpolatedUnivariateSpline
 
 import pyworkflow.protocol.params as params
-from pkpd.objects import PKPDExperiment, PKPDDose, PKPDSample, PKPDVariable
+from pkpd.objects import PKPDExperiment, PKPDDose, PKPDSample, PKPDVariable, PKPDODEModel
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from .protocol_pkpd_ode_base import ProtPKPDODEBase
 from pkpd.pkpd_units import createUnit, multiplyUnits, divideUnits, strUnit, PKPDUnit, unitFromString
-from pkpd.utils import find_nearest, excelWriteRow
+from pkpd.utils import find_nearest, excelWriteRow, excelAppendRows
 from pkpd.biopharmaceutics import PKPDVia
 from pkpd.models.pk_models import PK_Monocompartment, PK_Twocompartments, PK_TwocompartmentsClintCl
 
@@ -72,6 +71,9 @@ class ProtPKPDODESimulate(ProtPKPDODEBase):
     PKTYPE_COMP2 = 1
     PKTYPE_COMP2CLCLINT = 2
 
+    # Number of simulations integrated together
+    BATCH_SIZE = 1000
+
     #--------------------------- DEFINE param functions --------------------------------------------
     def _defineParams(self, form):
         form.addSection('Input')
@@ -204,17 +206,15 @@ class ProtPKPDODESimulate(ProtPKPDODEBase):
         newSample.descriptors["Tmin"] = self.Tmin
         self.outputExperiment.samples[sampleName] = newSample
 
-    def NCA(self, t, C):
-        AUClist = []
-        AUMClist = []
-        Cminlist = []
-        Cavglist = []
-        Cmaxlist = []
-        Ctaulist = []
-        Tmaxlist = []
-        Tminlist = []
-        Ttaulist = []
+    def NCABatch(self, t, C):
+        """ NCA of many profiles at once. C is a matrix with one profile per row, sampled at the times t.
+        It returns the list of dose periods (idx0, idxF) and the AUC, AUMC, Cmin, Cavg, Cmax, Ctau, Tmax, Tmin and
+        Ttau of each period as matrices of size Ndoses x Nprofiles"""
+        t = np.asarray(t, np.double)
+        C = np.atleast_2d(np.asarray(C, np.double))
         Ndoses=len(self.drugSource.parsedDoseList)
+        periods = []
+        results = [[] for k in range(9)]
         for ndose in range(0,max(Ndoses,1)):
             tperiod0 = self.drugSource.parsedDoseList[ndose].t0
             if ndose+1<Ndoses:
@@ -225,46 +225,57 @@ class ProtPKPDODESimulate(ProtPKPDODEBase):
             idxF = find_nearest(t,tperiodF)
             if idxF>=len(t)-1:
                 idxF=len(t)-2
+            periods.append((idx0,idxF))
 
-            AUC0t = 0
-            AUMC0t = 0
             t0 = t[idx0+1]
-            for idx in range(idx0,idxF+1):
-                dt = (t[idx+1]-t[idx])
-                if C[idx+1]>=C[idx]: # Trapezoidal in the raise
-                    AUC0t  += 0.5*dt*(C[idx]+C[idx+1])
-                    AUMC0t += 0.5*dt*(C[idx]*t[idx]+C[idx+1]*t[idx+1])
-                else: # Log-trapezoidal in the decay
-                    decrement = C[idx]/C[idx+1]
-                    K = math.log(decrement)
-                    B = K/dt
-                    AUC0t  += dt*(C[idx]-C[idx+1])/K
-                    AUMC0t += (C[idx]*(t[idx]-tperiod0)-C[idx+1]*(t[idx+1]-tperiod0))/B-(C[idx+1]-C[idx])/(B*B)
-
-                if idx==idx0:
-                    Cmax=C[idx]
-                    Tmax=t[idx]-t0
-                    Cmin=C[idx]
-                    Tmin=t[idx]-t0
-                else:
-                    if C[idx]<Cmin:
-                        Cmin=C[idx]
-                        Tmin=t[idx]-t0
-                    elif C[idx]>Cmax:
-                        Cmax=C[idx]
-                        Tmax=t[idx]-t0
-                        # if ndose==0:
-                        #     Cmin=C[idx]
-                        #     Tmin=t[idx]-t0
-            AUClist.append(AUC0t)
-            AUMClist.append(AUMC0t)
-            Cminlist.append(Cmin)
-            Cmaxlist.append(Cmax)
-            Ctaulist.append(C[idxF])
-            Ttaulist.append(t[idxF]-t0)
-            Tmaxlist.append(Tmax)
-            Tminlist.append(Tmin)
-            Cavglist.append(AUC0t/(t[idxF]-t[idx0]))
+            ti = t[idx0:idxF+1]
+            ti1 = t[idx0+1:idxF+2]
+            Ci = C[:,idx0:idxF+1]
+            Ci1 = C[:,idx0+1:idxF+2]
+            dt = ti1-ti
+            raising = Ci1>=Ci
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                # Trapezoidal in the raise, log-trapezoidal in the decay
+                K = np.log(np.where(raising, 1.0, Ci/Ci1))
+                B = K/dt
+                AUC = np.where(raising, 0.5*dt*(Ci+Ci1), dt*(Ci-Ci1)/K)
+                AUMC = np.where(raising, 0.5*dt*(Ci*ti+Ci1*ti1),
+                                (Ci*(ti-tperiod0)-Ci1*(ti1-tperiod0))/B-(Ci1-Ci)/(B*B))
+            AUC0t = np.sum(AUC,axis=1)
+            idxMin = np.argmin(Ci,axis=1)
+            idxMax = np.argmax(Ci,axis=1)
+            results[0].append(AUC0t)
+            results[1].append(np.sum(AUMC,axis=1))
+            results[2].append(Ci[np.arange(C.shape[0]),idxMin])
+            results[3].append(AUC0t/(t[idxF]-t[idx0]))
+            results[4].append(Ci[np.arange(C.shape[0]),idxMax])
+            results[5].append(C[:,idxF])
+            results[6].append(ti[idxMax]-t0)
+            results[7].append(ti[idxMin]-t0)
+            results[8].append(np.full(C.shape[0],t[idxF]-t0))
+        return [periods]+[np.asarray(result) for result in results]
+
+    def setNCAValues(self, ncaList, n=0):
+        """ Keep the NCA of the last dose of the n-th profile analyzed by NCABatch """
+        _, AUClist, AUMClist, Cminlist, Cavglist, Cmaxlist, Ctaulist, Tmaxlist, Tminlist, Ttaulist = ncaList
+        self.AUC0t = float(AUClist[-1,n])
+        self.AUMC0t = float(AUMClist[-1,n])
+        self.MRT = self.AUMC0t/self.AUC0t
+        self.Cmin = float(Cminlist[-1,n])
+        self.Cmax = float(Cmaxlist[-1,n])
+        self.Tmin = float(Tminlist[-1,n])
+        self.Tmax = float(Tmaxlist[-1,n])
+        self.Cavg = float(Cavglist[-1,n])
+        self.Ctau = float(Ctaulist[-1,n])
+        self.Ttau = float(Ttaulist[-1,n])
+        self.fluctuation = self.Cmax/self.Cmin if self.Cmin>0 else np.nan
+        self.percentageAccumulation = Cavglist[-1,n]/Cavglist[0,n] if Cavglist[0,n]>0 else np.nan
+
+    def NCA(self, t, C):
+        ncaList = self.NCABatch(t, np.reshape(C,(1,-1)))
+        periods = ncaList[0]
+        AUClist, AUMClist, Cminlist, Cavglist, Cmaxlist, Ctaulist, Tmaxlist, Tminlist, Ttaulist = \
+            [result[:,0] for result in ncaList[1:]]
 
         print("Fluctuation = Cmax/Cmin")
         print("Accumulation(1) = Cavg(n)/Cavg(1) %")
@@ -279,6 +290,7 @@ class ProtPKPDODESimulate(ProtPKPDODEBase):
                 accumn = Cavglist[ndose]/Cavglist[ndose-1]
             else:
                 accumn = 0
+            idx0, idxF = periods[ndose]
             print("Dose #%d t=[%f,%f]: Cavg= %f [%s] Cmin= %f [%s] Tmin= %d [%s] Cmax= %f [%s] Tmax= %d [%s] Ctau= %f [%s] Ttau= %d [%s] Fluct= %f %% Accum(1)= %f %% Accum(n)= %f %% SSFrac(n)= %f %% AUC= %f [%s] AUMC= %f [%s]"%\
                   (ndose+1,t[idx0],t[idxF],Cavglist[ndose], strUnit(self.Cunits.unit), Cminlist[ndose],
                    strUnit(self.Cunits.unit), int(Tminlist[ndose]), strUnit(self.outputExperiment.getTimeUnits().unit),
@@ -290,18 +302,7 @@ class ProtPKPDODESimulate(ProtPKPDODEBase):
                    AUClist[ndose],strUnit(self.AUCunits),
                    AUMClist[ndose],strUnit(self.AUMCunits)))
 
-        self.AUC0t = float(AUClist[-1])
-        self.AUMC0t = float(AUMClist[-1])
-        self.MRT = self.AUMC0t/self.AUC0t
-        self.Cmin = float(Cminlist[-1])
-        self.Cmax = float(Cmaxlist[-1])
-        self.Tmin = float(Tminlist[-1])
-        self.Tmax = float(Tmaxlist[-1])
-        self.Cavg = float(Cavglist[-1])
-        self.Ctau = float(Ctaulist[-1])
-        self.Ttau = float(Ttaulist[-1])
-        self.fluctuation = self.Cmax/self.Cmin if self.Cmin>0 else np.nan
-        self.percentageAccumulation = Cavglist[-1]/Cavglist[0] if Cavglist[0]>0 else np.nan
+        self.setNCAValues(ncaList)
 
         print("   AUC0t=%f [%s]"%(self.AUC0t,strUnit(self.AUCunits)))
         print("   AUMC0t=%f [%s]"%(self.AUMC0t,strUnit(self.AUMCunits)))
@@ -315,6 +316,25 @@ class ProtPKPDODESimulate(ProtPKPDODEBase):
         print("   Ttau=%f [%s]"%(self.Ttau,strUnit(self.outputExperiment.getTimeUnits().unit)))
         return AUClist, AUMClist, Cminlist, Cavglist, Cmaxlist, Ctaulist, Tmaxlist, Tminlist, Ttaulist
 
+    def simulateBatch(self, parameters, x):
+        """ Simulate the response of each parameter vector (one per row). It returns a matrix of size
+        Nsimulations x len(x) x responseDimension"""
+        responseDim = self.getResponseDimension()
+        simulationsY = np.zeros((parameters.shape[0],len(x),responseDim))
+        if self.model.integrator==PKPDODEModel.INTEGRATOR_RK4:
+            for i0 in range(0,parameters.shape[0],self.BATCH_SIZE):
+                yBatch = self.forwardModelBatch(parameters[i0:i0+self.BATCH_SIZE], [x]*responseDim)
+                for j in range(responseDim):
+                    simulationsY[i0:i0+self.BATCH_SIZE,:,j] = yBatch[j]
+        else:
+            # Adaptive integrators simulate one parameter vector at a time
+            for i in range(0,parameters.shape[0]):
+                y = self.forwardModel(parameters[i], [x]*responseDim)
+                for j in range(responseDim):
+                    simulationsY[i,:,j] = y[j]
+        self.setParameters(parameters[-1])
+        return simulationsY
+
     def runSimulate(self, Nsimulations, confidenceInterval, doses):
         if self.odeSource.get()==self.SRC_ODE:
             self.protODE = self.inputODE.get()
@@ -414,6 +434,10 @@ class ProtPKPDODESimulate(ProtPKPDODEBase):
             self.model = self.protODE.createModel()
             if hasattr(self.protODE, "deltaT"):
                 self.model.deltaT = self.protODE.deltaT.get()
+            if hasattr(self.protODE, "integrator"):
+                self.model.integrator = self.protODE.integrator.get()
+            if hasattr(self.protODE, "analytic"):
+                self.model.analytic = self.protODE.analytic.get()
         else:
             if self.pkType.get() == self.PKTYPE_COMP1:
                 self.model = PK_Monocompartment()
@@ -442,202 +466,170 @@ class ProtPKPDODESimulate(ProtPKPDODEBase):
         # Dunits = self.outputExperiment.doses[dosename].dunits
         # Cunits = self.experiment.variables[self.varNameY].units
 
-        # Process user parameters
+        # Process user parameters, one parameter vector per row
         if self.odeSource.get()==self.SRC_ODE:
             if self.paramsSource==ProtPKPDODESimulate.PRM_POPULATION:
+                # Take all the parameters randomly from the population at once
                 Nsimulations = self.Nsimulations.get()
+                populationParameters = np.vstack([sampleFit.parameters for sampleFit in self.fitting.sampleFits])
+                Nrows = np.asarray([sampleFit.parameters.shape[0] for sampleFit in self.fitting.sampleFits])
+                firstRow = np.cumsum(Nrows)-Nrows
+                nfit = np.random.randint(0,len(self.fitting.sampleFits),Nsimulations)
+                nprm = np.floor(np.random.uniform(0,1,Nsimulations)*Nrows[nfit]).astype(int)
+                simulationParameters = populationParameters[firstRow[nfit]+nprm,:]
+                fromSamples = ["Population %d"%n for n in nprm]
             elif self.paramsSource == ProtPKPDODESimulate.PRM_USER_DEFINED:
                 lines = self.prmUser.get().strip().replace('\n',';;').split(';;')
-                Nsimulations = len(lines)
-                prmUser = []
-                for line in lines:
-                    tokens = line.strip().split(',')
-                    prmUser.append([float(token) for token in tokens])
+                simulationParameters = np.asarray([[float(token) for token in line.strip().split(',')]
+                                                   for line in lines], np.double)
+                fromSamples = ["User defined"]*len(lines)
             elif self.paramsSource == ProtPKPDODESimulate.PRM_FITTING:
-                Nsimulations = len(self.fitting.sampleFits)
+                simulationParameters = np.asarray([sampleFit.parameters for sampleFit in self.fitting.sampleFits],
+                                                  np.double)
+                fromSamples = [sampleFit.sampleName for sampleFit in self.fitting.sampleFits]
             else:
                 self.inputExperiment = self.readExperiment(self.inputExperiment.get().fnPKPD)
-                Nsimulations = len(self.inputExperiment.samples)
-                inputSampleNames = [x for x in self.inputExperiment.samples.keys()]
+                fromSamples = [x for x in self.inputExperiment.samples.keys()]
+                simulationParameters = np.asarray([[float(self.inputExperiment.samples[sampleName].getDescriptorValue(prmName))
+                                                    for prmName in self.fitting.modelParameters]
+                                                   for sampleName in fromSamples], np.double)
         else:
             lines = self.prmUser.get().strip().replace('\n', ';;').split(';;')
-            Nsimulations = len(lines)
-            prmUser = []
-            for line in lines:
-                tokens = line.strip().split(',')
-                prmUser.append([float(token) for token in tokens])
+            viaParameters = [float(token) for token in viaPrmList[:-2]]
+            simulationParameters = np.asarray([viaParameters+[float(token) for token in line.strip().split(',')]
+                                               for line in lines], np.double)
+            fromSamples = ["User defined"]*len(lines)
+        Nsimulations = simulationParameters.shape[0]
 
-        # Simulate the different responses
+        # Create AUC, AUMC, MRT variables and units
+        if type(self.varNameY)!=list:
+            self.Cunits = self.outputExperiment.variables[self.varNameY].units
+        else:
+            self.Cunits = self.outputExperiment.variables[self.varNameY[0]].units
+        self.AUCunits = multiplyUnits(tvar.units.unit, self.Cunits.unit)
+        self.AUMCunits = multiplyUnits(tvar.units.unit, self.AUCunits)
+
+        if self.addStats or self.addIndividuals:
+            fromvar = PKPDVariable()
+            fromvar.varName = "FromSample"
+            fromvar.varType = PKPDVariable.TYPE_TEXT
+            fromvar.role = PKPDVariable.ROLE_LABEL
+            fromvar.units = createUnit("none")
+
+            AUCvar = PKPDVariable()
+            AUCvar.varName = "AUC0t"
+            AUCvar.varType = PKPDVariable.TYPE_NUMERIC
+            AUCvar.role = PKPDVariable.ROLE_LABEL
+            AUCvar.units = createUnit(strUnit(self.AUCunits))
+
+            AUMCvar = PKPDVariable()
+            AUMCvar.varName = "AUMC0t"
+            AUMCvar.varType = PKPDVariable.TYPE_NUMERIC
+            AUMCvar.role = PKPDVariable.ROLE_LABEL
+            AUMCvar.units = createUnit(strUnit(self.AUMCunits))
+
+            MRTvar = PKPDVariable()
+            MRTvar.varName = "MRT"
+            MRTvar.varType = PKPDVariable.TYPE_NUMERIC
+            MRTvar.role = PKPDVariable.ROLE_LABEL
+            MRTvar.units = createUnit(self.outputExperiment.getTimeUnits().unit)
+
+            Cmaxvar = PKPDVariable()
+            Cmaxvar.varName = "Cmax"
+            Cmaxvar.varType = PKPDVariable.TYPE_NUMERIC
+            Cmaxvar.role = PKPDVariable.ROLE_LABEL
+            Cmaxvar.units = createUnit(strUnit(self.Cunits.unit))
+
+            Tmaxvar = PKPDVariable()
+            Tmaxvar.varName = "Tmax"
+            Tmaxvar.varType = PKPDVariable.TYPE_NUMERIC
+            Tmaxvar.role = PKPDVariable.ROLE_LABEL
+            Tmaxvar.units = createUnit(self.outputExperiment.getTimeUnits().unit)
+
+            Cminvar = PKPDVariable()
+            Cminvar.varName = "Cmin"
+            Cminvar.varType = PKPDVariable.TYPE_NUMERIC
+            Cminvar.role = PKPDVariable.ROLE_LABEL
+            Cminvar.units = createUnit(strUnit(self.Cunits.unit))
+
+            Tminvar = PKPDVariable()
+            Tminvar.varName = "Tmin"
+            Tminvar.varType = PKPDVariable.TYPE_NUMERIC
+            Tminvar.role = PKPDVariable.ROLE_LABEL
+            Tminvar.units = createUnit(self.outputExperiment.getTimeUnits().unit)
+
+            Cavgvar = PKPDVariable()
+            Cavgvar.varName = "Cavg"
+            Cavgvar.varType = PKPDVariable.TYPE_NUMERIC
+            Cavgvar.role = PKPDVariable.ROLE_LABEL
+            Cavgvar.units = createUnit(strUnit(self.Cunits.unit))
+
+            self.outputExperiment.variables["FromSample"] = fromvar
+            self.outputExperiment.variables["AUC0t"] = AUCvar
+            self.outputExperiment.variables["AUMC0t"] = AUMCvar
+            self.outputExperiment.variables["MRT"] = MRTvar
+            self.outputExperiment.variables["Cmax"] = Cmaxvar
+            self.outputExperiment.variables["Tmax"] = Tmaxvar
+            self.outputExperiment.variables["Cmin"] = Cminvar
+            self.outputExperiment.variables["Tmin"] = Tminvar
+            self.outputExperiment.variables["Cavg"] = Cavgvar
+
+        # Simulate all the responses at once
+        self.setTimeRange(None)
+        self.drugSource.setDoses(auxSample.parsedDoseList, self.model.t0, self.model.tF)
+        if self.protODE is not None:
+            self.protODE.configureSource(self.drugSource)
+        self.model.drugSource = self.drugSource
+        self.getParameterNames() # Necessary to count the number of source and PK parameters
         simulationsX = self.model.x
-        simulationsY = np.zeros((Nsimulations,len(simulationsX),self.getResponseDimension()))
-        AUCarray = np.zeros(Nsimulations)
-        AUMCarray = np.zeros(Nsimulations)
-        MRTarray = np.zeros(Nsimulations)
-        CminArray = np.zeros(Nsimulations)
-        CmaxArray = np.zeros(Nsimulations)
-        CavgArray = np.zeros(Nsimulations)
-        CtauArray = np.zeros(Nsimulations)
-        TminArray = np.zeros(Nsimulations)
-        TmaxArray = np.zeros(Nsimulations)
-        TtauArray = np.zeros(Nsimulations)
-        fluctuationArray = np.zeros(Nsimulations)
-        percentageAccumulationArray = np.zeros(Nsimulations)
+        simulationsY = self.simulateBatch(simulationParameters, simulationsX)
+
+        # Evaluate AUC, AUMC and MRT in all the dose periods
+        ncaList = self.NCABatch(simulationsX, simulationsY[:,:,0])
+        _, AUClist, AUMClist, Cminlist, Cavglist, Cmaxlist, Ctaulist, Tmaxlist, Tminlist, Ttaulist = ncaList
+        AUCarray = AUClist[-1]
+        AUMCarray = AUMClist[-1]
+        MRTarray = AUMCarray/AUCarray
+        CminArray = Cminlist[-1]
+        CmaxArray = Cmaxlist[-1]
+        CavgArray = Cavglist[-1]
+        CtauArray = Ctaulist[-1]
+        TminArray = Tminlist[-1]
+        TmaxArray = Tmaxlist[-1]
+        TtauArray = Ttaulist[-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fluctuationArray = np.where(CminArray>0, CmaxArray/CminArray, np.nan)
+            percentageAccumulationArray = np.where(Cavglist[0]>0, Cavglist[-1]/Cavglist[0], np.nan)
+        for i in range(0,Nsimulations):
+            print("Simulated sample %d from %s: %s AUC0t=%f [%s] Cmax=%f [%s]"%(i,fromSamples[i],
+                  str(simulationParameters[i]), AUCarray[i], strUnit(self.AUCunits), CmaxArray[i],
+                  strUnit(self.Cunits.unit)))
 
+        # Write all the simulations and doses in the Excel file
         wb = openpyxl.Workbook()
         wb.active.title = "Simulations"
-        for i in range(0,Nsimulations):
-            self.setTimeRange(None)
-
-            if self.odeSource.get() == self.SRC_ODE:
-                if self.paramsSource==ProtPKPDODESimulate.PRM_POPULATION:
-                    # Take parameters randomly from the population
-                    nfit = int(random.uniform(0,len(self.fitting.sampleFits)))
-                    sampleFit = self.fitting.sampleFits[nfit]
-                    nprm = int(random.uniform(0,sampleFit.parameters.shape[0]))
-                    parameters = sampleFit.parameters[nprm,:]
-                    self.fromSample="Population %d"%nprm
-                elif self.paramsSource==ProtPKPDODESimulate.PRM_USER_DEFINED:
-                    parameters = np.asarray(prmUser[i],np.double)
-                    self.fromSample="User defined"
-                elif self.paramsSource == ProtPKPDODESimulate.PRM_FITTING:
-                    parameters = self.fitting.sampleFits[i].parameters
-                    self.fromSample = self.fitting.sampleFits[i].sampleName
-                else:
-                    parameters = []
-                    self.fromSample=inputSampleNames[i]
-                    sample = self.inputExperiment.samples[self.fromSample]
-                    for prmName in self.fitting.modelParameters:
-                        parameters.append(float(sample.getDescriptorValue(prmName)))
-            else:
-                parameters = np.asarray(viaPrmList[:-2] + prmUser[i], np.double)
-                self.fromSample = "User defined"
-
-            print("From sample name: %s"%self.fromSample)
-            print("Simulated sample %d: %s"%(i,str(parameters)))
-
-            # Prepare source and this object
-            self.drugSource.setDoses(auxSample.parsedDoseList, self.model.t0, self.model.tF)
-            if self.protODE is not None:
-                self.protODE.configureSource(self.drugSource)
-            self.model.drugSource = self.drugSource
-            parameterNames = self.getParameterNames() # Necessary to count the number of source and PK parameters
-
-            # Prepare the model
-            self.setParameters(parameters)
-            y = self.forwardModel(parameters, [simulationsX]*self.getResponseDimension())
-
-            # Create AUC, AUMC, MRT variables and units
-            if i == 0:
-                if type(self.varNameY)!=list:
-                    self.Cunits = self.outputExperiment.variables[self.varNameY].units
-                else:
-                    self.Cunits = self.outputExperiment.variables[self.varNameY[0]].units
-                self.AUCunits = multiplyUnits(tvar.units.unit, self.Cunits.unit)
-                self.AUMCunits = multiplyUnits(tvar.units.unit, self.AUCunits)
-
-                if self.addStats or self.addIndividuals:
-                    fromvar = PKPDVariable()
-                    fromvar.varName = "FromSample"
-                    fromvar.varType = PKPDVariable.TYPE_TEXT
-                    fromvar.role = PKPDVariable.ROLE_LABEL
-                    fromvar.units = createUnit("none")
-
-                    AUCvar = PKPDVariable()
-                    AUCvar.varName = "AUC0t"
-                    AUCvar.varType = PKPDVariable.TYPE_NUMERIC
-                    AUCvar.role = PKPDVariable.ROLE_LABEL
-                    AUCvar.units = createUnit(strUnit(self.AUCunits))
-
-                    AUMCvar = PKPDVariable()
-                    AUMCvar.varName = "AUMC0t"
-                    AUMCvar.varType = PKPDVariable.TYPE_NUMERIC
-                    AUMCvar.role = PKPDVariable.ROLE_LABEL
-                    AUMCvar.units = createUnit(strUnit(self.AUMCunits))
-
-                    MRTvar = PKPDVariable()
-                    MRTvar.varName = "MRT"
-                    MRTvar.varType = PKPDVariable.TYPE_NUMERIC
-                    MRTvar.role = PKPDVariable.ROLE_LABEL
-                    MRTvar.units = createUnit(self.outputExperiment.getTimeUnits().unit)
-
-                    Cmaxvar = PKPDVariable()
-                    Cmaxvar.varName = "Cmax"
-                    Cmaxvar.varType = PKPDVariable.TYPE_NUMERIC
-                    Cmaxvar.role = PKPDVariable.ROLE_LABEL
-                    Cmaxvar.units = createUnit(strUnit(self.Cunits.unit))
-
-                    Tmaxvar = PKPDVariable()
-                    Tmaxvar.varName = "Tmax"
-                    Tmaxvar.varType = PKPDVariable.TYPE_NUMERIC
-                    Tmaxvar.role = PKPDVariable.ROLE_LABEL
-                    Tmaxvar.units = createUnit(self.outputExperiment.getTimeUnits().unit)
-
-                    Cminvar = PKPDVariable()
-                    Cminvar.varName = "Cmin"
-                    Cminvar.varType = PKPDVariable.TYPE_NUMERIC
-                    Cminvar.role = PKPDVariable.ROLE_LABEL
-                    Cminvar.units = createUnit(strUnit(self.Cunits.unit))
-
-                    Tminvar = PKPDVariable()
-                    Tminvar.varName = "Tmin"
-                    Tminvar.varType = PKPDVariable.TYPE_NUMERIC
-                    Tminvar.role = PKPDVariable.ROLE_LABEL
-                    Tminvar.units = createUnit(self.outputExperiment.getTimeUnits().unit)
-
-                    Cavgvar = PKPDVariable()
-                    Cavgvar.varName = "Cavg"
-                    Cavgvar.varType = PKPDVariable.TYPE_NUMERIC
-                    Cavgvar.role = PKPDVariable.ROLE_LABEL
-                    Cavgvar.units = createUnit(strUnit(self.Cunits.unit))
-
-                    self.outputExperiment.variables["FromSample"] = fromvar
-                    self.outputExperiment.variables["AUC0t"] = AUCvar
-                    self.outputExperiment.variables["AUMC0t"] = AUMCvar
-                    self.outputExperiment.variables["MRT"] = MRTvar
-                    self.outputExperiment.variables["Cmax"] = Cmaxvar
-                    self.outputExperiment.variables["Tmax"] = Tmaxvar
-                    self.outputExperiment.variables["Cmin"] = Cminvar
-                    self.outputExperiment.variables["Tmin"] = Tminvar
-                    self.outputExperiment.variables["Cavg"] = Cavgvar
-
-                excelWriteRow(["simulationName", "fromSample", "doseNumber",
-                               "AUC [%s]" % strUnit(self.AUCunits),
-                               "AUMC [%s]" % strUnit(self.AUMCunits),
-                               "Cmin [%s]" % strUnit(self.Cunits.unit),
-                               "Cavg [%s]" % strUnit(self.Cunits.unit),
-                               "Cmax [%s]" % strUnit(self.Cunits.unit),
-                               "Ctau [%s]" % strUnit(self.Cunits.unit),
-                               "Tmin [%s]" % strUnit(self.outputExperiment.getTimeUnits().unit),
-                               "Tmax [%s]" % strUnit(self.outputExperiment.getTimeUnits().unit),
-                               "Ttau [%s]" % strUnit(self.outputExperiment.getTimeUnits().unit)],
-                              wb, 1, bold=True)
-                wbRow = 2
-
-            # Evaluate AUC, AUMC and MRT in the last full period
-            AUClist, AUMClist, Cminlist, Cavglist, Cmaxlist, Ctaulist, Tmaxlist, Tminlist, Ttaulist = self.NCA(self.model.x,y[0])
-            for doseNo in range(0,len(AUClist)):
-                excelWriteRow(["Simulation_%d"%i, self.fromSample, doseNo, AUClist[doseNo], AUMClist[doseNo],
-                               Cminlist[doseNo], Cavglist[doseNo], Cmaxlist[doseNo], Ctaulist[doseNo],
-                               Tminlist[doseNo], Tmaxlist[doseNo], Ttaulist[doseNo]], wb, wbRow)
-                wbRow+=1
-
-            # Keep results
-            for j in range(self.getResponseDimension()):
-                simulationsY[i,:,j] = y[j]
-            AUCarray[i] = self.AUC0t
-            AUMCarray[i] = self.AUMC0t
-            MRTarray[i] = self.MRT
-            CminArray[i] = self.Cmin
-            CmaxArray[i] = self.Cmax
-            CavgArray[i] = self.Cavg
-            CtauArray[i] = self.Ctau
-            TminArray[i] = self.Tmin
-            TmaxArray[i] = self.Tmax
-            TtauArray[i] = self.Ttau
-            fluctuationArray[i] = self.fluctuation
-            percentageAccumulationArray[i] = self.percentageAccumulation
-            if self.addIndividuals or self.paramsSource!=ProtPKPDODESimulate.PRM_POPULATION:
-                self.addSample("Simulation_%d"%i, dosename, simulationsX, y[0])
+        excelWriteRow(["simulationName", "fromSample", "doseNumber",
+                       "AUC [%s]" % strUnit(self.AUCunits),
+                       "AUMC [%s]" % strUnit(self.AUMCunits),
+                       "Cmin [%s]" % strUnit(self.Cunits.unit),
+                       "Cavg [%s]" % strUnit(self.Cunits.unit),
+                       "Cmax [%s]" % strUnit(self.Cunits.unit),
+                       "Ctau [%s]" % strUnit(self.Cunits.unit),
+                       "Tmin [%s]" % strUnit(self.outputExperiment.getTimeUnits().unit),
+                       "Tmax [%s]" % strUnit(self.outputExperiment.getTimeUnits().unit),
+                       "Ttau [%s]" % strUnit(self.outputExperiment.getTimeUnits().unit)],
+                      wb, 1, bold=True)
+        ncaTable = np.stack([AUClist, AUMClist, Cminlist, Cavglist, Cmaxlist, Ctaulist, Tminlist, Tmaxlist, Ttaulist],
+                            axis=2).transpose(1,0,2).tolist()
+        excelAppendRows([["Simulation_%d"%i, fromSamples[i], doseNo]+ncaTable[i][doseNo]
+                         for i in range(0,Nsimulations) for doseNo in range(0,AUClist.shape[0])], wb)
+
+        # Keep individual results
+        if self.addIndividuals or self.paramsSource!=ProtPKPDODESimulate.PRM_POPULATION:
+            for i in range(0,Nsimulations):
+                self.fromSample = fromSamples[i]
+                self.setNCAValues(ncaList, i)
+                self.addSample("Simulation_%d"%i, dosename, simulationsX, simulationsY[i,:,0])
 
         # Report NCA statistics
         fhSummary = open(self._getPath("summary.txt"),"w")
@@ -90,6 +90,7 @@ are independent, which are not. Use Bootstrap estimates instead.\n
                            'SplinesN: [tlag]; Ymax; tmax; c1; c2; ...; cN\n')
         form.addParam('confidenceInterval', params.FloatParam, label="Confidence interval=", default=95, expertLevel=LEVEL_ADVANCED,
                       help='Confidence interval for the fitted parameters')
+        self._defineParamsGlobalSearch(form, parallel=True)
         form.addParam('resampleT',params.FloatParam, label='Simulation model time step=', default=-1,
                       help='If this value is greater than 0, then the fitted models will be sampled at this sampling period '
                            'and the created profiles will be collected in a new output experiment. '
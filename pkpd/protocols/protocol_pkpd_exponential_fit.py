@@ -64,6 +64,7 @@ are independent, which are not. Use Bootstrap estimates instead.\n
         if fullForm:
             form.addParam('reportX', params.StringParam, label="Evaluate at X=", default="", expertLevel=LEVEL_ADVANCED,
                           help='Evaluate the model at these X values\nExample 1: [0,5,10,20,40,100]\nExample 2: 0:0.55:10, from 0 to 10 in steps of 0.5')
+            self._defineParamsGlobalSearch(form, parallel=True)
         else:
             self.reportX=String()
             self.reportX.set("")
@@ -34,7 +34,7 @@ import numpy as np
 
 import pyworkflow.protocol.params as params
 from .protocol_pkpd import ProtPKPD
-from pkpd.objects import (PKPDDEOptimizer, PKPDLSOptimizer, PKPDFitting,
+from pkpd.objects import (PKPDDEOptimizer, PKPDLSOptimizer, PKPDMultiStartOptimizer, PKPDFitting,
                           PKPDSampleFit)
 from pkpd.utils import parseRange
 
@@ -51,6 +51,7 @@ class ProtPKPDFitBase(ProtPKPD):
                       help='Y is predicted as an exponential function of X, Y=f(X)')
         form.addParam('predicted', params.StringParam, label="Predicted variable (Y)", default=defaultPredicted,
                       help='Y is predicted as an exponential function of X, Y=f(X)')
+        self._defineParamsOptimizerLog(form)
 
     #--------------------------- INSERT steps functions --------------------------------------------
     def _insertAllSteps(self):
@@ -119,6 +120,22 @@ class ProtPKPDFitBase(ProtPKPD):
 
         return boundsDict
 
+    def getGlobalSearchOptions(self):
+        """Population size, maximum number of iterations and seed (None for a random one) of the global search"""
+        popsize = self.populationSize.get() if hasattr(self,"populationSize") else 15
+        maxiter = self.maxIterations.get() if hasattr(self,"maxIterations") else 30
+        return popsize, maxiter, self.getGlobalSearchSeed()
+
+    def getGlobalSearchProcesses(self):
+        """Number of processes of the global search"""
+        return self.numberOfProcesses.get() if hasattr(self,"numberOfProcesses") else 1
+
+    def getNumberOfStarts(self):
+        """Number of starting points of the multi-start search, 0 if the global search is differential evolution"""
+        if hasattr(self,"globalSearchMethod") and self.globalSearchMethod.get()==1:
+            return self.numberOfStarts.get()
+        return 0
+
     def setupModel(self):
         # Setup model
         self.model = self.createModel()
@@ -215,9 +232,19 @@ class ProtPKPDFitBase(ProtPKPD):
                 continue
             print(" ")
 
-            optimizer1 = PKPDDEOptimizer(self.model,fitType)
-            optimizer1.optimize()
+            popsize, maxiter, seed = self.getGlobalSearchOptions()
+            if self.getNumberOfStarts()>0:
+                optimizer1 = PKPDMultiStartOptimizer(self.model,fitType)
+                optimizer1.verbose = self.getOptimizerVerbosity()
+                optimizer1.optimize(Nstarts=self.getNumberOfStarts(), seed=seed,
+                                    Nprocesses=self.getGlobalSearchProcesses())
+            else:
+                optimizer1 = PKPDDEOptimizer(self.model,fitType)
+                optimizer1.verbose = self.getOptimizerVerbosity()
+                optimizer1.optimize(popsize=popsize, maxiter=maxiter, seed=seed,
+                                    Nprocesses=self.getGlobalSearchProcesses())
             optimizer2 = PKPDLSOptimizer(self.model,fitType)
+            optimizer2.verbose = self.getOptimizerVerbosity()
             optimizer2.optimize()
             optimizer2.setConfidenceInterval(self.confidenceInterval.get())
             self.setParameters(optimizer2.optimum)
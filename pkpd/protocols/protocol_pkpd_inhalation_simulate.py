@@ -24,6 +24,7 @@
 # *
 # **************************************************************************
 
+import copy
 import math
 import numpy as np
 
@@ -34,7 +35,8 @@ from .protocol_pkpd import ProtPKPD
 from pkpd.objects import PKDepositionParameters, PKSubstanceLungParameters, PKPhysiologyLungParameters, PKLung,\
                          PKPDExperiment, PKPDVariable, PKPDSample
 from pkpd.pkpd_units import createUnit
-from pkpd.inhalation import diam2vol, saturable_2D_upwind_IE
+from pkpd.inhalation import diam2vol, saturable_2D_upwind_IE, project_deposition, lung_geometry, print_solver_profile
+from pkpd.utils import parallelMap, getMD5Key, cachedArrays
 
 # Tested in test_workflow_inhalation1
 
@@ -90,7 +92,23 @@ class ProtPKPDInhSimulate(ProtPKPD):
                       label='Ciliary speed', expertLevel=LEVEL_ADVANCED)
 
         form.addParam('simulationTime', params.FloatParam, label="Simulation time (min)", default=10*24*60)
-        form.addParam('deltaT', params.FloatParam, label='Time step (min)', default=1, expertLevel=LEVEL_ADVANCED)
+        form.addParam('deltaT', params.FloatParam, label='Time step (min)', default=1, expertLevel=LEVEL_ADVANCED,
+                      help='With adaptive time steps, this is the time between reported time points')
+        form.addParam('adaptiveStep', params.BooleanParam, label='Adaptive time step', default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='The solver chooses the time steps from the CFL condition and the estimated error of '
+                           'each step, and the results are interpolated at the reported time points. Small steps are '
+                           'taken at the beginning of the simulation, where the dynamics are fast')
+        form.addParam('maxCFL', params.FloatParam, label='Maximum CFL factor', default=0.9, condition='adaptiveStep',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='The CFL factor of each time step is kept below this value, it must be smaller than 1')
+        form.addParam('tolerance', params.FloatParam, label='Tolerance', default=1e-4, condition='adaptiveStep',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Maximum estimated error of each time step, relative to each amount')
+        form.addParam('reportStep', params.IntParam, label='Report every (time steps)', default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='The simulation is reported every this number of time steps (and at the end of the '
+                           'simulation). Use it to get a coarser output for long simulations with small time steps')
         form.addParam('diameters', params.StringParam, label='Diameters (um)',
                       default="0.1,1.1,0.1; 1.2,9.2,0.2",
                       help='Diameters to analyze. Syntax: start1, stop1, step1; start2, stop2, step2; ... They will be '
@@ -98,6 +116,38 @@ class ProtPKPDInhSimulate(ProtPKPD):
                       expertLevel=LEVEL_ADVANCED)
         form.addParam('volMultiplier', params.FloatParam, label='Particle volume multiplier', default=1,
                       expertLevel=LEVEL_ADVANCED)
+        form.addParam('scenarios', params.TextParam, label='Scenarios', height=8, default="",
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Sweep of multipliers, one scenario per line with the syntax:\n'
+                           'label; dose multiplier; substance multiplier; physiology multiplier; PK multiplier\n'
+                           'The vectors of multipliers are given as above. The fields that are empty or missing '
+                           'take the multipliers above. Each scenario is a sample of the output experiment. '
+                           'If there are no scenarios, a single simulation is performed with the multipliers above.\n'
+                           'Example:\n'
+                           'Kp x2; 1; 1 1 1 1 2 2 1 1\n'
+                           'Half dose, low clearance; 0.5; ; ; 0.5 1 1 1 1 1')
+        form.addParam('sizeClasses', params.BooleanParam, label='Simulate each diameter separately', default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Each diameter of the deposition file is simulated separately, with the lung deposition of '
+                           'that diameter (there is no throat dose). Each diameter of each scenario is a sample of '
+                           'the output experiment. The simulations are independent, so that the saturation of the '
+                           'dissolution caused by the other diameters is not taken into account')
+        form.addParam('classDiameters', params.StringParam, label='Diameters to simulate (um)', default="",
+                      condition='sizeClasses', expertLevel=LEVEL_ADVANCED,
+                      help='Diameters of the deposition file separated by spaces, e.g. 1.5 3 6. If empty, all of them')
+        form.addParam('abortOnViolation', params.BooleanParam, label='Abort on quality control failures', default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='The solver checks the CFL condition and that the amounts are not negative at every time '
+                           'step. If this option is set, the simulation stops at the first failure. Otherwise, the '
+                           'failures are summarized in the log at the end of the simulation')
+        form.addParam('profile', params.BooleanParam, label='Profile the solver', default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Report in the log the time spent in each phase of the solver, the number of time steps, '
+                           'the CFL factors and the memory of the solver arrays of each simulation')
+        form.addParam('numberOfProcesses', params.IntParam, label="Parallel processes", default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Number of simulations (scenarios and diameters) performed simultaneously, each one in a '
+                           'separate process')
 
     #--------------------------- INSERT steps functions --------------------------------------------
     def _insertAllSteps(self):
@@ -105,40 +155,90 @@ class ProtPKPDInhSimulate(ProtPKPD):
         self._insertFunctionStep('createOutputStep')
 
     #--------------------------- STEPS functions --------------------------------------------
-    def runSimulation(self):
-        self.deposition = PKDepositionParameters()
-        self.deposition.setFiles(self.ptrDeposition.get().fnSubstance.get(),
-                                 self.ptrDeposition.get().fnLung.get(),
-                                 self.ptrDeposition.get().fnDeposition.get())
-        self.deposition.doseMultiplier = self.doseMultiplier.get()
-        self.deposition.read()
-
-        substanceParams = PKSubstanceLungParameters()
-        substanceParams.multiplier = [float(x) for x in self.substanceMultiplier.get().split()]
-        substanceParams.read(self.ptrDeposition.get().fnSubstance.get())
-
-        lungParams = PKPhysiologyLungParameters()
-        lungParams.multiplier = [float(x) for x in self.physiologyMultiplier.get().split()]
-        lungParams.read(self.ptrDeposition.get().fnLung.get())
-
-        pkParams = PKPDExperiment()
-        pkParams.load(self.ptrPK.get().fnPKPD)
+    def getScenarios(self):
+        """ List of scenarios [label, doseMultiplier, substanceMultiplier, physiologyMultiplier, pkMultiplier] """
+        default = [self.doseMultiplier.get(),
+                   [float(x) for x in self.substanceMultiplier.get().split()],
+                   [float(x) for x in self.physiologyMultiplier.get().split()],
+                   [float(x) for x in self.pkMultiplier.get().split()]]
+        if self.scenarios.get() is None or self.scenarios.get().strip()=="":
+            return [["simulation"]+default]
+        scenarioList = []
+        for line in self.scenarios.get().split('\n'):
+            if line.strip()=="":
+                continue
+            tokens = line.split(';')
+            if len(tokens)>5:
+                raise Exception("The scenario %s has more than 5 fields in %s"%(tokens[0].strip(),line))
+            scenario = [tokens[0].strip()]+default
+            for i, token in enumerate(tokens[1:]):
+                if token.strip()!="":
+                    try:
+                        scenario[i+1] = float(token) if i==0 else [float(x) for x in token.split()]
+                    except ValueError:
+                        raise Exception("The scenario %s has a value that is not a number in %s"%(scenario[0],line))
+            for multiplier, N in zip(scenario[2:], [8, 9, 6]):
+                if len(multiplier)!=N:
+                    raise Exception("The scenario %s does not have %d multipliers in %s"%(scenario[0],N,line))
+            if scenario[0] in [previousScenario[0] for previousScenario in scenarioList]:
+                raise Exception("The scenario %s is repeated"%scenario[0])
+            scenarioList.append(scenario)
+        return scenarioList
+
+    def getSizeClasses(self):
+        """ List of the indexes of the deposition diameters simulated separately, [None] if they are simulated
+            together """
+        if not self.sizeClasses.get():
+            return [None]
+        diameters = self.deposition.depositionDiameters
+        if self.classDiameters.get() is None or self.classDiameters.get().strip()=="":
+            return list(range(diameters.size))
+        sizeClassList = []
+        for token in self.classDiameters.get().replace(',',' ').split():
+            i = int(np.argmin(np.abs(diameters-float(token))))
+            if not np.isclose(diameters[i], float(token)):
+                raise Exception("The diameter %s is not in the deposition file %s"%
+                                (token, self.ptrDeposition.get().fnDeposition.get()))
+            sizeClassList.append(i)
+        return sizeClassList
+
+    def simulateScenario(self, doseMultiplier, substanceMultiplier, physiologyMultiplier, pkMultiplier,
+                         sizeClass=None, returnConcentrations=False):
+        deposition = self.deposition.getScaledCopy(doseMultiplier)
+        rho0br, rho0alv = self.rho0[sizeClass]
+        Sbnd = self.Sbnd
+        if sizeClass is not None:
+            deposition = deposition.getSizeClassCopy(sizeClass)
+            # Particles only shrink, the sizes above the largest deposited one remain empty and are not simulated
+            occupied = np.nonzero(np.any(rho0br!=0, axis=0) | (rho0alv!=0))[0]
+            Ns = occupied[-1]+1 if occupied.size>0 else 1
+            Sbnd = Sbnd[0:Ns+1]
+            rho0br = rho0br[:,0:Ns]
+            rho0alv = rho0alv[0:Ns]
+
+        substanceParams = copy.copy(self.substanceParams)
+        substanceParams.multiplier = substanceMultiplier
+
+        lungParams = copy.copy(self.lungParams)
+        lungParams.multiplier = physiologyMultiplier
 
         pkLungParams = PKLung()
-        pkLungParams.prepare(substanceParams, lungParams, pkParams,
-                             [float(x) for x in self.pkMultiplier.get().split()],
-                             self.ciliarySpeedType.get())
+        pkLungParams.prepare(substanceParams, lungParams, self.pkParams, pkMultiplier, self.ciliarySpeedType.get())
 
-        # diameters = np.concatenate((np.arange(0.1,1.1,0.1),np.arange(1.2,9.2,0.2))) # [um]
-        evalStr = "np.concatenate(("+",".join(["np.arange("+x.strip()+")" for x in self.diameters.get().split(";")])+"))"
-        diameters = eval(evalStr, {'np': np})
-        Sbnd = self.volMultiplier.get() * diam2vol(diameters)
+        key = getMD5Key(self.inputFiles, substanceMultiplier, physiologyMultiplier, self.ciliarySpeedType.get())
+        geometry = cachedArrays(self._getExtraPath("geometry_%s.npz"%key), lung_geometry, lungParams, pkLungParams)
 
-        tt=np.arange(0,self.simulationTime.get()+self.deltaT.get(),self.deltaT.get())
-        sol=saturable_2D_upwind_IE(lungParams, pkLungParams, self.deposition, tt, Sbnd)
+        rho0 = (doseMultiplier*rho0br, doseMultiplier*rho0alv)
+        sol=saturable_2D_upwind_IE(lungParams, pkLungParams, deposition, self.tt, Sbnd, self.reportStep.get(),
+                                   rho0, geometry, adaptive=self.adaptiveStep.get(), maxCFL=self.maxCFL.get(),
+                                   tolerance=self.tolerance.get(), profile=self.profile.get(),
+                                   abortOnViolation=self.abortOnViolation.get())
+        if self.profile.get():
+            print_solver_profile(sol['profile'])
+        tt=sol['discr']['grid']['t']
 
         # Postprocessing
-        depositionData = self.deposition.getData()
+        depositionData = deposition.getData()
         alvDose = np.sum(depositionData['alveolar'])
         bronchDose = np.sum(depositionData['bronchial'])
         lungDose = alvDose + bronchDose
@@ -164,6 +264,67 @@ class ProtPKPDInhSimulate(ProtPKPD):
 
         CsysPer = AsysPer * substanceParams.getData()['MW'] / pkLungParams.pkData['Vp']
 
+        columns = [("t", tt), ("Retention", lungRetention), ("Cnmol", Csysnmol), ("C", Csys),
+                   ("alvFluid", Aalvfluid), ("alvTissue", Aalvtissue), ("alvSolid", Aalvsolid),
+                   ("brFluid", Abrfluid), ("brTissue", Abrtissue), ("brSolid", Abrsolid), ("brClear", Abrcleared),
+                   ("CbrTis", Cavgbr), ("sysAbsorption", AsysGut), ("sysCentral", AsysCtr),
+                   ("sysPeripheral", AsysPer), ("Cp", CsysPer)]
+        lungDose = depositionData['dose_nmol']-depositionData['throat']
+        descriptors = [("dose_nmol", depositionData['dose_nmol']), ("throat_dose_nmol", depositionData['throat']),
+                       ("lung_dose_nmol", lungDose), ("bronchial_dose_nmol", bronchDose),
+                       ("alveolar_dose_nmol", alvDose), ("mcc_cleared_lung_dose_fraction", Abrcleared[-1]/lungDose)]
+        if returnConcentrations:
+            return columns, descriptors, sol['C']['br']['fluid'], substanceParams.getData()['Cs_br']
+        return columns, descriptors, None, None
+
+    def projectDeposition(self, deposition):
+        rho0br, rho0alv = project_deposition(deposition, self.lungParams, self.Sbnd)
+        return {'br': rho0br, 'alv': rho0alv}
+
+    def runSimulation(self):
+        self.deposition = PKDepositionParameters()
+        self.deposition.setFiles(self.ptrDeposition.get().fnSubstance.get(),
+                                 self.ptrDeposition.get().fnLung.get(),
+                                 self.ptrDeposition.get().fnDeposition.get())
+        self.deposition.read()
+
+        self.substanceParams = PKSubstanceLungParameters()
+        self.substanceParams.read(self.ptrDeposition.get().fnSubstance.get())
+
+        self.lungParams = PKPhysiologyLungParameters()
+        self.lungParams.read(self.ptrDeposition.get().fnLung.get())
+
+        self.pkParams = PKPDExperiment()
+        self.pkParams.load(self.ptrPK.get().fnPKPD)
+
+        # diameters = np.concatenate((np.arange(0.1,1.1,0.1),np.arange(1.2,9.2,0.2))) # [um]
+        evalStr = "np.concatenate(("+",".join(["np.arange("+x.strip()+")" for x in self.diameters.get().split(";")])+"))"
+        diameters = eval(evalStr, {'np': np})
+        self.Sbnd = self.volMultiplier.get() * diam2vol(diameters)
+
+        self.tt=np.arange(0,self.simulationTime.get()+self.deltaT.get(),self.deltaT.get())
+
+        # The deposition (of each size class) is projected on the simulation grid once for all scenarios, it is
+        # proportional to the dose. The projection and the lung geometry are cached in the extra folder, named after
+        # the MD5 of their inputs.
+        self.inputFiles = [self.ptrDeposition.get().fnSubstance.get(), self.ptrDeposition.get().fnLung.get()]
+        sizeClassList = self.getSizeClasses()
+        self.rho0 = {}
+        for sizeClass in sizeClassList:
+            deposition = self.deposition if sizeClass is None else self.deposition.getSizeClassCopy(sizeClass)
+            key = getMD5Key(self.inputFiles+[self.ptrDeposition.get().fnDeposition.get()], self.Sbnd, sizeClass)
+            rho0 = cachedArrays(self._getExtraPath("deposition_%s.npz"%key), self.projectDeposition, deposition)
+            self.rho0[sizeClass] = (rho0['br'], rho0['alv'])
+
+        # One simulation per scenario and size class
+        scenarioList = self.getScenarios()
+        runList = [(scenario, sizeClass) for scenario in scenarioList for sizeClass in sizeClassList]
+        argList = [tuple(scenario[1:])+(sizeClass, len(runList)==1) for scenario, sizeClass in runList]
+        # The output is only captured (and printed after the run) when the simulations are simultaneous
+        captureOutput = len(argList)>1 and self.numberOfProcesses.get()>1
+        results = parallelMap(self.simulateScenario, argList, self.numberOfProcesses.get(),
+                              captureOutput=captureOutput)
+
         # Create output
         self.experimentLungRetention = PKPDExperiment()
         self.experimentLungRetention.general["title"]="Inhalation simulate"
@@ -344,48 +505,64 @@ class ProtPKPDInhSimulate(ProtPKPD):
         self.experimentLungRetention.variables["alveolar_dose_nmol"] = doseAlveolarVar
         self.experimentLungRetention.variables["mcc_cleared_lung_dose_fraction"] = mccClearedLungDoseFractionVar
 
-        # Samples
-        simulationSample = PKPDSample()
-        simulationSample.sampleName = "simulation"
-        simulationSample.addMeasurementColumn("t", tt)
-        simulationSample.addMeasurementColumn("Retention", lungRetention)
-        simulationSample.addMeasurementColumn("Cnmol", Csysnmol)
-        simulationSample.addMeasurementColumn("C", Csys)
-        simulationSample.addMeasurementColumn("alvFluid", Aalvfluid)
-        simulationSample.addMeasurementColumn("alvTissue", Aalvtissue)
-        simulationSample.addMeasurementColumn("alvSolid", Aalvsolid)
-        simulationSample.addMeasurementColumn("brFluid", Abrfluid)
-        simulationSample.addMeasurementColumn("brTissue", Abrtissue)
-        simulationSample.addMeasurementColumn("brSolid", Abrsolid)
-        simulationSample.addMeasurementColumn("brClear", Abrcleared)
-        simulationSample.addMeasurementColumn("CbrTis", Cavgbr)
-        simulationSample.addMeasurementColumn("sysAbsorption", AsysGut)
-        simulationSample.addMeasurementColumn("sysCentral", AsysCtr)
-        simulationSample.addMeasurementColumn("sysPeripheral", AsysPer)
-        simulationSample.addMeasurementColumn("Cp", CsysPer)
-        simulationSample.setDescriptorValue("dose_nmol",depositionData['dose_nmol'])
-        simulationSample.setDescriptorValue("throat_dose_nmol",depositionData['throat'])
-        lungDose = depositionData['dose_nmol']-depositionData['throat']
-        simulationSample.setDescriptorValue("lung_dose_nmol",lungDose)
-        simulationSample.setDescriptorValue("bronchial_dose_nmol",bronchDose)
-        simulationSample.setDescriptorValue("alveolar_dose_nmol",alvDose)
-        simulationSample.setDescriptorValue("mcc_cleared_lung_dose_fraction",Abrcleared[-1]/lungDose)
-        self.experimentLungRetention.samples["simulmvarNameation"] = simulationSample
+        if len(scenarioList)>1:
+            for varName, varType, comment in [("dose_multiplier", PKPDVariable.TYPE_NUMERIC, "Dose multiplier"),
+                                              ("substance_multiplier", PKPDVariable.TYPE_TEXT, "Substance multiplier"),
+                                              ("physiology_multiplier", PKPDVariable.TYPE_TEXT, "Physiology multiplier"),
+                                              ("pk_multiplier", PKPDVariable.TYPE_TEXT, "PK multiplier")]:
+                multiplierVar = PKPDVariable()
+                multiplierVar.varName = varName
+                multiplierVar.varType = varType
+                multiplierVar.role = PKPDVariable.ROLE_LABEL
+                multiplierVar.units = createUnit("none")
+                multiplierVar.comment = comment
+                self.experimentLungRetention.variables[varName] = multiplierVar
+        if sizeClassList[0] is not None:
+            diameterVar = PKPDVariable()
+            diameterVar.varName = "diameter"
+            diameterVar.varType = PKPDVariable.TYPE_NUMERIC
+            diameterVar.role = PKPDVariable.ROLE_LABEL
+            diameterVar.units = createUnit("none")
+            diameterVar.comment = "Particle diameter in the deposition file (um)"
+            self.experimentLungRetention.variables["diameter"] = diameterVar
+
+        # Samples, one per scenario and size class
+        for (scenario, sizeClass), result in zip(runList, results):
+            if captureOutput:
+                log, result = result
+                print(log, end="")
+            columns, descriptors, Cflu, Cs = result
+            simulationSample = PKPDSample()
+            if sizeClass is None:
+                simulationSample.sampleName = scenario[0]
+            else:
+                diameter = self.deposition.depositionDiameters[sizeClass]
+                simulationSample.sampleName = "%s_%gum"%(scenario[0], diameter)
+                simulationSample.setDescriptorValue("diameter", diameter)
+            for varName, values in columns:
+                simulationSample.addMeasurementColumn(varName, values)
+            for varName, value in descriptors:
+                simulationSample.setDescriptorValue(varName, value)
+            if len(scenarioList)>1:
+                simulationSample.setDescriptorValue("dose_multiplier", scenario[1])
+                simulationSample.setDescriptorValue("substance_multiplier", " ".join(["%g"%x for x in scenario[2]]))
+                simulationSample.setDescriptorValue("physiology_multiplier", " ".join(["%g"%x for x in scenario[3]]))
+                simulationSample.setDescriptorValue("pk_multiplier", " ".join(["%g"%x for x in scenario[4]]))
+            self.experimentLungRetention.samples[simulationSample.sampleName] = simulationSample
 
         self.experimentLungRetention.write(self._getPath("experiment.pkpd"))
+        if len(runList)>1:
+            return
 
         # Plots
         import matplotlib.pyplot as plt
-        lungData = lungParams.getBronchial()
+        lungData = self.lungParams.getBronchial()
         Xbnd = np.sort([0] + lungData['end_cm'].tolist() + lungData['pos'].tolist())
         Xctr = Xbnd[:-1] + np.diff(Xbnd) / 2
 
-        tvec = tt / 60;
+        tvec = columns[0][1] / 60;
         T = np.max(tvec);
 
-        Cflu = sol['C']['br']['fluid'];
-        Cs = substanceParams.getData()['Cs_br'];
-
         plt.figure(figsize=(15, 9))
         plt.title('Concentration in bronchial fluid (Cs=%f [uM])'%Cs)
         plt.imshow(Cflu, interpolation='bilinear', aspect='auto', extent=[np.min(Xctr),np.max(Xctr),T,0])
@@ -397,7 +574,7 @@ class ProtPKPDInhSimulate(ProtPKPD):
         plt.xlabel('Distance from throat [cm]')
         plt.savefig(self._getPath('concentrationBronchialFluid.png'))
 
-        Ctis = sol['C']['br']['fluid'];
+        Ctis = Cflu;
         plt.figure(figsize=(15, 9))
         plt.title('Concentration in bronchial tissue')
         plt.imshow(Ctis, interpolation='bilinear', aspect='auto', extent=[np.min(Xctr),np.max(Xctr),T,0])
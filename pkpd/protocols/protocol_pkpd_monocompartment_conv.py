@@ -46,6 +46,12 @@ are independent, which are not. Use Bootstrap estimates instead.\n
     def forwardModel(self, parameters, x=None):
         return self.forwardModelByConvolution(parameters, x)
 
+    def hasJacobian(self, parameters):
+        return False # The convolution has no batched version
+
+    def getJacobian(self, parameters, x=None):
+        return None
+
     #--------------------------- DEFINE param functions --------------------------------------------
     def _defineParams(self, form):
         self._defineParams1(form, True, "t", "Cp")
@@ -35,10 +35,10 @@ import numpy as np
 
 import pyworkflow.protocol.params as params
 from .protocol_pkpd import ProtPKPD
-from pkpd.objects import (PKPDDEOptimizer, PKPDLSOptimizer, PKPDFitting,
-                          PKPDSampleFit, PKPDModelBase, PKPDModelBase2)
+from pkpd.objects import (PKPDDEOptimizer, PKPDLSOptimizer, PKPDMultiStartOptimizer, PKPDFitting,
+                          PKPDSampleFit, PKPDModelBase, PKPDModelBase2, PKPDODEModel, PKPDVariable)
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
-from pkpd.utils import parseRange
+from pkpd.utils import parseRange, parallelMap
 from pkpd.biopharmaceutics import DrugSource
 from pkpd.pkpd_units import PKPDUnit
 
@@ -49,6 +49,7 @@ class ProtPKPDODEBase(ProtPKPD,PKPDModelBase2):
     def __init__(self,**kwargs):
         ProtPKPD.__init__(self,**kwargs)
         self.boundsList = None
+        self.globalSearchProcesses = 1
 
     #--------------------------- DEFINE param functions --------------------------------------------
     def _defineParams1(self, form, addXY=False, defaultPredictor="", defaultPredicted=""):
@@ -65,7 +66,26 @@ class ProtPKPDODEBase(ProtPKPD,PKPDModelBase2):
                       help="Time step for the numerical solution of the differential equation. Same units as time in the "
                            "input experiment. "
                            "For very long simulations you may want to increase this value, beware that this results in "
-                           "less accurate solutions.")
+                           "less accurate solutions. The step is only used by the Runge-Kutta 4 integrator, the "
+                           "adaptive integrators choose their own step.")
+        form.addParam('integrator', params.EnumParam, label='ODE integrator', expertLevel = LEVEL_ADVANCED,
+                      choices=[PKPDODEModel.INTEGRATOR_NAMES[PKPDODEModel.INTEGRATOR_RK4],
+                               PKPDODEModel.INTEGRATOR_NAMES[PKPDODEModel.INTEGRATOR_RK45],
+                               PKPDODEModel.INTEGRATOR_NAMES[PKPDODEModel.INTEGRATOR_LSODA]],
+                      default=PKPDODEModel.INTEGRATOR_RK4,
+                      help="Runge-Kutta 4 uses a fixed step (see Step). The adaptive integrators adjust the step to "
+                           "the dynamics of the system, treat the intravenous boluses as discontinuities and are "
+                           "usually much cheaper for long simulations. LSODA switches automatically to a stiff "
+                           "solver when needed (e.g., Michaelis-Menten or autoinduction models, or wide bounds "
+                           "during the global search), Runge-Kutta 4(5) may be very slow for them. The number of "
+                           "evaluations of the differential equation is reported in the log.")
+        form.addParam('analytic', params.BooleanParam, label='Closed form solution if possible', default=False,
+                      expertLevel = LEVEL_ADVANCED,
+                      help="Linear models (mono, two and three compartments) with intravenous boluses, infusions "
+                           "and first order absorptions (ev1) have an exact solution whose cost only depends on the "
+                           "number of observations. If this option is set, it is used instead of the ODE integrator "
+                           "whenever the model and the vias allow it. The fitted values may then differ slightly "
+                           "from those of the integrator.")
 
         fromTo = form.addLine('Simulation length', expertLevel = LEVEL_ADVANCED,
                            help='Minimum and maximum time (in hours). '
@@ -84,6 +104,18 @@ class ProtPKPDODEBase(ProtPKPD,PKPDModelBase2):
         form.addParam('globalSearch', params.BooleanParam, label="Global search", default=True, expertLevel=LEVEL_ADVANCED,
                       help='Global search looks for the best parameters within bounds. If it is not performed, the '
                            'middle of the bounding box is used as initial parameter for a local optimization')
+        self._defineParamsGlobalSearch(form, condition='globalSearch',
+                                       seedHelp='The fit is also the same for any number of processes above 1 '
+                                                '(see Parallel processes). ')
+        form.addParam('numberOfProcesses', params.IntParam, label="Parallel processes", default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='If there are several groups, number of groups fitted simultaneously. Each group is fitted '
+                           'in a separate process and the results are collected in the same order as in the sequential '
+                           'fit. If there is a single group, the population of the global search is evaluated with '
+                           'these processes (or the local optimizations of the multi-start search). With more '
+                           'than one process, the population of the differential evolution is updated once per '
+                           'generation.')
+        self._defineParamsOptimizerLog(form)
 
     #--------------------------- INSERT steps functions --------------------------------------------
     def getListOfFormDependencies(self):
@@ -177,6 +209,10 @@ class ProtPKPDODEBase(ProtPKPD,PKPDModelBase2):
 
         if hasattr(self,"deltaT"):
             self.model.deltaT = self.deltaT.get()
+        if hasattr(self,"integrator"):
+            self.model.integrator = self.integrator.get()
+        if hasattr(self,"analytic"):
+            self.model.analytic = self.analytic.get()
 
     def setVarNames(self,varNameX,varNameY):
         self.varNameX = varNameX
@@ -304,6 +340,38 @@ class ProtPKPDODEBase(ProtPKPD,PKPDModelBase2):
         self.yPredicted = self.mergeLists(yPredictedList)
         return copy.copy(self.yPredicted)
 
+    def forwardModelBatch(self, parameters, x=None):
+        """Simulate many parameter vectors (one per row of parameters) at once. For each response dimension it
+        returns a matrix with one row per parameter vector and the predictions of all samples concatenated"""
+        parameters = np.atleast_2d(parameters)
+        sourceParameters = None
+        if self.NparametersSource>0:
+            sourceParameters = parameters[:,0:self.NparametersSource]
+        parametersPK = parameters[:,-self.NparametersModel:]
+
+        yPredictedList = []
+        for n in range(len(self.modelList)):
+            yPredictedList.append(self.modelList[n].forwardModelBatch(parametersPK, x, self.drugSourceList[n],
+                                                                      sourceParameters))
+        yPredictedBatch = []
+        for j in range(len(yPredictedList[0])):
+            yPredictedBatch.append(np.concatenate([yPredicted[j] for yPredicted in yPredictedList],axis=1))
+        return yPredictedBatch
+
+    def hasJacobian(self, parameters):
+        parametersPK = np.asarray(parameters,np.double)[-self.NparametersModel:]
+        for model, drugSource in izip(self.modelList, self.drugSourceList):
+            if not model.hasClosedFormSolution(parametersPK, drugSource):
+                return False
+        return True
+
+    def getJacobian(self, parameters, x=None):
+        """Derivative of the prediction of all samples by forward differences of the closed form solution, evaluated
+        for the parameters and their perturbations in a single batch (see PKPDODEModel.getJacobian)"""
+        if not self.hasJacobian(parameters):
+            return None
+        return self.getJacobianByBatch(parameters, x)
+
     def forwardModelByConvolution(self, parameters, x=None):
         self.setParameters(parameters)
         tFImpulse = None
@@ -395,116 +463,171 @@ class ProtPKPDODEBase(ProtPKPD,PKPDModelBase2):
         elif self.fitType.get()==2:
             fitType = "relative"
 
-        for groupName, group in self.experiment.groups.items():
-            self.printSection("Fitting "+groupName)
-            self.clearGroupParameters()
-
-            for sampleName in group.sampleList:
-                print("   Sample "+sampleName)
-                sample = self.experiment.samples[sampleName]
-
-                self.createDrugSource()
-                self.setupModel()
-
-                # Get the values to fit
-                x, y = sample.getXYValues(self.varNameX,self.varNameY)
-                print("X= "+str(x))
-                print("Y= "+str(y))
-                print(" ")
-
-                # Interpret the dose
-                self.setTimeRange(sample)
-                sample.interpretDose()
-
-                self.drugSource.setDoses(sample.parsedDoseList, self.model.t0, self.model.tF)
-                self.configureSource(self.drugSource)
-                self.model.drugSource = self.drugSource
-
-                # Prepare the model
-                self.setBounds(sample)
-                self.setXYValues(x, y)
-                self.addSample(sample)
-                self.prepareForSampleAnalysis(sampleName)
-                self.calculateParameterUnits(sample)
+        groupNames = list(self.experiment.groups.keys())
+        Nprocesses = self.numberOfProcesses.get()
+        # The random seed of each group makes the global search independent of the process that runs it
+        globalSearchSeed = self.getGlobalSearchSeed()
+        if globalSearchSeed is not None:
+            seeds = np.random.RandomState(globalSearchSeed).randint(0,2**31-1,len(groupNames))
+        else:
+            seeds = np.random.randint(0,2**31-1,len(groupNames))
+        if Nprocesses<=1 or len(groupNames)<=1:
+            self.globalSearchProcesses = Nprocesses
+            for groupName, seed in izip(groupNames, seeds):
+                self.fitGroup(groupName, fitType, reportX, seed if globalSearchSeed is not None else None)
+            parameterNames = self.getParameterNames()
+            description = self.getDescription()
+        else:
+            print("Fitting %d groups with %d processes"%(len(groupNames),Nprocesses))
+            self.globalSearchProcesses = 1
+            results = parallelMap(self._fitGroupInProcess,
+                                  [(groupName, fitType, reportX, seed) for groupName, seed in izip(groupNames, seeds)],
+                                  Nprocesses, captureOutput=True)
+            for log, (sampleFits, descriptors, variables, parameterUnits, parameterNames, description) in results:
+                print(log, end="")
+                self.fitting.sampleFits += sampleFits
+                for sampleName, sampleDescriptors in descriptors:
+                    self.experiment.samples[sampleName].descriptors = sampleDescriptors
+                for varName in variables:
+                    if not varName in self.experiment.variables or \
+                       self.experiment.variables[varName].role==PKPDVariable.ROLE_LABEL:
+                        self.experiment.variables[varName] = variables[varName]
                 if self.fitting.modelParameterUnits==None:
-                    self.fitting.modelParameterUnits = self.parameterUnits
-
-            self.printSetup()
-            self.x = self.mergeLists(self.XList)
-            self.y = self.mergeLists(self.YList)
+                    self.fitting.modelParameterUnits = parameterUnits
 
-            if self.globalSearch:
-                optimizer1 = PKPDDEOptimizer(self,fitType)
-                optimizer1.optimize()
-            else:
-                self.parameters = np.zeros(len(self.boundsList),np.double)
-                n = 0
-                for bound in self.boundsList:
-                    self.parameters[n] = 0.5*(bound[0]+bound[1])
-                    n += 1
-            try:
-                optimizer2 = PKPDLSOptimizer(self,fitType)
-                optimizer2.optimize()
-            except Exception as e:
-                msg="Error: "+str(e)
-                msg+="\nErrors in the local optimizer may be caused by starting from a bad initial guess\n"
-                msg+="Try performing a global search first or changing the bounding box"
-                raise Exception("Error in the local optimizer\n"+msg)
-            optimizer2.setConfidenceInterval(self.getConfidenceInterval())
-            self.setParameters(optimizer2.optimum)
-            optimizer2.evaluateQuality()
-            self.model.printOtherParameterization()
-
-            self.yPredictedList=self.separateLists(self.yPredicted)
-            self.yPredictedLowerList=self.separateLists(self.yPredictedLower)
-            self.yPredictedUpperList=self.separateLists(self.yPredictedUpper)
-
-            n=0
-            for sampleName in group.sampleList:
-                sample = self.experiment.samples[sampleName]
-
-                # Keep this result
-                sampleFit = PKPDSampleFit()
-                sampleFit.sampleName = sample.sampleName
-                sampleFit.x = self.XList[n]
-                sampleFit.y = self.YList[n]
-                sampleFit.yp = self.yPredictedList[n]
-                sampleFit.yl = self.yPredictedLowerList[n]
-                sampleFit.yu = self.yPredictedUpperList[n]
-                sampleFit.parameters = self.parameters
-                sampleFit.modelEquation = self.getEquation()
-                sampleFit.copyFromOptimizer(optimizer2)
-                self.fitting.sampleFits.append(sampleFit)
-
-                # Add the parameters to the sample and experiment
-                for varName, varUnits, description, varValue in izip(self.getParameterNames(), self.parameterUnits, self.getParameterDescriptions(), self.parameters):
-                    self.experiment.addParameterToSample(sampleName, varName, varUnits, description, varValue, rewrite=True)
-                self.experiment.addParameterToSample(sampleName, "R2", PKPDUnit.UNIT_NONE, "Fitting R2", sampleFit.R2, rewrite=True)
-
-                self.postSampleAnalysis(sampleName)
-
-                if reportX!=None:
-                    print("Evaluation of the model at specified time points")
-                    self.model.tF = np.max(reportX)
-                    yreportX = self.model.forwardModel(self.model.parameters, reportX)
-                    print("==========================================")
-                    print("X     Ypredicted     log10(Ypredicted)")
-                    print("==========================================")
-                    for n in range(0,reportX.shape[0]):
-                        aux = 0
-                        if yreportX[n]>0:
-                            aux = math.log10(yreportX[n])
-                        print("%f %f %f"%(reportX[n],yreportX[n],aux))
-                    print(' ')
-
-                n+=1
-
-        self.fitting.modelParameters = self.getParameterNames()
-        self.fitting.modelDescription=self.getDescription()
+        self.fitting.modelParameters = parameterNames
+        self.fitting.modelDescription = description
         self.fitting.write(self._getPath("fitting.pkpd"))
-        self.experiment.general['Model'] = self.getDescription()
+        self.experiment.general['Model'] = description
         self.experiment.write(self._getPath("experiment.pkpd"))
 
+    def fitGroup(self, groupName, fitType, reportX, seed=None):
+        """Fit the samples of a group, the results are added to self.fitting and self.experiment. seed is the
+        random seed of the global search"""
+        group = self.experiment.groups[groupName]
+        self.printSection("Fitting "+groupName)
+        self.clearGroupParameters()
+
+        for sampleName in group.sampleList:
+            print("   Sample "+sampleName)
+            sample = self.experiment.samples[sampleName]
+
+            self.createDrugSource()
+            self.setupModel()
+
+            # Get the values to fit
+            x, y = sample.getXYValues(self.varNameX,self.varNameY)
+            print("X= "+str(x))
+            print("Y= "+str(y))
+            print(" ")
+
+            # Interpret the dose
+            self.setTimeRange(sample)
+            sample.interpretDose()
+
+            self.drugSource.setDoses(sample.parsedDoseList, self.model.t0, self.model.tF)
+            self.configureSource(self.drugSource)
+            self.model.drugSource = self.drugSource
+
+            # Prepare the model
+            self.setBounds(sample)
+            self.setXYValues(x, y)
+            self.addSample(sample)
+            self.prepareForSampleAnalysis(sampleName)
+            self.calculateParameterUnits(sample)
+            if self.fitting.modelParameterUnits==None:
+                self.fitting.modelParameterUnits = self.parameterUnits
+
+        self.printSetup()
+        self.x = self.mergeLists(self.XList)
+        self.y = self.mergeLists(self.YList)
+
+        if self.globalSearch and self.globalSearchMethod.get()==1:
+            optimizer1 = PKPDMultiStartOptimizer(self,fitType)
+            optimizer1.verbose = self.getOptimizerVerbosity()
+            optimizer1.optimize(Nstarts=self.numberOfStarts.get(), seed=seed, Nprocesses=self.globalSearchProcesses)
+        elif self.globalSearch:
+            optimizer1 = PKPDDEOptimizer(self,fitType)
+            optimizer1.verbose = self.getOptimizerVerbosity()
+            optimizer1.optimize(popsize=self.populationSize.get(), maxiter=self.maxIterations.get(), seed=seed,
+                                Nprocesses=self.globalSearchProcesses,
+                                updating='deferred' if self.numberOfProcesses.get()>1 else 'immediate')
+        else:
+            self.parameters = np.zeros(len(self.boundsList),np.double)
+            n = 0
+            for bound in self.boundsList:
+                self.parameters[n] = 0.5*(bound[0]+bound[1])
+                n += 1
+        try:
+            optimizer2 = PKPDLSOptimizer(self,fitType)
+            optimizer2.verbose = self.getOptimizerVerbosity()
+            optimizer2.optimize()
+        except Exception as e:
+            msg="Error: "+str(e)
+            msg+="\nErrors in the local optimizer may be caused by starting from a bad initial guess\n"
+            msg+="Try performing a global search first or changing the bounding box"
+            raise Exception("Error in the local optimizer\n"+msg)
+        optimizer2.setConfidenceInterval(self.getConfidenceInterval())
+        self.setParameters(optimizer2.optimum)
+        optimizer2.evaluateQuality()
+        self.model.printOtherParameterization()
+        print("Number of evaluations of the differential equation: %d"%sum([model.Nfev for model in self.modelList]))
+        print(" ")
+
+        self.yPredictedList=self.separateLists(self.yPredicted)
+        self.yPredictedLowerList=self.separateLists(self.yPredictedLower)
+        self.yPredictedUpperList=self.separateLists(self.yPredictedUpper)
+
+        n=0
+        for sampleName in group.sampleList:
+            sample = self.experiment.samples[sampleName]
+
+            # Keep this result
+            sampleFit = PKPDSampleFit()
+            sampleFit.sampleName = sample.sampleName
+            sampleFit.x = self.XList[n]
+            sampleFit.y = self.YList[n]
+            sampleFit.yp = self.yPredictedList[n]
+            sampleFit.yl = self.yPredictedLowerList[n]
+            sampleFit.yu = self.yPredictedUpperList[n]
+            sampleFit.parameters = self.parameters
+            sampleFit.modelEquation = self.getEquation()
+            sampleFit.copyFromOptimizer(optimizer2)
+            self.fitting.sampleFits.append(sampleFit)
+
+            # Add the parameters to the sample and experiment
+            for varName, varUnits, description, varValue in izip(self.getParameterNames(), self.parameterUnits, self.getParameterDescriptions(), self.parameters):
+                self.experiment.addParameterToSample(sampleName, varName, varUnits, description, varValue, rewrite=True)
+            self.experiment.addParameterToSample(sampleName, "R2", PKPDUnit.UNIT_NONE, "Fitting R2", sampleFit.R2, rewrite=True)
+
+            self.postSampleAnalysis(sampleName)
+
+            if reportX!=None:
+                print("Evaluation of the model at specified time points")
+                self.model.tF = np.max(reportX)
+                yreportX = self.model.forwardModel(self.model.parameters, reportX)
+                print("==========================================")
+                print("X     Ypredicted     log10(Ypredicted)")
+                print("==========================================")
+                for n in range(0,reportX.shape[0]):
+                    aux = 0
+                    if yreportX[n]>0:
+                        aux = math.log10(yreportX[n])
+                    print("%f %f %f"%(reportX[n],yreportX[n],aux))
+                print(' ')
+
+            n+=1
+
+    def _fitGroupInProcess(self, groupName, fitType, reportX, seed):
+        # Executed in a forked process, the results of the group are sent back to the main process
+        np.random.seed(seed)
+        Nfits = len(self.fitting.sampleFits)
+        self.fitGroup(groupName, fitType, reportX, seed)
+        group = self.experiment.groups[groupName]
+        descriptors = [(sampleName, self.experiment.samples[sampleName].descriptors) for sampleName in group.sampleList]
+        return self.fitting.sampleFits[Nfits:], descriptors, self.experiment.variables, \
+               self.fitting.modelParameterUnits, self.getParameterNames(), self.getDescription()
+
     def createOutputStep(self):
         self._defineOutputs(outputFitting=self.fitting)
         self._defineOutputs(outputExperiment=self.experiment)
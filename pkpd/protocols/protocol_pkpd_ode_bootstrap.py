@@ -28,6 +28,7 @@ import numpy as np
 
 import pyworkflow.protocol.params as params
 from pkpd.objects import PKPDFitting, PKPDSampleFitBootstrap, PKPDLSOptimizer
+from pkpd.utils import parallelMapUnordered
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from .protocol_pkpd_ode_base import ProtPKPDODEBase
 
@@ -67,6 +68,7 @@ class ProtPKPDODEBootstrap(ProtPKPDODEBase):
         form.addParam('confidenceInterval', params.FloatParam, label="Confidence interval", default=95, expertLevel=LEVEL_ADVANCED,
                       help='Confidence interval for the fitted parameters')
         form.addParam('deltaT', params.FloatParam, default=2, label='Step (min)', expertLevel=LEVEL_ADVANCED)
+        self._defineParamsBootstrapParallel(form)
 
     #--------------------------- INSERT steps functions --------------------------------------------
     def _insertAllSteps(self):
@@ -138,6 +140,10 @@ class ProtPKPDODEBootstrap(ProtPKPDODEBase):
         elif self.protODE.fitType.get()==2:
             fitType = "relative"
 
+        if self.seed.get()>=0:
+            randomState = np.random.RandomState(self.seed.get())
+        else:
+            randomState = np.random.RandomState()
         parameterNames = None
         for groupName, group in self.experiment.groups.items():
             self.printSection("Fitting "+groupName)
@@ -164,8 +170,6 @@ class ProtPKPDODEBootstrap(ProtPKPDODEBase):
                 x, y = sample.getXYValues(self.varNameX,self.varNameY)
                 print("X= "+str(x))
                 print("Y= "+str(y))
-                firstX=x[0] # From [array(...)] to array(...)
-                firstY=y[0] # From [array(...)] to array(...)
 
                 # Interpret the dose
                 self.protODE.setVarNames(self.varNameX,self.varNameY)
@@ -198,53 +202,15 @@ class ProtPKPDODEBootstrap(ProtPKPDODEBase):
                 # Output object
                 sampleFit = PKPDSampleFitBootstrap()
                 sampleFit.sampleName = sample.sampleName
-                sampleFit.parameters = np.zeros((self.Nbootstrap.get(),len(parameters0)),np.double)
-                sampleFit.xB = []
-                sampleFit.yB = []
+                sampleFit.allocateReplicates(self.Nbootstrap.get(),len(parameters0))
 
                 # Bootstrap samples
-                idx = [k for k in range(0,len(firstX))]
-                for n in range(0,self.Nbootstrap.get()):
-                    ok = False
-                    while not ok:
-                        if self.sampleLength.get()>0:
-                            lenToUse = self.sampleLength.get()
-                        else:
-                            lenToUse = len(idx)
-                        idxB = sorted(np.random.choice(idx,lenToUse))
-                        xB = [np.asarray([firstX[i] for i in idxB])]
-                        yB = [np.asarray([firstY[i] for i in idxB])]
-
-                        print("Bootstrap sample %d"%n)
-                        print("X= "+str(xB))
-                        print("Y= "+str(yB))
-                        self.clearXYLists()
-                        self.setXYValues(xB, yB)
-                        self.parameters = parameters0
-
-                        optimizer2 = PKPDLSOptimizer(self,fitType)
-                        optimizer2.verbose = 0
-                        try:
-                            optimizer2.optimize(ftol=1e-4, xtol=1e-4)
-                            ok=True
-                        except Exception as e:
-                            print(e)
-                            raise(e)
-                            ok=False
-
-                    # Evaluate the quality on the whole data set
-                    self.clearXYLists()
-                    self.setXYValues(x, y)
-                    optimizer2.evaluateQuality()
-                    print(optimizer2.optimum)
-                    print("   R2 = %f R2Adj=%f AIC=%f AICc=%f BIC=%f"%(optimizer2.R2,optimizer2.R2adj,optimizer2.AIC,\
-                                                                       optimizer2.AICc,optimizer2.BIC))
-
-                    # Keep this result
-                    sampleFit.parameters[n,:] = optimizer2.optimum
-                    sampleFit.xB.append(str(xB[0]))
-                    sampleFit.yB.append(str(yB[0]))
-                    sampleFit.copyFromOptimizer(optimizer2)
+                replicateSeeds = randomState.randint(0,2**31-1,self.Nbootstrap.get())
+                argList = [(n, x, y, parameters0, fitType, replicateSeed) for n, replicateSeed in enumerate(replicateSeeds)]
+                for n, (log, replicate) in parallelMapUnordered(self.fitReplicate, argList,
+                                                                self.numberOfProcesses.get(), captureOutput=True):
+                    print(log, end="")
+                    sampleFit.setReplicate(n, *replicate)
 
                 self.fitting.sampleFits.append(sampleFit)
 
@@ -252,6 +218,48 @@ class ProtPKPDODEBootstrap(ProtPKPDODEBase):
         self.fitting.modelDescription = self.getDescription()
         self.fitting.write(self._getPath("bootstrapPopulation.pkpd"))
 
+    def fitReplicate(self, n, x, y, parameters0, fitType, seed):
+        randomState = np.random.RandomState(seed)
+        firstX=x[0] # From [array(...)] to array(...)
+        firstY=y[0] # From [array(...)] to array(...)
+        idx = [k for k in range(0,len(firstX))]
+        ok = False
+        while not ok:
+            if self.sampleLength.get()>0:
+                lenToUse = self.sampleLength.get()
+            else:
+                lenToUse = len(idx)
+            idxB = sorted(randomState.choice(idx,lenToUse))
+            xB = [np.asarray([firstX[i] for i in idxB])]
+            yB = [np.asarray([firstY[i] for i in idxB])]
+
+            print("Bootstrap sample %d"%n)
+            print("X= "+str(xB))
+            print("Y= "+str(yB))
+            self.clearXYLists()
+            self.setXYValues(xB, yB)
+            self.parameters = parameters0
+
+            optimizer2 = PKPDLSOptimizer(self,fitType)
+            optimizer2.verbose = 0
+            try:
+                optimizer2.optimize(ftol=1e-4, xtol=1e-4)
+                ok=True
+            except Exception as e:
+                print(e)
+                raise(e)
+                ok=False
+
+        # Evaluate the quality on the whole data set
+        self.clearXYLists()
+        self.setXYValues(x, y)
+        optimizer2.evaluateQuality()
+        print(optimizer2.optimum)
+        print("   R2 = %f R2Adj=%f AIC=%f AICc=%f BIC=%f"%(optimizer2.R2,optimizer2.R2adj,optimizer2.AIC,\
+                                                           optimizer2.AICc,optimizer2.BIC))
+        return optimizer2.optimum, str(xB[0]), str(yB[0]), \
+               (optimizer2.R2, optimizer2.R2adj, optimizer2.AIC, optimizer2.AICc, optimizer2.BIC)
+
     def createOutputStep(self):
         self._defineOutputs(outputPopulation=self.fitting)
         self._defineSourceRelation(self.inputODE.get(), self.fitting)
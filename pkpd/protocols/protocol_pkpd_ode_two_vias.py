@@ -29,7 +29,8 @@ import numpy as np
 import pyworkflow.protocol.params as params
 from .protocol_pkpd import ProtPKPD
 from pkpd.objects import (PKPDModelBase2, PKPDExperiment, PKPDFitting,
-                          PKPDDEOptimizer, PKPDLSOptimizer, PKPDSampleFit)
+                          PKPDDEOptimizer, PKPDLSOptimizer, PKPDMultiStartOptimizer,
+                          PKPDSampleFit)
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 
 # TESTED in test_workflow_gabrielsson_pk10.py
@@ -62,6 +63,10 @@ class ProtPKPDODETwoVias(ProtPKPD,PKPDModelBase2):
         form.addParam('globalSearch', params.BooleanParam, label="Global search", default=False, expertLevel=LEVEL_ADVANCED,
                       help='Global search looks for the best parameters within bounds. If it is not performed, the '
                            'middle of the bounding box is used as initial parameter for a local optimization')
+        self._defineParamsGlobalSearch(form, condition='globalSearch',
+                                       seedHelp='The fit is also the same for any number of processes above 1 '
+                                                '(see Parallel processes). ', parallel=True)
+        self._defineParamsOptimizerLog(form)
 
     #--------------------------- INSERT steps functions --------------------------------------------
     def _insertAllSteps(self):
@@ -257,6 +262,14 @@ class ProtPKPDODETwoVias(ProtPKPD,PKPDModelBase2):
         self.yPredicted = self.yp1+self.yp2 # Merge two lists
         return self.yPredicted
 
+    def setYPredicted(self, yPredicted):
+        N1 = len(self.yp1)
+        self.yp1 = yPredicted[0:N1]
+        self.yp2 = yPredicted[N1:]
+        self.prot1.yPredicted = self.yp1
+        self.prot2.yPredicted = self.yp2
+        self.yPredicted = yPredicted
+
     def keepSampleFit(self,fitting,prot,sampleName,x,y,yp,yplower,ypupper,prmLowerBound,prmUpperBound,optimizer2):
         sampleFit = PKPDSampleFit()
         sampleFit.sampleName = sampleName
@@ -377,12 +390,22 @@ class ProtPKPDODETwoVias(ProtPKPD,PKPDModelBase2):
                 print(" ")
 
                 # Optimize
-                if self.globalSearch:
+                if self.globalSearch and self.globalSearchMethod.get()==1:
+                    optimizer1 = PKPDMultiStartOptimizer(self,fitType)
+                    optimizer1.verbose = self.getOptimizerVerbosity()
+                    optimizer1.optimize(Nstarts=self.numberOfStarts.get(),
+                                        seed=self.getGlobalSearchSeed(),
+                                        Nprocesses=self.numberOfProcesses.get())
+                elif self.globalSearch:
                     optimizer1 = PKPDDEOptimizer(self,fitType)
-                    optimizer1.optimize()
+                    optimizer1.verbose = self.getOptimizerVerbosity()
+                    optimizer1.optimize(popsize=self.populationSize.get(), maxiter=self.maxIterations.get(),
+                                        seed=self.getGlobalSearchSeed(),
+                                        Nprocesses=self.numberOfProcesses.get())
                 else:
                     self.setInitialSolution(sample2name)
                 optimizer2 = PKPDLSOptimizer(self,fitType)
+                optimizer2.verbose = self.getOptimizerVerbosity()
                 optimizer2.optimize()
                 optimizer2.setConfidenceInterval(self.prot1.confidenceInterval.get())
                 self.setParameters(optimizer2.optimum)
@@ -81,6 +81,7 @@ are independent, which are not. Use Bootstrap estimates instead.\n
                       help='Confidence interval for the fitted parameters')
         form.addParam('reportX', params.StringParam, label="Evaluate at X=", default="", expertLevel=LEVEL_ADVANCED,
                       help='Evaluate the model at these X values\nExample 1: [0,5,10,20,40,100]\nExample 2: 0:2:10, from 0 to 10 in steps of 2')
+        self._defineParamsGlobalSearch(form, parallel=True)
 
     def getListOfFormDependencies(self):
         return [self.modelType.get(), self.fitType.get(), self.bounds.get(), self.confidenceInterval.get(),
@@ -61,12 +61,7 @@ class PKPDLiver(PKPDODEModel):
         return np.array([0.0,dD/Vinlet,0.0],np.double)
 
     def imposeConstraints(self, yt):
-        if yt[0]<0:
-            yt[0]=0
-        if yt[1]<0:
-            yt[1]=0
-        if yt[2]<0:
-            yt[2]=0
+        yt[yt<0]=0
 
     def getResponseDimension(self):
         return 3
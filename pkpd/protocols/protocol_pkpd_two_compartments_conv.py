@@ -47,6 +47,12 @@ class ProtPKPDTwoCompartmentsConv(ProtPKPDODEBase):
     def forwardModel(self, parameters, x=None):
         return self.forwardModelByConvolution(parameters, x)
 
+    def hasJacobian(self, parameters):
+        return False # The convolution has no batched version
+
+    def getJacobian(self, parameters, x=None):
+        return None
+
     #--------------------------- DEFINE param functions --------------------------------------------
     def _defineParams(self, form):
         self._defineParams1(form, True, "t", "Cp")
@@ -29,6 +29,7 @@ from pkpd.protocols import *
 from pkpd.objects import PKPDDataSet
 from .test_workflow import TestWorkflow
 import copy
+import numpy as np
 
 class TestDissolutionWorkflow(TestWorkflow):
 
@@ -358,6 +359,21 @@ class TestDissolutionWorkflow(TestWorkflow):
         self.assertTrue(mu[1]>0.28 and mu[1]<0.29)
         self.assertTrue(mu[2]>1.4 and mu[2]<1.5)
 
+        # The same seed produces the same bootstrap samples for any number of processes
+        print("Fitting bootstrap with a seed ...")
+        bootstrapParameters = []
+        for numberOfProcesses in [1, 2]:
+            prot = self.newProtocol(ProtPKPDFitBootstrap,
+                                    objLabel='pkpd - fit bootstrap seed %d processes'%numberOfProcesses,
+                                    Nbootstrap=10, seed=1, numberOfProcesses=numberOfProcesses)
+            prot.inputFit.set(protWeibull)
+            self.launchProtocol(prot)
+            self.assertIsNotNone(prot.outputPopulation.fnFitting, "There was a problem with the fit bootstrap")
+            fitting = PKPDFitting("PKPDSampleFitBootstrap")
+            fitting.load(prot.outputPopulation.fnFitting)
+            bootstrapParameters.append([np.asarray(sampleFit.parameters, np.double) for sampleFit in fitting.sampleFits])
+        self.assertTrue(np.array_equal(bootstrapParameters[0], bootstrapParameters[1]))
+
         # Check that operations are working
         print("Operations 1 ...")
         prot = self.newProtocol(ProtPKPDOperateExperiment,
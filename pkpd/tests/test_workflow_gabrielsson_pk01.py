@@ -25,6 +25,9 @@
 # **************************************************************************
 
 
+import os
+import shutil
+
 from pyworkflow.tests import *
 from pkpd.protocols import *
 from .test_workflow import TestWorkflow
@@ -139,5 +142,90 @@ class TestGabrielssonPK01Workflow(TestWorkflow):
         self.assertTrue(fitting.sampleFits[0].R2>0.9887)
         self.assertTrue(fitting.sampleFits[0].AIC<-45.8)
 
+        # The binary sidecars give the same experiment and fitting as the text files
+        fnExperiment = protIVMonoCompartment.outputExperiment.fnPKPD.get()
+        fnFitting = protIVMonoCompartment.outputFitting.fnFitting.get()
+        experimentText = PKPDExperiment()
+        experimentText.load(fnExperiment, useSidecar=False)
+        experimentLazy = PKPDExperiment()
+        experimentLazy.load(fnExperiment, lazy=True)
+        for varName in ['t', 'Cp']:
+            self.assertEqual(experiment.samples['Individual1'].getValues(varName),
+                             experimentText.samples['Individual1'].getValues(varName))
+            self.assertEqual(experimentLazy.samples['Individual1'].getValues(varName),
+                             experimentText.samples['Individual1'].getValues(varName))
+        fittingText = PKPDFitting()
+        fittingText.load(fnFitting, useSidecar=False)
+        self.assertEqual(list(fitting.sampleFits[0].parameters), list(fittingText.sampleFits[0].parameters))
+        self.assertEqual(fitting.sampleFits[0].R2, fittingText.sampleFits[0].R2)
+        self.assertEqual(fitting.sampleFits[0].y, fittingText.sampleFits[0].y)
+
+        # A sidecar is ignored once its text file has been modified
+        modifiedDir = protIVMonoCompartment._getExtraPath('modified')
+        os.makedirs(modifiedDir)
+        for fn in [fnExperiment, fnFitting]:
+            fnModified = os.path.join(modifiedDir, os.path.basename(fn))
+            with open(fn) as fhIn, open(fnModified, 'w') as fhOut:
+                fhOut.write(fhIn.read().replace('Individual1', 'Modified1'))
+            fnSidecar = os.path.splitext(fn)[0]+".npz"
+            shutil.copy(fnSidecar, os.path.join(modifiedDir, os.path.basename(fnSidecar)))
+        experimentModified = PKPDExperiment()
+        experimentModified.load(os.path.join(modifiedDir, os.path.basename(fnExperiment)))
+        self.assertEqual(list(experimentModified.samples.keys()), ['Modified1'])
+        fittingModified = PKPDFitting()
+        fittingModified.load(os.path.join(modifiedDir, os.path.basename(fnFitting)))
+        self.assertEqual(fittingModified.sampleFits[0].sampleName, 'Modified1')
+
+        # Fit the same model with an adaptive integrator
+        print("Fitting monocompartmental model with LSODA...")
+        protIVMonoCompartmentLSODA = self.newProtocol(ProtPKPDMonoCompartment,
+                                                      objLabel='pkpd - iv monocompartment lsoda',
+                                                      bounds='(0.0, 0.2); (0.0, 20.0)', integrator=2,
+                                                      analytic=False)
+        protIVMonoCompartmentLSODA.inputExperiment.set(protNCAIVObs.outputExperiment)
+        self.launchProtocol(protIVMonoCompartmentLSODA)
+        self.assertIsNotNone(protIVMonoCompartmentLSODA.outputExperiment.fnPKPD, "There was a problem with the monocompartmental model ")
+        self.assertIsNotNone(protIVMonoCompartmentLSODA.outputFitting.fnFitting, "There was a problem with the monocompartmental model ")
+
+        experiment = PKPDExperiment()
+        experiment.load(protIVMonoCompartmentLSODA.outputExperiment.fnPKPD)
+        Cl=float(experiment.samples['Individual1'].descriptors['Cl'])
+        V=float(experiment.samples['Individual1'].descriptors['V'])
+        self.assertTrue(Cl>0.09 and Cl<0.11)
+        self.assertTrue(V>9.7 and V<10)
+        fitting = PKPDFitting()
+        fitting.load(protIVMonoCompartmentLSODA.outputFitting.fnFitting)
+        self.assertTrue(fitting.sampleFits[0].R2>0.9887)
+
+        # Delay the intravenous bolus by a tlag larger than the Runge-Kutta step
+        print("Change via to a lagged intravenous...")
+        protChangeVia = self.newProtocol(ProtPKPDChangeVia,
+                                         objLabel='pkpd - change via',
+                                         viaName='Intravenous', newViaType="", tlag="5", bioavailability="1")
+        protChangeVia.inputExperiment.set(protChangeUnits.outputExperiment)
+        self.launchProtocol(protChangeVia)
+        self.assertIsNotNone(protChangeVia.outputExperiment.fnPKPD, "There was a problem with the change of via")
+
+        # The closed form, Runge-Kutta 4 and LSODA give the same fit of the lagged bolus
+        lagged = {}
+        for label, integrator, analytic in [('closed form', 0, True), ('rk4', 0, False), ('lsoda', 2, False)]:
+            print("Fitting monocompartmental model with lagged bolus (%s)..."%label)
+            protLagged = self.newProtocol(ProtPKPDMonoCompartment,
+                                          objLabel='pkpd - iv monocompartment lagged %s'%label,
+                                          bounds='(0.0, 0.2); (0.0, 20.0)', integrator=integrator,
+                                          analytic=analytic)
+            protLagged.inputExperiment.set(protChangeVia.outputExperiment)
+            self.launchProtocol(protLagged)
+            self.assertIsNotNone(protLagged.outputFitting.fnFitting, "There was a problem with the monocompartmental model ")
+            experiment = PKPDExperiment()
+            experiment.load(protLagged.outputExperiment.fnPKPD)
+            lagged[label] = [float(experiment.samples['Individual1'].descriptors[varName]) for varName in ['Cl', 'V']]
+            fitting = PKPDFitting()
+            fitting.load(protLagged.outputFitting.fnFitting)
+            self.assertTrue(fitting.sampleFits[0].R2>0.9887)
+        for label in ['rk4', 'lsoda']:
+            for value, valueClosedForm in zip(lagged[label], lagged['closed form']):
+                self.assertTrue(abs(value-valueClosedForm)<0.01*valueClosedForm)
+
 if __name__ == "__main__":
     unittest.main()
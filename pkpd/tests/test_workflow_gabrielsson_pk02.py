@@ -25,6 +25,8 @@
 # **************************************************************************
 
 
+import numpy as np
+
 from pyworkflow.tests import *
 from pkpd.protocols import *
 from .test_workflow import TestWorkflow
@@ -170,5 +172,37 @@ class TestGabrielssonPK02Workflow(TestWorkflow):
         self.assertIsNotNone(protFilterBootstrap.outputPopulation.fnFitting, "There was a problem with the population filter")
         self.validateFiles('protFilterBootstrap', protFilterBootstrap)
 
+        # The same seed produces the same bootstrap samples for any number of processes
+        print("Bootstrapping model with a seed...")
+        bootstrapParameters = []
+        for numberOfProcesses in [1, 2]:
+            protBootstrap = self.newProtocol(ProtPKPDODEBootstrap,
+                                             objLabel='pkpd - bootstrap seed %d processes'%numberOfProcesses,
+                                             Nbootstrap=10, seed=1, numberOfProcesses=numberOfProcesses)
+            protBootstrap.inputODE.set(protEV1MonoCompartment)
+            self.launchProtocol(protBootstrap)
+            self.assertIsNotNone(protBootstrap.outputPopulation.fnFitting, "There was a problem with the bootstrap")
+            fitting = PKPDFitting("PKPDSampleFitBootstrap")
+            fitting.load(protBootstrap.outputPopulation.fnFitting)
+            bootstrapParameters.append([np.asarray(sampleFit.parameters, np.double) for sampleFit in fitting.sampleFits])
+        self.assertTrue(np.array_equal(bootstrapParameters[0], bootstrapParameters[1]))
+
+        # With more than one process the population of the global search is updated once per generation, and the
+        # same seed produces the same fit for any number of processes
+        print("Fitting monocompartmental model with a seed...")
+        fitParameters = []
+        for numberOfProcesses in [2, 3]:
+            protSeed = self.newProtocol(ProtPKPDMonoCompartment,
+                                        objLabel='pkpd - ev1 monocompartment seed %d processes'%numberOfProcesses,
+                                        bounds='(0.0, 30.0); (0.0, 0.2); (0.0, 1.0); (0.0, 100.0)',
+                                        seed=1, numberOfProcesses=numberOfProcesses)
+            protSeed.inputExperiment.set(protAbsorptionRate.outputExperiment)
+            self.launchProtocol(protSeed)
+            self.assertIsNotNone(protSeed.outputFitting.fnFitting, "There was a problem with the monocompartmental model ")
+            fitting = PKPDFitting()
+            fitting.load(protSeed.outputFitting.fnFitting)
+            fitParameters.append(np.asarray(fitting.sampleFits[0].parameters, np.double))
+        self.assertTrue(np.array_equal(fitParameters[0], fitParameters[1]))
+
 if __name__ == "__main__":
     unittest.main()
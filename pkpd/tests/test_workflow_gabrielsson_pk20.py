@@ -25,6 +25,8 @@
 # **************************************************************************
 
 
+import numpy as np
+
 from pyworkflow.tests import *
 from pkpd.protocols import *
 from pkpd.objects import PKPDDataSet
@@ -102,5 +104,27 @@ class TestGabrielssonPK20Workflow(TestWorkflow):
         self.assertTrue(fitting.sampleFits[0].R2>0.99)
         self.assertTrue(fitting.sampleFits[1].R2>0.99)
 
+        # Multi-start global search. Each group has its own seed, derived from the seed of the protocol, so that the
+        # fit is the same whether the groups are fitted sequentially or in parallel
+        print("Fitting a mono-compartment model intrinsic with a multi-start search ...")
+        fitParameters = []
+        for numberOfProcesses in [1, 2]:
+            protMultiStart = self.newProtocol(ProtPKPDMonoCompartmentClint,
+                                              objLabel='pkpd - iv mono-compartment intrinsic multi-start %d processes'%
+                                                       numberOfProcesses,
+                                              globalSearch=True, globalSearchMethod=1, fitType=1,
+                                              seed=1, numberOfProcesses=numberOfProcesses,
+                                              bounds='(0,1); (0,1); (0,100)')
+            protMultiStart.inputExperiment.set(protChangeConcUnit.outputExperiment)
+            self.launchProtocol(protMultiStart)
+            self.assertIsNotNone(protMultiStart.outputFitting.fnFitting, "There was a problem with the mono-compartmental model ")
+            fitting = PKPDFitting()
+            fitting.load(protMultiStart.outputFitting.fnFitting)
+            self.assertEqual(len(fitting.sampleFits), 2)
+            self.assertTrue(fitting.sampleFits[0].R2>0.99)
+            self.assertTrue(fitting.sampleFits[1].R2>0.99)
+            fitParameters.append([np.asarray(sampleFit.parameters, np.double) for sampleFit in fitting.sampleFits])
+        self.assertTrue(np.array_equal(fitParameters[0], fitParameters[1]))
+
 if __name__ == "__main__":
     unittest.main()
@@ -102,6 +102,48 @@ class TestInhalation1Workflow(TestWorkflow):
         retention = np.asarray([float(x) for x in experiment.samples['simulation'].getValues('Retention')])
         self.assertTrue(abs(retention[0]-100.0)<0.001)
         self.assertTrue(abs(retention[8000]-1.3809)<0.001)
+        # The deposition projection and the lung geometry are cached in the extra folder
+        cachedFiles = os.listdir(protSimulate._getExtraPath())
+        self.assertEqual(len([fn for fn in cachedFiles if fn.startswith("deposition_") and fn.endswith(".npz")]), 1)
+        self.assertEqual(len([fn for fn in cachedFiles if fn.startswith("geometry_") and fn.endswith(".npz")]), 1)
+
+        # Simulate inhalation with adaptive time steps
+        print("Inhalation simulation with adaptive time steps ...")
+        protSimulateAdaptive = self.newProtocol(ProtPKPDInhSimulate,
+                                                objLabel='pkpd - simulate inhalation adaptive',
+                                                deltaT=1.8, adaptiveStep=True)
+        protSimulateAdaptive.ptrDeposition.set(protDepo.outputDeposition)
+        protSimulateAdaptive.ptrPK.set(protPK.outputExperiment)
+        self.launchProtocol(protSimulateAdaptive)
+        self.assertIsNotNone(protSimulateAdaptive.outputExperiment.fnPKPD, "There was a problem with the simulation")
+        experiment = PKPDExperiment()
+        experiment.load(protSimulateAdaptive.outputExperiment.fnPKPD)
+        retentionAdaptive = np.asarray([float(x) for x in experiment.samples['simulation'].getValues('Retention')])
+        self.assertTrue(abs(retentionAdaptive[0]-100.0)<0.001)
+        self.assertTrue(abs(retentionAdaptive[8000]-retention[8000])<0.001)
+
+        # Simulate two scenarios, each diameter separately, reporting every 10 time steps. The deposition has a single
+        # diameter and the gold is not dissolved, so that the retention is the same as in the simulation above
+        print("Inhalation simulation of scenarios and size classes ...")
+        protSimulateScenarios = self.newProtocol(ProtPKPDInhSimulate,
+                                                 objLabel='pkpd - simulate inhalation scenarios',
+                                                 deltaT=1.8, reportStep=10,
+                                                 scenarios="reference; 1\nhalf dose; 0.5",
+                                                 sizeClasses=True)
+        protSimulateScenarios.ptrDeposition.set(protDepo.outputDeposition)
+        protSimulateScenarios.ptrPK.set(protPK.outputExperiment)
+        self.launchProtocol(protSimulateScenarios)
+        self.assertIsNotNone(protSimulateScenarios.outputExperiment.fnPKPD, "There was a problem with the simulation")
+        experiment = PKPDExperiment()
+        experiment.load(protSimulateScenarios.outputExperiment.fnPKPD)
+        self.assertEqual(sorted(experiment.samples.keys()), ['half dose_5um', 'reference_5um'])
+        for sampleName, doseMultiplier in [('reference_5um', 1.0), ('half dose_5um', 0.5)]:
+            sample = experiment.samples[sampleName]
+            self.assertTrue(abs(float(sample.getDescriptorValue('dose_multiplier'))-doseMultiplier)<1e-6)
+            self.assertTrue(abs(float(sample.getDescriptorValue('diameter'))-5.0)<1e-6)
+            retentionScenario = np.asarray([float(x) for x in sample.getValues('Retention')])
+            self.assertEqual(len(retentionScenario), 801)
+            self.assertTrue(abs(retentionScenario[800]-retention[8000])<0.001)
 
         # Plot short term
         dataSmith=pandas.read_csv(self.dataset.getFile('SmithPSLGold6'))
@@ -161,5 +203,25 @@ class TestInhalation1Workflow(TestWorkflow):
         plt.legend(legends)
         plt.savefig('longTerm.png')
 
+    def testQualityControl(self):
+        from pkpd.inhalation import quality_control_failures
+        # A NaN in the first check must not hide a later negative value, and it is reported itself
+        failed = quality_control_failures([np.nan, 1.0, -1.0, 2.0, np.inf])
+        self.assertEqual(list(failed), [True, False, True, False, True])
+        self.assertFalse(np.any(quality_control_failures([0.5, 0.0, 1.0])))
+
+    def testBilinearInterpolation(self):
+        from pkpd.inhalation import bilinear_interpolation
+        # z=x+10*y is reproduced exactly inside the grid, whatever the order of the grid axes
+        x = np.asarray([0.0, 1.0, 3.0])
+        y = np.asarray([0.0, 2.0])
+        xi = np.asarray([0.5, 2.0, 4.0])
+        yi = np.asarray([1.0])
+        z = np.add.outer(10*y, x)
+        zi = bilinear_interpolation(x, y, z, xi, yi)
+        self.assertTrue(np.allclose(zi, [[10.5, 12.0, 0.0]]))
+        ziReversed = bilinear_interpolation(x[::-1], y[::-1], z[::-1, ::-1], xi, yi)
+        self.assertTrue(np.allclose(ziReversed, zi))
+
 if __name__ == "__main__":
     unittest.main()
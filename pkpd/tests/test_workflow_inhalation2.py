@@ -164,6 +164,30 @@ class TestInhalation2Workflow(TestWorkflow):
         [tmax30x45, Cmax30x45, AUC_Sys_12h_scaled30x45] = simulate(protDepo30, "3.0x4.5", 4.5,  66.06,  76.2173, 510.0135)
         [tmax60x45, Cmax60x45, AUC_Sys_12h_scaled60x45] = simulate(protDepo60, "6.0x4.5", 4.5, 378.36,  15.4504, 178.0614)
 
+        # Simulate both doses as scenarios of a single simulation, in parallel
+        print("Inhalation simulation of scenarios ...")
+        protScenarios = self.newProtocol(ProtPKPDInhSimulate,
+                                         objLabel='pkpd - simulate inhalation scenarios 1.5',
+                                         simulationTime=12 * 60,
+                                         deltaT=0.18,
+                                         scenarios="x1; 1\nx4.5; 4.5",
+                                         numberOfProcesses=2)
+        protScenarios.ptrDeposition.set(protDepo15.outputDeposition)
+        protScenarios.ptrPK.set(protPK.outputExperiment)
+        self.launchProtocol(protScenarios)
+        self.assertIsNotNone(protScenarios.outputExperiment.fnPKPD, "There was a problem with the simulation")
+        experiment = PKPDExperiment()
+        experiment.load(protScenarios.outputExperiment.fnPKPD)
+        self.assertEqual(sorted(experiment.samples.keys()), ['x1', 'x4.5'])
+        for sampleName, multiplier, NCA0 in [('x1', 1.0, [tmax15x1, Cmax15x1, AUC_Sys_12h_scaled15x1]),
+                                             ('x4.5', 4.5, [tmax15x45, Cmax15x45, AUC_Sys_12h_scaled15x45])]:
+            sample = experiment.samples[sampleName]
+            self.assertTrue(abs(float(sample.getDescriptorValue('dose_multiplier'))-multiplier)<1e-6)
+            t = np.asarray([float(x) for x in sample.getValues('t')])
+            Cnmol = np.asarray([float(x) for x in sample.getValues('Cnmol')])
+            for value, value0 in zip(NCA(t, Cnmol, MW), NCA0):
+                self.assertTrue(abs(value - value0) < 0.0001)
+
         print('Nominal dose')
         print('Aerodynamic Diameter=%f AUC_12h=%f Cmax=%f tmax=%f'%(1.5, AUC_Sys_12h_scaled15x1, Cmax15x1, tmax15x1))
         print('Aerodynamic Diameter=%f AUC_12h=%f Cmax=%f tmax=%f'%(3.0, AUC_Sys_12h_scaled30x1, Cmax30x1, tmax30x1))
@@ -27,6 +27,9 @@
 PKPD functions
 """
 import copy
+import functools
+import os
+import sys
 try:
     from itertools import izip
 except ImportError:
@@ -36,6 +39,8 @@ import math
 from scipy.interpolate import InterpolatedUnivariateSpline, pchip_interpolate
 import time
 import hashlib
+from contextlib import redirect_stdout
+from io import StringIO
 from os.path import (exists, splitext, getmtime)
 from openpyxl.styles import Font, PatternFill
 from openpyxl.utils.cell import get_column_letter
@@ -103,6 +108,68 @@ def verifyMD5(fn):
         fn=fnFile
     return getMD5String(fn)==md5StringFile
 
+def getSidecarFilename(fn):
+    return splitext(fn)[0]+".npz"
+
+def writeSidecar(fn, arrays):
+    """ Binary copy (.npz) of the content of fn. It keeps the MD5 of fn so that it is only used while fn is not
+    modified """
+    np.savez(getSidecarFilename(fn), md5=getMD5String(fn), **arrays)
+
+def readSidecar(fn):
+    """ Dictionary with the arrays of the sidecar of fn, None if there is no sidecar or fn has been modified
+    after writing it """
+    if fn is None:
+        return None
+    fnSidecar = getSidecarFilename(fn)
+    if not exists(fn) or not exists(fnSidecar):
+        return None
+    try:
+        with np.load(fnSidecar, allow_pickle=False) as data:
+            arrays = dict(data)
+    except Exception:
+        return None
+    if str(arrays.pop("md5",""))!=getMD5String(fn):
+        return None
+    return arrays
+
+def packLists(lists, dtype):
+    """ A list of lists of different lengths as a single array and the offsets of each list in it """
+    offsets = np.cumsum([0]+[len(values) for values in lists])
+    return np.array([value for values in lists for value in values], dtype=dtype), offsets
+
+def unpackLists(values, offsets):
+    values = values.tolist()
+    return [values[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+def getMD5Key(fileNames, *values):
+    """ MD5 of the content of the files and the given values (numbers, strings, lists or arrays) """
+    mhash = hashlib.md5()
+    for fn in fileNames:
+        mhash.update(getMD5String(fn).encode())
+    for value in values:
+        if isinstance(value, np.ndarray):
+            mhash.update(("%s%s"%(value.dtype, value.shape)).encode())
+            mhash.update(np.ascontiguousarray(value).tobytes())
+        else:
+            mhash.update(repr(value).encode())
+    return mhash.hexdigest()
+
+def cachedArrays(fnCache, function, *args):
+    """ Dictionary of arrays returned by function(*args). It is stored in fnCache (.npz) the first time and read from
+    it afterwards, so that fnCache must be named after everything the result depends on (see getMD5Key) """
+    if exists(fnCache):
+        try:
+            with np.load(fnCache, allow_pickle=False) as data:
+                return dict(data)
+        except Exception:
+            pass
+    arrays = function(*args)
+    fnTmp = "%s_%d.npz"%(splitext(fnCache)[0], os.getpid()) # Several processes may be writing the same file
+    np.savez(fnTmp, **arrays)
+    os.replace(fnTmp, fnCache)
+    return arrays
+
 def uniqueFloatValues(x,y, TOL=-1):
     xp=np.asarray(x,dtype=np.float64)
     yp=np.asarray(y,dtype=np.float64)
@@ -227,6 +294,17 @@ def excelWriteRow(msgList, workbook, row, col=1, sheetName="", bold=False):
             print("Cannot convert the cell row=%d, col=%d"%(row,col),msg)
         currentCol+=1
 
+def excelAppendRows(rowList, workbook, sheetName=""):
+    # Much faster than writing the rows cell by cell with excelWriteRow
+    if sheetName!="":
+        if not sheetName in workbook.sheetnames:
+            workbook.create_sheet(sheetName)
+        sheet=workbook[sheetName]
+    else:
+        sheet=workbook.active
+    for row in rowList:
+        sheet.append(row)
+
 def excelFillCells(workbook, row, col0=1, colF=10, sheetName="", fillColor="54B948"):
     if sheetName!="":
         if not sheetName in workbook.sheetnames:
@@ -321,3 +399,159 @@ def int_dx1dx2(x1, x2, y):
     dx1 = np.diff(x1)
     dx2 = np.diff(x2)
     return np.sum(np.multiply(np.sum(np.multiply(y,dx2),axis=1),dx1))
+
+def expDifference(a, b, t):
+    # (exp(a*t)-exp(b*t))/(a-b) for t>=0, also valid when a and b are (almost) equal
+    m = np.maximum(a,b)
+    d = np.abs(a-b)
+    dt = d*t
+    dSafe = np.where(d>0,d,1.0)
+    return np.exp(m*t)*np.where(dt>1e-8,-np.expm1(-dt)/dSafe,t*(1-0.5*dt))
+
+def latinHypercube(bounds, N, randomState=None):
+    """N points (N x len(bounds)) in the box given by a list of (lower, upper) bounds. Each parameter range is
+    divided in N intervals of equal length and every interval contains exactly one point"""
+    if randomState is None:
+        randomState = np.random
+    points = np.zeros((N,len(bounds)),np.double)
+    for j, (lower, upper) in enumerate(bounds):
+        u = (randomState.permutation(N)+randomState.uniform(size=N))/N
+        points[:,j] = lower+u*(upper-lower)
+    return points
+
+class PhaseTimer:
+    """Wall time spent in each phase of a computation. lap(phase) adds to phase the time since the previous lap
+    (or since the timer was created)"""
+    def __init__(self):
+        self.times = {}
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.times[phase] = self.times.get(phase, 0.0) + now - self.last
+        self.last = now
+
+class ProgressReporter:
+    """
+    Report the progress of an iterative computation according to a verbosity level: QUIET prints nothing, PROGRESS
+    prints the progress messages at most once every minInterval seconds and DEBUG prints all the progress and debug
+    messages. Messages are given as a format and its arguments, they are only formatted if they are printed.
+    """
+    QUIET = 0
+    PROGRESS = 1
+    DEBUG = 2
+
+    def __init__(self, minInterval=5.0):
+        self.minInterval = minInterval
+        self.lastReport = None
+
+    def progress(self, verbose, message, *args):
+        """Print the message if the verbosity is DEBUG, or PROGRESS and the last report is old enough"""
+        if verbose<ProgressReporter.PROGRESS:
+            return False
+        now = time.perf_counter()
+        if verbose<ProgressReporter.DEBUG and self.lastReport is not None and now-self.lastReport<self.minInterval:
+            return False
+        self.lastReport = now
+        self._print(message, args)
+        return True
+
+    def debug(self, verbose, message, *args):
+        """Print the message if the verbosity is DEBUG"""
+        if verbose>=ProgressReporter.DEBUG:
+            self._print(message, args)
+
+    def _print(self, message, args):
+        print(message%args if args else message)
+        sys.stdout.flush()
+
+def callCapturingOutput(function, *args):
+    """
+    Call function(*args) and return what it prints and its result. If it raises an exception, the exception is
+    re-raised with what was printed appended to its args.
+    """
+    log = StringIO()
+    try:
+        with redirect_stdout(log):
+            result = function(*args)
+    except Exception as e:
+        e.args += (log.getvalue(),)
+        raise
+    return log.getvalue(), result
+
+_parallelFunction = None
+
+def _callParallelFunction(args):
+    return _parallelFunction(*args)
+
+def _callParallelFunctionIndexed(indexedArgs):
+    return indexedArgs[0], _parallelFunction(*indexedArgs[1])
+
+def parallelMap(function, argList, Nprocesses, captureOutput=False):
+    """
+    Evaluate function(*args) for every args in argList using Nprocesses processes and return the results in the
+    same order as argList. The processes are forked, so that they inherit the state of the caller and function does
+    not need to be picklable (args and the results must be). If captureOutput, each result is a pair (log, result)
+    with what function printed, so that the caller can print the logs of simultaneous processes one after another.
+    When the evaluation is serial, the output is not captured but printed as it is produced, and the logs are empty.
+    """
+    global _parallelFunction
+    if Nprocesses<=1 or len(argList)<=1:
+        return [("", function(*args)) if captureOutput else function(*args) for args in argList]
+    if captureOutput:
+        function = functools.partial(callCapturingOutput, function)
+    import multiprocessing
+    _parallelFunction = function
+    try:
+        with multiprocessing.get_context("fork").Pool(min(Nprocesses,len(argList))) as pool:
+            return pool.map(_callParallelFunction, argList, chunksize=1)
+    finally:
+        _parallelFunction = None
+
+class ForkedPool:
+    """
+    Nprocesses processes that evaluate function(*args) for lists of args (see parallelMap). The processes are forked
+    only once, when the pool is created, so that they inherit the state of the caller at that moment. Use it as a
+    context manager, the processes are terminated on exit.
+    """
+    def __init__(self, function, Nprocesses):
+        global _parallelFunction
+        import multiprocessing
+        self.Nprocesses = Nprocesses
+        _parallelFunction = function
+        try:
+            self.pool = multiprocessing.get_context("fork").Pool(Nprocesses)
+        finally:
+            _parallelFunction = None
+
+    def map(self, argList):
+        """Results of function(*args) for every args in argList, in the same order as argList"""
+        chunksize = max(1,len(argList)//(4*self.Nprocesses))
+        return self.pool.map(_callParallelFunction, argList, chunksize=chunksize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.pool.terminate()
+        self.pool.join()
+
+def parallelMapUnordered(function, argList, Nprocesses, captureOutput=False):
+    """
+    Same as parallelMap, but the results are yielded as soon as they are available as pairs (index in argList, result)
+    """
+    global _parallelFunction
+    if Nprocesses<=1 or len(argList)<=1:
+        for i, args in enumerate(argList):
+            yield i, ("", function(*args)) if captureOutput else function(*args)
+        return
+    if captureOutput:
+        function = functools.partial(callCapturingOutput, function)
+    import multiprocessing
+    _parallelFunction = function
+    try:
+        with multiprocessing.get_context("fork").Pool(min(Nprocesses,len(argList))) as pool:
+            for i, result in pool.imap_unordered(_callParallelFunctionIndexed, enumerate(argList)):
+                yield i, result
+    finally:
+        _parallelFunction = None